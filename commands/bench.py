@@ -0,0 +1,128 @@
+from time import monotonic
+from statistics import mean, median
+
+from commands import Command
+from uengine import ctx
+
+
+def report(name, timings):
+    timings_ms = sorted(t * 1000 for t in timings)
+    p95 = timings_ms[int(len(timings_ms) * 0.95) - 1]
+    print(f"{name:<32} mean {mean(timings_ms):8.3f}ms  median {median(timings_ms):8.3f}ms  p95 {p95:8.3f}ms")
+
+
+async def measure(coro_func, iterations):
+    timings = []
+    for _ in range(iterations):
+        t1 = monotonic()
+        await coro_func()
+        timings.append(monotonic() - t1)
+    return timings
+
+
+class Bench(Command):
+
+    DESCRIPTION = "Run performance benchmarks against the configured (local) database"
+
+    BENCHMARKS = ("pagination", "json")
+
+    def init_argument_parser(self, parser):
+        parser.add_argument("benchmark", choices=self.BENCHMARKS, help="Benchmark to run")
+        parser.add_argument("-n", "--iterations", type=int, dest="iterations", default=200,
+                            help="Number of measured iterations")
+        parser.add_argument("-d", "--documents", type=int, dest="documents", default=20000,
+                            help="Number of documents to create (or to serialize) for the benchmark")
+
+    async def run_async(self):
+        from sandboxapp import force_init_app
+        force_init_app()
+        bench_func = getattr(self, f"bench_{self.args.benchmark}")
+        await bench_func()
+
+    async def bench_pagination(self):
+        from uengine.api import paginated, pagination_params, count_documents, CountMode
+        from uengine.models.storable_model import StorableModel
+        from uengine.utils import gather_or_cancel
+
+        class BenchUser(StorableModel):
+            __collection__ = "bench_users"
+            username: str
+            email: str = None
+
+        collection = ctx.db.meta.conn[BenchUser.__collection__]
+        await collection.drop()
+        docs = [{"username": f"user{idx:08d}", "email": f"user{idx}@example.com"}
+                for idx in range(self.args.documents)]
+        await collection.insert_many(docs)
+        await collection.create_index("username")
+
+        pagination = pagination_params(_page=50, _limit=20, _count=CountMode.exact)
+
+        async def serial():
+            data = BenchUser.find({"username": {"$gte": "user0"}}).sort("username")
+            await count_documents(data)
+            await data.skip(980).limit(21).all()
+
+        async def concurrent():
+            data = BenchUser.find({"username": {"$gte": "user0"}}).sort("username")
+            await gather_or_cancel(count_documents(data), data.skip(980).limit(21).all())
+
+        async def list_endpoint():
+            data = BenchUser.find({"username": {"$gte": "user0"}}).sort("username")
+            await paginated(data, pagination=pagination)
+
+        try:
+            # warm up connections and caches
+            await measure(serial, 10)
+            print(f"count + page fetch over {self.args.documents} documents, "
+                  f"{self.args.iterations} iterations")
+            report("serial count, then page", await measure(serial, self.args.iterations))
+            report("concurrent count and page", await measure(concurrent, self.args.iterations))
+            report("paginated()", await measure(list_endpoint, self.args.iterations))
+        finally:
+            await collection.drop()
+
+    async def bench_json(self):
+        import json
+        from bson import ObjectId
+        from fastapi.encoders import jsonable_encoder
+        from uengine.json import dumps
+        from uengine.utils import now
+        from sandboxapp.models import User
+
+        users = [
+            User(
+                _id=ObjectId(),
+                ext_id=idx,
+                username=f"user{idx:06d}",
+                first_name="First",
+                last_name="Last",
+                email=f"user{idx}@example.com",
+                created_at=now(),
+                updated_at=now(),
+            )
+            for idx in range(min(self.args.documents, 1000))
+        ]
+        page = {
+            "page": 1,
+            "total_pages": 1,
+            "count": len(users),
+            "data": [await u.to_dict() for u in users],
+        }
+        raw_page = dict(page, data=[await u.to_dict(jsonable_dict=False) for u in users])
+
+        async def fastapi_default():
+            # what FastAPI does with a dict returned from a handler
+            json.dumps(jsonable_encoder(page), ensure_ascii=False, allow_nan=False,
+                       separators=(",", ":")).encode("utf-8")
+
+        async def uengine_dumps():
+            dumps(page)
+
+        async def uengine_dumps_raw():
+            dumps(raw_page)
+
+        print(f"serializing a page of {len(users)} users, {self.args.iterations} iterations")
+        report("jsonable_encoder + json.dumps", await measure(fastapi_default, self.args.iterations))
+        report("uengine.json.dumps", await measure(uengine_dumps, self.args.iterations))
+        report("uengine.json.dumps, raw dicts", await measure(uengine_dumps_raw, self.args.iterations))
@@ -27,6 +27,10 @@ class Index(Command):
                     continue
                 obj = getattr(module, attr)
                 if hasattr(obj, "ensure_indexes"):
+                    # migrations clear the way for the current indexes
+                    if hasattr(obj, "migrate") and obj.__module__ == module.__name__:
+                        ctx.log.info("Migrating %s, collection %s", attr, obj.__collection__)
+                        await obj.migrate()
                     ctx.log.info(
                         "Creating indexes for %s, collection %s", attr, obj.__collection__)
                     await obj.ensure_indexes(True, self.args.overwrite)
@@ -0,0 +1,86 @@
+from commands import Command
+from sandboxapp import app
+from uengine import ctx
+from uengine.utils import get_modules
+from uengine.index_advisor import advise, load_shapes, load_slow_log, group_by_collection, format_keys
+import importlib
+import os.path
+
+
+class IndexAdvisor(Command):
+
+    NAME = "index_advisor"
+    DESCRIPTION = "Compare recorded query shapes with the declared and the existing indexes"
+
+    def init_argument_parser(self, parser):
+        parser.add_argument("-s", "--shapes", dest="shapes", action="append", default=[],
+                            help="Query shapes file recorded with the query_shapes_file option")
+        parser.add_argument("-l", "--slow-log", dest="slow_logs", action="append", default=[],
+                            help="Log file with the slow query log records")
+        parser.add_argument("--no-db", dest="no_db", action="store_true", default=False,
+                            help="Compare with the declared indexes only, don't list the database ones")
+
+    @staticmethod
+    def models():
+        models_directory = os.path.join(app.base_dir, "sandboxapp/models")
+        modules = [x for x in get_modules(models_directory) if x not in
+                   ("storable_model", "abstract_model", "sharded_model")]
+        models = {}
+        for mname in modules:
+            module = importlib.import_module("sandboxapp.models.%s" % mname)
+            for attr in dir(module):
+                if attr.startswith("__") or attr in ("StorableModel", "AbstractModel", "ShardedModel"):
+                    continue
+                obj = getattr(module, attr)
+                # models imported from uengine are not the app ones
+                if getattr(obj, "__module__", None) != module.__name__:
+                    continue
+                if hasattr(obj, "ensure_indexes") and getattr(obj, "__collection__", None):
+                    models[obj.__collection__] = obj
+        return models
+
+    @staticmethod
+    async def existing_indexes(model):
+        indexes = []
+        for db in model._get_possible_databases():  # pylint: disable=protected-access
+            indexes.extend([index async for index in db.conn[model.__collection__].list_indexes()])
+        return indexes
+
+    async def run_async(self):
+        records = []
+        for filename in self.args.shapes:
+            records.extend(load_shapes(filename))
+        for filename in self.args.slow_logs:
+            records.extend(load_slow_log(filename))
+        if not records:
+            ctx.log.warning("no query shapes given, only the index definitions are checked")
+        by_collection = group_by_collection(records)
+
+        models = self.models()
+        for collection in sorted(set(by_collection) - set(models)):
+            print(f"{collection}: queried but no model found, skipped\n")
+
+        for collection, model in sorted(models.items()):
+            existing = None if self.args.no_db else await self.existing_indexes(model)
+            collection_records = by_collection.get(collection, [])
+            advice = advise(collection_records, model.index_specs(), existing)
+            self.report(collection, model, advice, bool(collection_records))
+
+    @staticmethod
+    def report(collection, model, advice, queried):
+        print(f"{collection} ({model.__name__}):")
+        if not queried:
+            print("  no queries recorded")
+        elif not any(advice.values()):
+            print("  ok")
+        for keys, query, sort, count in advice["missing"]:
+            print(f"  missing index [{format_keys(keys)}] for {count} queries like filter={query} sort={sort}")
+        for index in advice["unused"]:
+            print(f"  unused index [{format_keys(index.keys)}] ({index.source})")
+        for index, covering in advice["redundant"]:
+            print(f"  index [{format_keys(index.keys)}] is a prefix of [{format_keys(covering.keys)}]")
+        for index in advice["not_created"]:
+            print(f"  index [{format_keys(index.keys)}] is declared but doesn't exist, run micro.py index")
+        for index in advice["undeclared"]:
+            print(f"  index [{format_keys(index.keys)}] exists but isn't declared in __indexes__")
+        print()
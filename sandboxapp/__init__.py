@@ -18,7 +18,9 @@ class App(Base):
         self.server.include_router(work_groups, prefix="/api/v2/work_groups", tags=["workgroups"])
 
     def get_session_class(self):
-        from sandboxapp.models import Session
+        from sandboxapp.models import Session, CookieSession
+        if ctx.cfg.get("session_backend") == "cookie":
+            return CookieSession
         return Session
 
 
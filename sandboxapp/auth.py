@@ -1,22 +1,26 @@
-from fastapi import Depends
 from starlette.requests import Request
 
 from uengine.errors import AuthenticationError
 from uengine.sessions import acquire_session
+from uengine.tracing import traced
 
 from sandboxapp.models.token import Token, TokenType
-from sandboxapp.models import Session
 
 
 def set_current_user(required: bool = True):
-    async def auth_wrapper(request: Request, session: Session = Depends(acquire_session)):
+    @traced("dependency.set_current_user")
+    async def auth_wrapper(request: Request):
         user = None
         if "X-Api-Auth-Token" in request.headers:
             token = await Token.get(request.headers["X-Api-Auth-Token"])
             if token and token.type == TokenType.auth and not token.expired:
                 user = await token.user()
-        elif session:
-            if session.user_id:
+                if user:
+                    await token.prolong()
+        else:
+            # the session is only looked up for non-token requests
+            session = await acquire_session(request)
+            if session and session.user_id:
                 user = await session.user()
 
         if required and not user:
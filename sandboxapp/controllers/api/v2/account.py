@@ -59,7 +59,7 @@ async def authenticate(
     if not user:
         raise AuthenticationError("invalid credentials")
 
-    if not user.check_password(form.password):
+    if not await user.check_password_async(form.password):
         raise AuthenticationError("invalid credentials")
 
     session.user_id = user._id
@@ -110,17 +110,15 @@ async def oauth_callback(code: str, session=Depends(acquire_session)):
                 headers={"Authorization": f"Bearer {token}"}
             )
             user_data = await resp.json()
-            user = await User.find_one({"ext_id": user_data["id"]})
-            print(user_data)
-            if user is None:
-                user = User(
-                    first_name=user_data["first_name"],
-                    last_name=user_data["last_name"],
-                    username=user_data["username"],
-                    ext_id=user_data["id"],
-                    email=user_data["email"]
-                )
-                await user.save()
+            user, _ = await User.get_or_create(
+                {"ext_id": user_data["id"]},
+                {
+                    "first_name": user_data["first_name"],
+                    "last_name": user_data["last_name"],
+                    "username": user_data["username"],
+                    "email": user_data["email"],
+                }
+            )
             session.user_id = user._id
             session.modified = True
         return RedirectResponse(redirect_url, status_code=302)
@@ -1,6 +1,6 @@
 from fastapi import APIRouter, Depends
 
-from uengine.api import paginated, pagination_params, fields_param, PaginationParams
+from uengine.api import paginated, pagination_params, fields_param, PaginationParams, to_response
 from uengine.errors import Forbidden, IntegrityError
 
 from sandboxapp.models import User
@@ -16,7 +16,7 @@ async def index(
         fields: list = Depends(fields_param)):
     data = User.find({}).sort("username")
     data = await paginated(data, pagination=pagination, fields=fields)
-    return data
+    return to_response(data)
 
 
 @users.get("/{user_id}")
@@ -41,13 +41,10 @@ async def create(data: UserView,
     if not current.supervisor:
         raise Forbidden("you don't have permission to create new users")
 
-    existing = await User.get(data.username)
-    if existing is not None:
+    user, created = await User.get_or_create({"username": data.username}, data.dict())
+    if not created:
         raise IntegrityError("user exists")
 
-    user = User(**data.dict())
-    await user.save()
-
     data = await user.to_dict(fields=fields)
     if fields and "modification_allowed" in fields:
         data["modification_allowed"] = user.modification_allowed(current)
@@ -104,7 +101,7 @@ async def set_password(user_id: str,
     user = await User.get(user_id, "user not found")
     if not user.modification_allowed(current):
         raise Forbidden("you don't have permission to modify this user")
-    user.set_password(data.password_raw)
+    await user.set_password_async(data.password_raw)
     await user.save()
 
     data = await user.to_dict(fields=fields)
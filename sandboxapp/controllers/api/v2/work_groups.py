@@ -4,7 +4,7 @@ from fastapi import APIRouter, Depends
 
 from uengine.errors import Forbidden, InputDataError
 from uengine.api import (paginated, pagination_params, fields_param,
-                         PaginationParams)
+                         PaginationParams, to_response)
 
 from sandboxapp.api import filter_params, FilterParams
 from sandboxapp.auth import set_current_user
@@ -37,7 +37,7 @@ async def index(
 
     data = WorkGroup.find(query).sort("name", 1)
     data = await paginated(data, pagination=pagination, fields=fields)
-    return data
+    return to_response(data)
 
 
 @work_groups.get("/{work_group_id}")
@@ -1,4 +1,4 @@
 from .user import User
 from .token import Token
-from .session import Session
+from .session import Session, CookieSession
 from .work_group import WorkGroup
\ No newline at end of file
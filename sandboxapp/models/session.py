@@ -1,4 +1,4 @@
-from uengine.sessions import BaseSession
+from uengine.sessions import BaseSession, BaseCookieSession
 from bson.objectid import ObjectId
 
 
@@ -12,3 +12,11 @@ class Session(BaseSession):
     async def user(self):
         from .user import User
         return await User.find_one({"_id": self.user_id})
+
+
+class CookieSession(BaseCookieSession):
+    user_id: ObjectId = None
+
+    async def user(self):
+        from .user import User
+        return await User.find_one({"_id": self.user_id})
@@ -1,8 +1,10 @@
 from bson.objectid import ObjectId
 from enum import IntEnum
-from datetime import datetime
+from datetime import datetime, timedelta
+from pymongo.errors import DuplicateKeyError
 
 from uengine.models import StorableModel
+from uengine.models.storable_model import touch_interval
 from uengine.utils import uuid4_string, now
 from uengine import ctx
 
@@ -10,46 +12,156 @@ from sandboxapp.errors import InvalidUserId
 
 DEFAULT_TOKEN_EXPIRATION_TIME = 87600 * 7 * 2
 DEFAULT_TOKEN_AUTO_PROLONGATION = True
+# indexes of the former token lookups, superseded by user_id_1_type_1_current
+LEGACY_INDEXES = ("user_id_1_type_1", "user_id_1_type_1_updated_at_-1")
 
 
 class TokenType(IntEnum):
     auth = 1
 
 
+def _auto_prolongation():
+    return ctx.cfg.get("token_auto_prolongation", DEFAULT_TOKEN_AUTO_PROLONGATION)
+
+
+def _lifetime():
+    """
+    token lifetime in seconds counting from lifetime_field(), None if tokens never expire
+    """
+    expiration_time = ctx.cfg.get("token_expiration_time", DEFAULT_TOKEN_EXPIRATION_TIME)
+    if expiration_time <= 0:
+        return None
+    if _auto_prolongation():
+        # stored updated_at lags behind by up to touch_interval() seconds
+        expiration_time += touch_interval()
+    return expiration_time
+
+
+def _updated_at_ttl():
+    return _lifetime() if _auto_prolongation() else None
+
+
+def _created_at_ttl():
+    return None if _auto_prolongation() else _lifetime()
+
+
 class Token(StorableModel):
     token: str = uuid4_string
     user_id: ObjectId = ...
     type: TokenType = TokenType.auth
     created_at: datetime = now
     updated_at: datetime = now
+    # set on the token get_or_create_for() hands out, at most one per user and type
+    current: bool = None
 
     __key_field__ = "token"
     __rejected_fields__ = {"token", "user_id", "type"}
     __indexes__ = [
         ["token", {"unique": True}],
-        ["user_id", "type"]
+        # named explicitly not to clash with the former plain user_id_1_type_1 index
+        ["user_id", "type", {"unique": True, "partialFilterExpression": {"current": True},
+                             "name": "user_id_1_type_1_current"}],
+        # mongo removes expired tokens by itself, the index
+        # matching the current prolongation mode is TTL one
+        ["updated_at", {"expireAfterSeconds": _updated_at_ttl}],
+        ["created_at", {"expireAfterSeconds": _created_at_ttl}],
     ]
 
     def touch(self):
         self.updated_at = now()
 
+    @staticmethod
+    def auto_prolongation():
+        return _auto_prolongation()
+
+    @staticmethod
+    def lifetime_field():
+        return "updated_at" if _auto_prolongation() else "created_at"
+
+    async def prolong(self):
+        """
+        keeps an auto-prolonged token alive, the write is throttled by db_touch()
+        """
+        if self.auto_prolongation():
+            await self.db_touch()
+
     async def user(self):
         from .user import User
         if self.user_id is None:
             return None
         return await User.find_one({"_id": self.user_id})
 
+    @classmethod
+    def unexpired_query(cls, query):
+        lifetime = _lifetime()
+        if lifetime is None:
+            return query
+        return dict(query, **{cls.lifetime_field(): {"$gte": now() - timedelta(seconds=lifetime)}})
+
+    @classmethod
+    async def get_or_create_for(cls, user_id, token_type=TokenType.auth):
+        """
+        returns the current unexpired token of the user creating one if there is none.
+        The unique index on the current token makes concurrent calls agree on
+        the same token: the upsert losing the race fails with DuplicateKeyError
+        and is retried, finding the winner's token
+        """
+        key = {"user_id": user_id, "type": token_type, "current": True}
+        token = await cls.find_one(cls.unexpired_query(key))
+        if token:
+            return token
+
+        lifetime = _lifetime()
+        if lifetime is not None:
+            # an expired token not removed by the TTL monitor yet gives way to a new one
+            expired = {cls.lifetime_field(): {"$lt": now() - timedelta(seconds=lifetime)}}
+            await cls.update_many(dict(key, **expired), {"$unset": {"current": ""}})
+
+        ts = now()
+        update = {"$setOnInsert": {"token": uuid4_string(), "created_at": ts, "updated_at": ts}}
+        try:
+            data = await ctx.db.meta.find_and_upsert(cls.__collection__, key, update)
+        except DuplicateKeyError:
+            data = await ctx.db.meta.find_and_upsert(cls.__collection__, key, update)
+        return cls.from_data(**data)
+
+    @classmethod
+    async def migrate(cls):
+        """
+        prepares tokens issued before the current flag for the unique index:
+        drops the legacy indexes and marks the newest unexpired token of each
+        user and type as current, so get_or_create_for() keeps handing it out
+        """
+        collection = ctx.db.meta.conn[cls.__collection__]
+        existing = [index["name"] async for index in collection.list_indexes()]
+        for name in LEGACY_INDEXES:
+            if name in existing:
+                ctx.log.info("Dropping legacy index %s of %s", name, cls.__collection__)
+                await collection.drop_index(name)
+
+        pipeline = [
+            {"$match": cls.unexpired_query({})},
+            {"$sort": {cls.lifetime_field(): -1}},
+            {"$group": {
+                "_id": {"user_id": "$user_id", "type": "$type"},
+                "newest": {"$first": "$_id"},
+                "has_current": {"$max": {"$eq": ["$current", True]}},
+            }},
+            {"$match": {"has_current": False}},
+        ]
+        groups = await ctx.db.meta.aggregate(cls.__collection__, pipeline)
+        if groups:
+            await cls.update_many({"_id": {"$in": [group["newest"] for group in groups]}},
+                                  {"$set": {"current": True}})
+            ctx.log.info("%d tokens marked as current", len(groups))
+
     @property
     def expired(self):
-        expiration_time = ctx.cfg.get("token_expiration_time", DEFAULT_TOKEN_EXPIRATION_TIME)
-        if expiration_time <= 0:
+        lifetime = _lifetime()
+        if lifetime is None:
             return False
-
-        auto_prolongation = ctx.cfg.get("token_auto_prolongation", DEFAULT_TOKEN_AUTO_PROLONGATION)
-        token_lifetime_start = self.updated_at if auto_prolongation else self.created_at
-        token_lifetime = now() - token_lifetime_start
-
-        return token_lifetime.total_seconds() > expiration_time
+        token_lifetime = now() - getattr(self, self.lifetime_field())
+        return token_lifetime.total_seconds() > lifetime
 
     async def _before_save(self):
         if not self.user:
@@ -3,6 +3,7 @@ from datetime import datetime
 from typing import Union
 
 from uengine.models.storable_model import StorableModel
+from uengine.executor import get_executor
 from uengine.utils import now
 from uengine import ctx
 
@@ -15,6 +16,14 @@ def _cfgget_docs_per_page():
     return ctx.cfg.get("docs_per_page", 20)
 
 
+def hash_password(password_raw):
+    return bcrypt.hashpw(password_raw.encode(), bcrypt.gensalt()).decode('utf-8')
+
+
+def check_password_hash(password_raw, password_hash):
+    return bcrypt.checkpw(password_raw.encode('utf-8'), password_hash.encode('utf-8'))
+
+
 class User(StorableModel):
 
     __collection__ = "users"
@@ -50,7 +59,9 @@ class User(StorableModel):
 
     __indexes__ = (
         ["username", {"unique": True}],
-        "ext_id",
+        # unique to keep oauth get_or_create() race free, local users have no ext_id
+        ["ext_id", {"unique": True, "partialFilterExpression": {"ext_id": {"$type": "number"}},
+                    "name": "ext_id_1_unique"}],
         "updated_at",
         "supervisor",
         "system",
@@ -63,6 +74,17 @@ class User(StorableModel):
         "email",
     }
 
+    @classmethod
+    async def migrate(cls):
+        """
+        drops the former plain ext_id index superseded by ext_id_1_unique
+        """
+        collection = ctx.db.meta.conn[cls.__collection__]
+        existing = [index["name"] async for index in collection.list_indexes()]
+        if "ext_id_1" in existing:
+            ctx.log.info("Dropping legacy index ext_id_1 of %s", cls.__collection__)
+            await collection.drop_index("ext_id_1")
+
     def __init__(self, **kwargs):
         password_raw = None
         if "password_raw" in kwargs:
@@ -74,15 +96,8 @@ class User(StorableModel):
 
     async def get_auth_token(self):
         from .token import Token, TokenType
-        tokens = Token.find({"type": TokenType.auth, "user_id": self._id})
-        async for token in tokens:
-            if token.expired:
-                await token.destroy()
-            else:
-                return token
-        token = Token(type=TokenType.auth, user_id=self._id)
-        await token.save()
-        return token
+        # expired tokens are removed by the TTL index
+        return await Token.get_or_create_for(self._id, TokenType.auth)
 
     async def reset_auth_token(self):
         from .token import Token
@@ -91,12 +106,25 @@ class User(StorableModel):
     def set_password(self, password_raw):
         if not password_raw:
             raise InvalidPassword("password can't be empty")
-        self.password_hash = bcrypt.hashpw(password_raw.encode(), bcrypt.gensalt()).decode('utf-8')
+        self.password_hash = hash_password(password_raw)
 
     def check_password(self, password_raw):
         if self.password_hash == "-":
             return False
-        return bcrypt.checkpw(password_raw.encode('utf-8'), self.password_hash.encode('utf-8'))
+        return check_password_hash(password_raw, self.password_hash)
+
+    # bcrypt takes hundreds of milliseconds by design, request handlers
+    # should use the async variants running it in the bcrypt executor
+
+    async def set_password_async(self, password_raw):
+        if not password_raw:
+            raise InvalidPassword("password can't be empty")
+        self.password_hash = await get_executor("bcrypt").run(hash_password, password_raw)
+
+    async def check_password_async(self, password_raw):
+        if self.password_hash == "-":
+            return False
+        return await get_executor("bcrypt").run(check_password_hash, password_raw, self.password_hash)
 
     async def get_all_auth_tokens(self):
         from .token import Token
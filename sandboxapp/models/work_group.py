@@ -1,6 +1,7 @@
 from bson import ObjectId
 from datetime import datetime
 
+from uengine.models import Relation
 from uengine.models.storable_model import StorableModel
 from uengine.utils import now
 
@@ -41,25 +42,26 @@ class WorkGroup(StorableModel):
         "name",
     }
 
+    # resolved for a whole page of work groups with one query each,
+    # the owner and members properties are for single objects
+    __relations__ = {
+        "owner_doc": Relation("owner_id", "sandboxapp.models.user.User"),
+        "member_docs": Relation("member_ids", "sandboxapp.models.user.User", many=True),
+        "owner_username": Relation("owner_id", "sandboxapp.models.user.User", attribute="username"),
+        "member_usernames": Relation("member_ids", "sandboxapp.models.user.User", many=True,
+                                     attribute="username"),
+    }
+
     @property
     async def owner(self):
         from .user import User
         return await User.get(self.owner_id)
 
-    @property
-    async def owner_username(self):
-        owner = await self.owner
-        return owner.username
-
     @property
     def members(self):
         from .user import User
         return User.find({"_id": {"$in": self.member_ids}})
 
-    @property
-    async def member_usernames(self):
-        return [u.username async for u in self.members]
-
     @property
     def participants(self):
         from .user import User
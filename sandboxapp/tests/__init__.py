@@ -0,0 +1 @@
+from .models.test_work_groups import TestWorkGroups
@@ -0,0 +1,43 @@
+import asyncio
+
+from uengine.api import paginated, PaginationParams
+from uengine.tests.temp_db_test import TemporaryDatabaseTest
+
+from sandboxapp.models import User, WorkGroup
+
+
+class TestWorkGroups(TemporaryDatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        async def create():
+            await WorkGroup.destroy_all()
+            await User.destroy_all()
+            users = []
+            for idx in range(4):
+                user = User(username=f"user{idx}")
+                await user.save()
+                users.append(user)
+            for idx in range(3):
+                group = WorkGroup(name=f"group{idx}", owner_id=users[idx]._id,
+                                  member_ids=[u._id for u in users[idx:idx + 2]])
+                await group.save()
+        self.loop.run_until_complete(create())
+
+    def test_page_relations(self):
+        fields = ["name", "owner_username", "member_usernames", "owner_doc.username"]
+        pagination = PaginationParams(limit=10, page=1, nopaging=False)
+        with self.assertMaxQueries(find=4):
+            result = self.loop.run_until_complete(
+                paginated(WorkGroup.find().sort("name"), pagination=pagination, fields=fields)
+            )
+        self.assertDictEqual(result["data"][1], {
+            "name": "group1",
+            "owner_username": "user1",
+            "member_usernames": ["user1", "user2"],
+            "owner_doc": {"username": "user1"},
+        })
@@ -1,17 +1,69 @@
 import re
 import asyncio
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as Base64Error
+from bson import json_util
 from collections import namedtuple
+from enum import Enum
+from pymongo import ASCENDING
+from starlette.responses import JSONResponse, StreamingResponse, Response as StarletteResponse
 from typing import Callable, Iterable
 from math import ceil
 
 from uengine import ctx
 from uengine.db import ObjectsCursor
+from uengine.errors import InputDataError
+from uengine.json import dumps
 from uengine.models.abstract_model import AbstractModel
+from uengine.models.serializer import serialize_models, parse_fields, ensure_serialization_limiter
+from uengine.utils import gather_or_cancel
 
 
 DEFAULT_DOCUMENTS_PER_PAGE = 20
+DEFAULT_ESTIMATED_COUNT_LIMIT = 10000
 
-PaginationParams = namedtuple("_PaginationParams", field_names=["limit", "page", "nopaging"])
+
+class CountMode(str, Enum):
+    exact = "exact"
+    estimated = "estimated"
+    none = "none"
+
+
+class StreamFormat(str, Enum):
+    ndjson = "ndjson"
+    json = "json"
+
+
+STREAM_MEDIA_TYPES = {
+    StreamFormat.ndjson: "application/x-ndjson",
+    StreamFormat.json: "application/json",
+}
+
+PaginationParams = namedtuple("_PaginationParams",
+                              field_names=["limit", "page", "nopaging", "cursor", "count", "stream"],
+                              defaults=[None, CountMode.exact, None])
+
+
+class Response(JSONResponse):
+    """
+    json response rendered with uengine.json.dumps. Returning it from
+    a handler skips FastAPI's jsonable_encoder pass over the content,
+    as the server's default_response_class it only renders what
+    jsonable_encoder has already converted
+    """
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def to_response(data) -> StarletteResponse:
+    """
+    wraps handler results (e.g. paginated() ones) into Response
+    passing through ready responses like the streamed ones
+    """
+    if isinstance(data, StarletteResponse):
+        return data
+    return Response(data)
 
 
 def filter_expr(flt):
@@ -26,47 +78,249 @@ def filter_expr(flt):
         return ""
 
 
-def pagination_params(_page: int = 1, _limit: int = 0, _nopaging: bool = False) -> PaginationParams:
+def pagination_params(_page: int = 1,
+                      _limit: int = 0,
+                      _nopaging: bool = False,
+                      _cursor: str = None,
+                      _count: CountMode = CountMode.exact,
+                      _stream: StreamFormat = None) -> PaginationParams:
+    """
+    _cursor switches pagination to the keyset mode: pass an empty
+    value to get the first page and the "next" value of the previous
+    response to get the following ones
+
+    _count controls the total documents count: "exact" counts all the
+    matching documents, "estimated" uses collection metadata for empty
+    queries and a count capped by estimated_count_limit otherwise,
+    "none" skips counting, clients should rely on "has_more" then
+
+    _stream along with _nopaging streams documents as they are read
+    from the database either as newline-delimited json objects or as
+    a plain json array, no count and no pagination info is sent then
+    """
     if not _limit:
         _limit = ctx.cfg.get("documents_per_page", DEFAULT_DOCUMENTS_PER_PAGE)
-    return PaginationParams(limit=_limit, page=_page, nopaging=_nopaging)
+    return PaginationParams(limit=_limit, page=_page, nopaging=_nopaging, cursor=_cursor,
+                            count=_count, stream=_stream)
 
 
 def fields_param(_fields: str = None):
+    """
+    comma-separated list of fields to return. Cursor fields can be
+    capped with a slice-like suffix, e.g. "name,members[:20]". Dotted
+    paths select subfields of related objects, e.g. "owner.username"
+    """
     if _fields:
-        return _fields.split(",")
+        fields = _fields.split(",")
+        try:
+            parse_fields(fields)
+        except ValueError as e:
+            raise InputDataError(str(e))
+        return fields
     return None
 
 
+def keyset_sort(sort_spec):
+    """
+    appends _id to the sort specification making the order total
+    """
+    sort_spec = list(sort_spec)
+    if "_id" not in [key for key, _ in sort_spec]:
+        sort_spec.append(("_id", ASCENDING))
+    return sort_spec
+
+
+def sort_key_value(item: AbstractModel, key: str):
+    tokens = key.split(".")
+    value = getattr(item, tokens[0], None)
+    for token in tokens[1:]:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(token)
+    return value
+
+
+def encode_keyset_cursor(values: list) -> str:
+    return urlsafe_b64encode(json_util.dumps(values).encode()).decode()
+
+
+def decode_keyset_cursor(cursor: str, length: int) -> list:
+    try:
+        values = json_util.loads(urlsafe_b64decode(cursor.encode()))
+    except (Base64Error, ValueError):
+        raise InputDataError("invalid pagination cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise InputDataError("pagination cursor doesn't match the sort order")
+    return values
+
+
+def keyset_query(sort_spec, values):
+    """
+    builds a query selecting documents which follow the one having
+    given sort key values in the sort_spec order. Mongo sorts null and
+    missing values before any other ones, comparisons never match them
+    so they are selected explicitly
+    """
+    clauses = []
+    for idx, (key, direction) in enumerate(sort_spec):
+        # {key: None} matches both null and missing values
+        clause = {prev_key: values[prev_idx] for prev_idx, (prev_key, _) in enumerate(sort_spec[:idx])}
+        value = values[idx]
+        if direction == ASCENDING:
+            clause[key] = {"$ne": None} if value is None else {"$gt": value}
+        elif value is None:
+            # nulls come last in descending order, nothing follows them
+            continue
+        else:
+            clause["$or"] = [{key: {"$lt": value}}, {key: None}]
+        clauses.append(clause)
+    return {"$or": clauses}
+
+
+async def count_documents(data: ObjectsCursor, mode: CountMode = CountMode.exact):
+    """
+    :return: (count, capped), capped is True if the estimated count
+             stopped at estimated_count_limit and the actual one is bigger
+    """
+    collection = data.cursor.collection
+    if mode == CountMode.none:
+        return None, False
+    if mode == CountMode.estimated:
+        if not data.query:
+            return await collection.estimated_document_count(), False
+        limit = ctx.cfg.get("estimated_count_limit", DEFAULT_ESTIMATED_COUNT_LIMIT)
+        # counting one more tells the capped count from the exact one
+        count = await collection.count_documents(data.query, limit=limit + 1)
+        if count > limit:
+            return limit, True
+        return count, False
+    return await collection.count_documents(data.query), False
+
+
 async def default_transform(item: AbstractModel, fields: Iterable = None) -> dict:
     return await item.to_dict(fields=fields)
 
 
+async def transform_items(items: list,
+                          fields: Iterable = None,
+                          transform: Callable[[AbstractModel, Iterable], dict] = default_transform) -> list:
+    """
+    applies transform to every item concurrently. With default_transform
+    items are serialized in one loop, tasks are created only for the
+    items which have something to await (async properties or cursors)
+    """
+    if transform is not default_transform:
+        # the transforms' tasks share the limiter set up here
+        ensure_serialization_limiter()
+        return await asyncio.gather(*[transform(item, fields) for item in items])
+    return await serialize_models(items, fields)
+
+
+def streamed(data: ObjectsCursor,
+             stream_format: StreamFormat = StreamFormat.ndjson,
+             fields: Iterable = None,
+             transform: Callable[[AbstractModel, Iterable], dict] = default_transform) -> StreamingResponse:
+    """
+    streams the cursor batch by batch. The body is generated after the
+    http middlewares have returned, so the queries of the stream are not
+    seen by the instrumentation (Server-Timing, stats, access log), the
+    session middleware and the tracing ones.
+
+    Once the response has started its status can't be changed, an error
+    in the middle of the stream is logged and re-raised to abort the
+    connection, so that the client doesn't take a truncated body for
+    a complete one
+    """
+
+    async def generate():
+        separator = b"\n" if stream_format == StreamFormat.ndjson else b","
+        first = True
+        if stream_format == StreamFormat.json:
+            yield b"["
+        try:
+            async for batch in data.batches():
+                items = await transform_items(batch, fields, transform)
+                chunk = separator.join(dumps(item) for item in items)
+                if stream_format == StreamFormat.ndjson:
+                    chunk += separator
+                elif not first:
+                    chunk = separator + chunk
+                first = False
+                yield chunk
+        except Exception as e:
+            ctx.log.error("error streaming the response: %s", e)
+            raise
+        if stream_format == StreamFormat.json:
+            yield b"]"
+
+    return StreamingResponse(generate(), media_type=STREAM_MEDIA_TYPES[stream_format])
+
+
 async def paginated(data: ObjectsCursor,
                     pagination: PaginationParams,
                     extra: dict = None,
                     fields: Iterable = None,
                     transform: Callable[[AbstractModel, Iterable], dict] = default_transform):
     page, limit, nopaging = pagination.page, pagination.limit, pagination.nopaging
+    if nopaging and pagination.stream:
+        return streamed(data, pagination.stream, fields=fields, transform=transform)
+
+    keyset = pagination.cursor is not None and not nopaging
     if nopaging:
         page = None
         limit = None
 
-    count = await data.cursor.collection.count_documents(data.query)
-    if limit is not None and page is not None:
-        data = data.skip((page - 1) * limit).limit(limit)
+    sort_spec = None
+    keyset_values = None
+    if keyset:
+        page = None
+        sort_spec = keyset_sort(data.sort_spec)
+        if pagination.cursor:
+            keyset_values = decode_keyset_cursor(pagination.cursor, len(sort_spec))
+
+    async def fetch_page():
+        if keyset:
+            cursor = data
+            if keyset_values is not None:
+                cursor = data.refine(keyset_query(sort_spec, keyset_values))
+            # fetching one extra document tells if there is a next page
+            items = await cursor.sort(sort_spec).limit(limit + 1).all()
+            if len(items) > limit:
+                items = items[:limit]
+                last_values = [sort_key_value(items[-1], key) for key, _ in sort_spec]
+                return items, True, encode_keyset_cursor(last_values)
+            return items, False, None
+
+        if limit is not None and page is not None:
+            items = await data.skip((page - 1) * limit).limit(limit + 1).all()
+            if len(items) > limit:
+                return items[:limit], True, None
+            return items, False, None
+
+        return await data.all(), False, None
+
+    # the count and the page are independent queries, running them
+    # concurrently saves a round trip
+    (count, count_capped), (items, has_more, next_cursor) = await gather_or_cancel(
+        count_documents(data, pagination.count),
+        fetch_page(),
+    )
 
-    total_pages = ceil(count / limit) if limit is not None else None
+    # a capped count is a lower bound, the number of pages is unknown then
+    total_pages = ceil(count / limit) if limit is not None and count is not None and not count_capped else None
 
-    data_tasks = [asyncio.create_task(transform(item, fields)) for item in await data.all()]
-    data = await asyncio.gather(*data_tasks)
+    data = await transform_items(items, fields, transform)
 
     result = {
         "page": page,
         "total_pages": total_pages,
         "count": count,
+        "count_capped": count_capped,
+        "has_more": has_more,
         "data": data,
     }
+    if keyset:
+        result["next"] = next_cursor
 
     if extra is not None:
         for k, v in extra.items():
@@ -1,24 +1,37 @@
 import os
 import sys
+import atexit
+import asyncio
 import inspect
 import logging
 import uvicorn
 
 from abc import abstractmethod
 from fastapi import FastAPI
+from starlette.responses import PlainTextResponse
 from logging.handlers import WatchedFileHandler
 
 from . import ctx
+from .api import Response
 from .db import DB
+from .instrumentation import create_instrumentation_middleware, add_db_observer
+from .metrics import registry as metrics_registry, db_metrics_observer, monitor_event_loop_lag, \
+    PROMETHEUS_CONTENT_TYPE, DEFAULT_LOOP_LAG_INTERVAL
+from .log import RequestIdFilter, create_queue_logging, request_id_middleware, DEFAULT_LOG_QUEUE_SIZE, DROP_NEW
 from .errors import ApiError, handle_api_error, handle_other_errors
+from .index_advisor import QueryShapeRecorder
+from .slow_queries import SlowQueryLog, DEFAULT_SLOW_QUERY_THRESHOLD
+from .nplusone import create_nplusone_middleware, DEFAULT_NPLUSONE_THRESHOLD
+from .tracing import create_tracing_middleware, create_exporter, set_exporter, db_tracing_observer
+from .sessions import create_session_middleware, DEFAULT_SESSION_CLEANUP_INTERVAL
 
 ENVIRONMENT_TYPES = ("development", "testing", "production")
 DEFAULT_ENVIRONMENT_TYPE = "development"
-DEFAULT_SESSION_EXPIRATION_TIME = 86400 * 7 * 2
 DEFAULT_TOKEN_TTL = 86400 * 7 * 2
 DEFAULT_LOG_FORMAT = "[%(asctime)s] %(levelname)s %(filename)s:%(lineno)d %(request_id)s %(message)s"
 DEFAULT_LOG_LEVEL = "debug"
 DEFAULT_FILECACHE_DIR = "/var/cache/uengine"
+DEFAULT_METRICS_PATH = "/metrics"
 
 
 class Base:
@@ -36,18 +49,27 @@ class Base:
             envtype = DEFAULT_ENVIRONMENT_TYPE
         ctx.envtype = envtype
 
-        self.session_expiration_time = None
         self.session_auto_cleanup = None
         self.session_auto_cleanup_trigger = None
+        self.log_listener = None
+        self.loop_lag_monitor = None
 
         # Later steps depend on the earlier ones. The order is important here
         ctx.cfg = self.__read_config()
+        self.__read_session_config()  # Requires ctx.cfg
         ctx.log = self.__setup_logging()  # Requires ctx.cfg
         ctx.db = DB()  # Requires ctx.cfg
         self.server = self.__setup_server()
         self.__setup_error_handling()
         ctx.cache = self.__setup_cache()  # requires ctx.cfg and ctx.log
         self.__setup_sessions()
+        self.__setup_instrumentation()
+        self.__setup_nplusone_detection()
+        self.__setup_slow_query_log()
+        self.__setup_query_shapes_recording()
+        self.__setup_metrics()
+        self.__setup_tracing()
+        self.__setup_request_id()
         self.configure_routes()
         self.after_configured()
 
@@ -64,14 +86,18 @@ class Base:
         with open(ver_filename) as verf:
             self.version = verf.read().strip()
 
+    def __read_session_config(self):
+        self.session_auto_cleanup = ctx.cfg.get("session_auto_cleanup", False)
+        # seconds between expired sessions cleanups
+        self.session_auto_cleanup_trigger = ctx.cfg.get("session_auto_cleanup_trigger",
+                                                        DEFAULT_SESSION_CLEANUP_INTERVAL)
+
     @staticmethod
     def __setup_cache():
         ctx.log.error("CACHE NOT IMPLEMENTED")
         return 0
 
-    @staticmethod
-    def __setup_logging():
-        # TODO consider using async logging
+    def __setup_logging(self):
         logger = logging.getLogger("app")
         logger.propagate = False
 
@@ -79,29 +105,43 @@ class Base:
         log_level = log_level.upper()
         log_level = getattr(logging, log_level)
 
+        handlers = []
         if "log_file" in ctx.cfg:
             handler = WatchedFileHandler(ctx.cfg.get("log_file"))
-            logger.addHandler(handler)
+            handlers.append(handler)
 
-        if ctx.cfg.get("debug") or not logger.handlers:
+        if ctx.cfg.get("debug") or not handlers:
             handler = logging.StreamHandler(stream=sys.stdout)
-            logger.addHandler(handler)
+            handlers.append(handler)
 
         log_format = ctx.cfg.get("log_format", DEFAULT_LOG_FORMAT)
         log_format = logging.Formatter(log_format)
 
         logger.setLevel(log_level)
-        for handler in logger.handlers:
+        for handler in handlers:
             handler.setLevel(log_level)
             handler.setFormatter(log_format)
 
+        # the actual handlers write from a separate thread so that slow disks
+        # don't block the event loop, log_queue_size = 0 makes logging synchronous
+        queue_size = ctx.cfg.get("log_queue_size", DEFAULT_LOG_QUEUE_SIZE)
+        if queue_size:
+            queue_handler, self.log_listener = create_queue_logging(
+                handlers, queue_size, ctx.cfg.get("log_drop_policy", DROP_NEW))
+            atexit.register(self.log_listener.stop)
+            handlers = [queue_handler]
+
+        for handler in handlers:
+            logger.addHandler(handler)
+        logger.addFilter(RequestIdFilter())
+
         logger.info("logger is created, starting up")
         return logger
 
     @staticmethod
     def __setup_server():
         ctx.log.info("setting up a fastapi server")
-        server = FastAPI()
+        server = FastAPI(default_response_class=Response)
         return server
 
     def __read_config(self):
@@ -130,11 +170,86 @@ class Base:
 
     @abstractmethod
     def get_session_class(self):
+        """
+        :return: a BaseSession subclass to keep sessions in mongo, a BaseCookieSession
+                 subclass for stateless cookie sessions or None to disable sessions.
+                 Apps can choose the class by the session_backend config value
+        """
         return None
 
-    def __setup_sessions(self):
-        from .sessions import create_session_middleware
+    def __setup_instrumentation(self):
+        self.server.middleware("http")(create_instrumentation_middleware())
+
+    def __setup_nplusone_detection(self):
+        # repeated query shapes are reported in development mode only
+        if not ctx.cfg.get("nplusone_detection", ctx.cfg.get("debug", False)):
+            return
+        self.server.middleware("http")(create_nplusone_middleware(
+            ctx.cfg.get("nplusone_threshold", DEFAULT_NPLUSONE_THRESHOLD),
+            ctx.cfg.get("nplusone_raise", False),
+        ))
 
+    def __setup_slow_query_log(self):
+        # seconds, 0 disables the slow query log
+        threshold = ctx.cfg.get("slow_query_threshold", DEFAULT_SLOW_QUERY_THRESHOLD)
+        if not threshold:
+            return
+        # explaining costs an extra query per slow query shape, debug environments only
+        explain = bool(ctx.cfg.get("debug") and ctx.cfg.get("slow_query_explain", False))
+        add_db_observer(SlowQueryLog(threshold, explain))
+
+    def __setup_query_shapes_recording(self):
+        # the shapes are appended to the file on shutdown, for the index_advisor command
+        shapes_file = ctx.cfg.get("query_shapes_file")
+        if not shapes_file:
+            return
+        recorder = QueryShapeRecorder()
+        add_db_observer(recorder)
+
+        @self.server.on_event("shutdown")
+        async def dump_query_shapes():
+            recorder.dump(shapes_file)
+
+    def __setup_metrics(self):
+        if not ctx.cfg.get("metrics_enabled", True):
+            return
+        add_db_observer(db_metrics_observer)
+
+        async def metrics():
+            return PlainTextResponse(metrics_registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+        self.server.add_api_route(ctx.cfg.get("metrics_path", DEFAULT_METRICS_PATH), metrics,
+                                  methods=["GET"], include_in_schema=False)
+
+        lag_interval = ctx.cfg.get("event_loop_lag_interval", DEFAULT_LOOP_LAG_INTERVAL)
+        if lag_interval:
+            @self.server.on_event("startup")
+            async def start_loop_lag_monitor():
+                self.loop_lag_monitor = asyncio.ensure_future(monitor_event_loop_lag(lag_interval))
+
+            @self.server.on_event("shutdown")
+            async def stop_loop_lag_monitor():
+                if self.loop_lag_monitor is not None:
+                    self.loop_lag_monitor.cancel()
+
+    def __setup_tracing(self):
+        # the fraction of requests to trace, 0 disables tracing
+        sample_rate = ctx.cfg.get("tracing_sample_rate", 0)
+        if not sample_rate:
+            return
+        exporter = create_exporter()
+        # flushes the spans still queued on exit
+        atexit.register(exporter.close)
+        set_exporter(exporter)
+        add_db_observer(db_tracing_observer)
+        self.server.middleware("http")(create_tracing_middleware(sample_rate))
+
+    def __setup_request_id(self):
+        # added last to be the outermost middleware, so that
+        # the other middlewares log with the request id too
+        self.server.middleware("http")(request_id_middleware)
+
+    def __setup_sessions(self):
         session_class = self.get_session_class()
 
         if session_class is None:
@@ -145,5 +260,6 @@ class Base:
         if not sid_key:
             ctx.log.info("no session_cookie_name configuration, sessions disabled")
 
-        session_middleware = create_session_middleware(session_class)
+        cleanup_interval = self.session_auto_cleanup_trigger if self.session_auto_cleanup else None
+        session_middleware = create_session_middleware(session_class, cleanup_interval)
         self.server.middleware("http")(session_middleware)
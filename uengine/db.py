@@ -3,15 +3,19 @@ import asyncio
 import functools
 import inspect
 
+from collections import deque
+from contextlib import nullcontext
 from bson.objectid import ObjectId, InvalidId
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo.errors import ServerSelectionTimeoutError
 from uengine.errors import InvalidShardId
 
 from . import ctx
+from .instrumentation import instrumented, track_db_op
+from .metrics import DB_RETRIES, DB_CONNECTION_RESETS, DB_GIVE_UPS
 from .models.abstract_model import AbstractModel
 
-CURSOR_BUFFER_LENGTH = 20
+CURSOR_BUFFER_LENGTH = 100
 
 
 def intercept_db_errors_rw(retry_sleep: int = 3, max_retries: int = 6):
@@ -41,11 +45,15 @@ def intercept_db_errors_rw(retry_sleep: int = 3, max_retries: int = 6):
                     )
                     db_obj = args[0]
                     db_obj.reset_conn()
+                    DB_CONNECTION_RESETS.inc("rw")
                 if retries_left == 0:
                     ctx.log.error(
                         "Mongo connection %d retries more passed with no result, giving up", max_retries / 2)
+                    DB_GIVE_UPS.inc("rw", func.__name__)
                     raise
 
+                DB_RETRIES.inc("rw", func.__name__)
+
                 await asyncio.sleep(retry_sleep)
 
                 kwargs["retries_left"] = retries_left
@@ -84,11 +92,15 @@ def intercept_db_errors_ro(retry_sleep: int = 3, max_retries: int = 6):
                     )
                     db_obj = args[0]
                     db_obj._ro_conn = db_obj.conn  # pylint: disable=protected-access
+                    DB_CONNECTION_RESETS.inc("ro")
                 if retries_left == 0:
                     ctx.log.error(
                         "Mongo connection %d retries more passed with no result, giving up", max_retries / 2)
+                    DB_GIVE_UPS.inc("ro", func.__name__)
                     raise
 
+                DB_RETRIES.inc("ro", func.__name__)
+
                 await asyncio.sleep(retry_sleep)
 
                 kwargs["retries_left"] = retries_left
@@ -100,46 +112,142 @@ def intercept_db_errors_ro(retry_sleep: int = 3, max_retries: int = 6):
     return decorator
 
 
+def normalize_sort(key_or_list, direction=None):
+    """
+    converts any form of sort specification accepted by pymongo
+    into a list of (key, direction) tuples
+    """
+    if isinstance(key_or_list, str):
+        return [(key_or_list, pymongo.ASCENDING if direction is None else direction)]
+    spec = []
+    for item in key_or_list:
+        if isinstance(item, str):
+            spec.append((item, pymongo.ASCENDING))
+        else:
+            key, item_direction = item
+            spec.append((key, item_direction))
+    return spec
+
+
 class ObjectsCursor:
 
-    def __init__(self, cursor, obj_constructor, query, shard_id=None):
+    def __init__(self, cursor, obj_constructor, query, shard_id=None, find_kwargs=None):
         self.obj_constructor = obj_constructor
         self.query = query
         self.cursor = cursor
         self.shard_id = shard_id
+        self.find_kwargs = find_kwargs or {}
+        self.sort_spec = normalize_sort(self.find_kwargs["sort"]) if self.find_kwargs.get("sort") else []
+        self.skip_count = self.find_kwargs.get("skip")
+        self.limit_count = self.find_kwargs.get("limit")
+        # documents fetched for async iteration, one batch at a time
+        self._buffer = deque()
+        self._batch_size = None
+        # documents taken from the motor cursor, the rest of the
+        # retrieved ones are in its buffer
+        self._consumed = 0
+
+    def options(self):
+        """
+        sort, skip and limit of the cursor as reported to db observers
+        """
+        if not self.sort_spec and not self.skip_count and not self.limit_count:
+            return None
+        return {"sort": self.sort_spec, "skip": self.skip_count, "limit": self.limit_count}
+
+    def _track(self, operation):
+        return track_db_op(operation, self.cursor.collection.name, self.shard_id, self.query, self.options())
+
+    def _track_fetch(self):
+        # the round trips after the first one continue the same query,
+        # they are reported as get_more not to look like repeated finds
+        cursor_id = self.cursor.cursor_id
+        if cursor_id is None:
+            return self._track("find")
+        # documents received but not consumed yet are served without a round trip,
+        # an exhausted cursor (id 0) makes none either
+        if cursor_id and self._consumed >= self.cursor.delegate.retrieved:
+            return self._track("get_more")
+        return nullcontext()
 
     @intercept_db_errors_ro()
     async def all(self):
         res = []
-        for doc in await self.cursor.to_list(length=CURSOR_BUFFER_LENGTH):
+        with self._track_fetch():
+            docs = await self.cursor.to_list(length=None)
+        self._consumed += len(docs)
+        for doc in docs:
             res.append(self.obj_constructor(**doc))
         return res
 
-    def limit(self, *args, **kwargs):
-        self.cursor.limit(*args, **kwargs)
+    @intercept_db_errors_ro()
+    async def _fetch_batch(self, batch_size):
+        with self._track_fetch():
+            docs = await self.cursor.to_list(length=batch_size)
+        self._consumed += len(docs)
+        return docs
+
+    async def batches(self, batch_size=CURSOR_BUFFER_LENGTH):
+        """
+        iterates over lists of at most batch_size objects
+        keeping only one batch in memory at a time
+        """
+        self.batch_size(batch_size)
+        while True:
+            docs = await self._fetch_batch(batch_size)
+            if not docs:
+                return
+            yield [self.obj_constructor(**doc) for doc in docs]
+
+    def batch_size(self, batch_size):
+        self.cursor.batch_size(batch_size)
+        self._batch_size = batch_size
+        return self
+
+    def limit(self, limit):
+        self.cursor.limit(limit)
+        self.limit_count = limit
         return self
 
-    def skip(self, *args, **kwargs):
-        self.cursor.skip(*args, **kwargs)
+    def skip(self, skip):
+        self.cursor.skip(skip)
+        self.skip_count = skip
         return self
 
-    def sort(self, *args, **kwargs):
-        self.cursor.sort(*args, **kwargs)
+    def sort(self, key_or_list, direction=None):
+        self.cursor.sort(key_or_list, direction)
+        self.sort_spec = normalize_sort(key_or_list, direction)
         return self
 
+    def refine(self, query):
+        """
+        creates a new cursor over the documents matching both the
+        original query and the given one, keeping the sort order
+        """
+        refined_query = {"$and": [self.query, query]} if self.query else query
+        cursor = self.cursor.collection.find(refined_query, **self.find_kwargs)
+        refined = ObjectsCursor(cursor, self.obj_constructor, refined_query,
+                                shard_id=self.shard_id, find_kwargs=self.find_kwargs)
+        if self.sort_spec:
+            refined.sort(self.sort_spec)
+        return refined
+
     async def count(self):
-        return await self.cursor.collection.count_documents(self.query)
+        with self._track("count"):
+            return await self.cursor.collection.count_documents(self.query)
 
     def __aiter__(self):
         return self
 
-    @intercept_db_errors_ro()
     async def __anext__(self):
-        has_data = await self.cursor.fetch_next
-        if has_data:
-            doc = self.cursor.next_object()
-            return self.obj_constructor(**doc)
-        raise StopAsyncIteration
+        if not self._buffer and self.cursor.alive:
+            if self._batch_size is None:
+                self.batch_size(CURSOR_BUFFER_LENGTH)
+            # one round trip per batch, the documents are served from the buffer
+            self._buffer.extend(await self._fetch_batch(self._batch_size))
+        if not self._buffer:
+            raise StopAsyncIteration
+        return self.obj_constructor(**self._buffer.popleft())
 
     def __getattr__(self, item):
         return getattr(self.cursor, item)
@@ -189,20 +297,23 @@ class DBShard:
             self.init_ro_conn()
         return self._ro_conn
 
+    @instrumented("find_one", lambda cls, collection, query, sort=None, **_: (
+        collection, query, {"sort": normalize_sort(sort)} if sort else None))
     @intercept_db_errors_ro()
-    async def get_obj(self, cls, collection, query):
+    async def get_obj(self, cls, collection, query, **kwargs):
         if not isinstance(query, dict):
             try:
                 query = {'_id': ObjectId(query)}
             except InvalidId:
                 pass
-        data = await self.ro_conn[collection].find_one(query)
+        data = await self.ro_conn[collection].find_one(query, **kwargs)
         if data:
             if self._shard_id:
                 data["shard_id"] = self._shard_id
             return cls(**data)
         return None
 
+    @instrumented("find_one", lambda cls, collection, query: (collection, query))
     @intercept_db_errors_ro()
     async def get_obj_id(self, cls, collection, query):
         if not isinstance(query, dict):
@@ -217,31 +328,51 @@ class DBShard:
 
     def get_objs(self, cls, collection, query, **kwargs):
         cursor = self.ro_conn[collection].find(query, **kwargs)
-        return ObjectsCursor(cursor, cls, query, shard_id=self._shard_id)
+        return ObjectsCursor(cursor, cls, query, shard_id=self._shard_id, find_kwargs=kwargs)
 
     def get_objs_projected(self, collection, query, projection, **kwargs):
         cursor = self.ro_conn[collection].find(
             query, projection=projection, **kwargs)
         return cursor
 
+    @instrumented("count", lambda collection, query, **_: (collection, query))
+    @intercept_db_errors_ro()
+    async def count_docs(self, collection, query, **kwargs):
+        return await self.ro_conn[collection].count_documents(query, **kwargs)
+
+    @instrumented("distinct", lambda collection, key, query=None: (collection, query))
+    @intercept_db_errors_ro()
+    async def distinct(self, collection, key, query=None):
+        return await self.ro_conn[collection].distinct(key, query)
+
+    @instrumented("aggregate", lambda collection, pipeline, **_: (collection, pipeline))
+    @intercept_db_errors_ro()
+    async def aggregate(self, collection, pipeline, **kwargs):
+        cursor = self.ro_conn[collection].aggregate(pipeline, **kwargs)
+        return await cursor.to_list(length=None)
+
     @intercept_db_errors_rw()
     async def save_obj(self, obj: AbstractModel):
         if obj.is_new:
             data = await obj.to_dict(include_restricted=True, jsonable_dict=False)
             del data["_id"]
-            result = await self.conn[obj.__collection__].insert_one(data)
+            with track_db_op("insert", obj.__collection__, self._shard_id):
+                result = await self.conn[obj.__collection__].insert_one(data)
             obj._id = result.inserted_id
         else:
-            await self.conn[obj.__collection__].replace_one(
-                {"_id": obj._id}, await obj.to_dict(include_restricted=True, jsonable_dict=False), upsert=True
-            )
+            data = await obj.to_dict(include_restricted=True, jsonable_dict=False)
+            query = {"_id": obj._id}
+            with track_db_op("update", obj.__collection__, self._shard_id, query):
+                await self.conn[obj.__collection__].replace_one(query, data, upsert=True)
 
+    @instrumented("delete", lambda obj: (obj.__collection__, {"_id": obj._id}))
     @intercept_db_errors_rw()
     async def delete_obj(self, obj):
         if obj.is_new:
             return
-        self.conn[obj.__collection__].delete_one({'_id': obj._id})
+        await self.conn[obj.__collection__].delete_one({'_id': obj._id})
 
+    @instrumented("update", lambda obj, update, when=None: (obj.__collection__, {"_id": obj._id}))
     @intercept_db_errors_rw()
     async def find_and_update_obj(self, obj, update, when=None):
         query = {"_id": obj._id}
@@ -258,10 +389,30 @@ class DBShard:
             new_data["shard_id"] = self._shard_id
         return new_data
 
+    @instrumented("update", lambda collection, query, update: (collection, query))
+    @intercept_db_errors_rw()
+    async def find_and_upsert(self, collection, query, update):
+        """
+        atomically updates the document matching the query or inserts
+        a new one built from the query equality fields and the update
+        :return: the resulting document
+        """
+        data = await self.conn[collection].find_one_and_update(
+            query,
+            update,
+            upsert=True,
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if self._shard_id:
+            data["shard_id"] = self._shard_id
+        return data
+
+    @instrumented("delete", lambda collection, query: (collection, query))
     @intercept_db_errors_rw()
     async def delete_query(self, collection, query):
         return await self.conn[collection].delete_many(query)
 
+    @instrumented("update", lambda collection, query, update: (collection, query))
     @intercept_db_errors_rw()
     async def update_query(self, collection, query, update):
         return await self.conn[collection].update_many(query, update)
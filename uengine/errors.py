@@ -145,6 +145,11 @@ class InputDataError(ApiError):
     pass
 
 
+class ServiceOverloaded(ApiError):
+    error_key = "service.overloaded"
+    status_code = 503
+
+
 async def handle_api_error(request: Request, exc: ApiError):
     content = exc.to_dict()
     content["request"] = {
@@ -0,0 +1,124 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+
+from . import ctx
+from .context import ContextError
+from .errors import ServiceOverloaded
+
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_QUEUE = 64
+
+_executors = {}
+
+
+class BoundedExecutor:
+    """
+    thread pool for blocking cpu-heavy calls like bcrypt hashing which
+    would otherwise freeze the event loop. At most max_queue calls may wait
+    for a free worker, the excess ones are rejected with ServiceOverloaded
+    right away instead of piling up and timing out later
+    """
+
+    def __init__(self, name: str, max_workers: int = DEFAULT_MAX_WORKERS, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=f"{name}_executor")
+        self._pending = 0
+
+        # metrics
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queue_depth = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        number of calls waiting for a free worker
+        """
+        return max(0, self._pending - self.max_workers)
+
+    @property
+    def in_progress(self) -> int:
+        return min(self._pending, self.max_workers)
+
+    async def run(self, func, *args):
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise ServiceOverloaded(f"{self.name} executor queue is full")
+
+        self._pending += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        submitted_at = monotonic()
+
+        def call():
+            started_at = monotonic()
+            try:
+                return func(*args), started_at, None
+            except Exception as e:  # pylint: disable=broad-except
+                return None, started_at, e
+
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(call)
+        # the worker keeps running when the awaiting task is cancelled,
+        # so the call is only done when the thread is
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._release))
+        result, started_at, error = await asyncio.wrap_future(future)
+
+        self.wait_time += started_at - submitted_at
+        self.run_time += monotonic() - started_at
+        if error is not None:
+            self.failed += 1
+            raise error
+        self.completed += 1
+        return result
+
+    def _release(self):
+        self._pending -= 1
+
+    def stats(self) -> dict:
+        calls = self.completed + self.failed
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_progress": self.in_progress,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_wait_time": self.wait_time / calls if calls else 0.0,
+            "avg_run_time": self.run_time / calls if calls else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    """
+    returns a named executor creating it on first use, the limits are
+    taken from the executors config section, e.g.
+    executors = {"bcrypt": {"max_workers": 4, "max_queue": 64}}
+    """
+    executor = _executors.get(name)
+    if executor is None:
+        try:
+            config = ctx.cfg.get("executors", {}).get(name, {})
+        except ContextError:
+            config = {}
+        executor = BoundedExecutor(
+            name,
+            max_workers=config.get("max_workers", DEFAULT_MAX_WORKERS),
+            max_queue=config.get("max_queue", DEFAULT_MAX_QUEUE),
+        )
+        _executors[name] = executor
+    return executor
+
+
+def executors_stats() -> dict:
+    return {name: executor.stats() for name, executor in _executors.items()}
@@ -0,0 +1,244 @@
+import json
+from collections import namedtuple
+from pymongo import HASHED
+
+from .instrumentation import normalize_query
+from .slow_queries import parse_slow_query_line
+
+# operations whose filter and sort can be served by an index
+RECORDED_OPERATIONS = ("find", "find_one", "count", "distinct", "update", "delete", "aggregate")
+# conditions with any other operator are treated as ranges
+EQUALITY_OPERATORS = ("$eq", "$in", "$all", "$elemMatch")
+# index options which make an index needed regardless of the queries
+CONSTRAINT_OPTIONS = ("unique", "expireAfterSeconds")
+
+# keys is a tuple of (field, order), source tells where the index is
+# found: "declared" in __indexes__, "db" or both
+IndexInfo = namedtuple("IndexInfo", ["keys", "options", "source"])
+
+
+def _normalize_order(order):
+    return int(order) if isinstance(order, (int, float)) else order
+
+
+def index_keys(keys) -> tuple:
+    return tuple((field, _normalize_order(order)) for field, order in keys)
+
+
+def format_keys(keys) -> str:
+    return ", ".join(f"{field}: {order}" for field, order in keys)
+
+
+class QueryShapeRecorder:
+    """
+    db observer counting the normalized filter and sort shapes
+    of the queries by collection
+    """
+
+    def __init__(self):
+        self.shapes = {}
+
+    def __call__(self, op):
+        if op.operation not in RECORDED_OPERATIONS or op.query is None:
+            return
+        query = op.query
+        sort = (op.options or {}).get("sort") or None
+        if op.operation == "aggregate":
+            # only a leading $match and $sort may use an index
+            pipeline = query
+            query = pipeline[0]["$match"] if pipeline and "$match" in pipeline[0] else {}
+            if len(pipeline) > 1 and "$sort" in pipeline[1]:
+                sort = list(pipeline[1]["$sort"].items())
+        key = (op.collection, json.dumps(normalize_query(query), sort_keys=True), json.dumps(sort))
+        self.shapes[key] = self.shapes.get(key, 0) + 1
+
+    def records(self) -> list:
+        return [
+            {"collection": collection, "filter": json.loads(query), "sort": json.loads(sort), "count": count}
+            for (collection, query, sort), count in self.shapes.items()
+        ]
+
+    def dump(self, filename: str):
+        """
+        appends the recorded shapes to a json lines file
+        """
+        with open(filename, "a") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+
+
+def load_shapes(filename: str) -> list:
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_slow_log(filename: str) -> list:
+    records = []
+    with open(filename) as f:
+        for line in f:
+            record = parse_slow_query_line(line)
+            if record is not None and record["operation"] in RECORDED_OPERATIONS:
+                records.append({"collection": record["collection"], "filter": record["filter"] or {},
+                                "sort": record["sort"], "count": 1})
+    return records
+
+
+def query_fields(query: dict) -> list:
+    """
+    splits the fields of a normalized filter into equality and range ones
+    :return: list of (equality_fields, range_fields), one per $or branch
+    """
+    equality, ranges, branches = [], [], [([], [])]
+    for key, value in query.items():
+        if key == "$and":
+            for sub_query in value:
+                sub_branches = query_fields(sub_query)
+                branches = [(eq + sub_eq, rng + sub_rng) for eq, rng in branches for sub_eq, sub_rng in sub_branches]
+        elif key == "$or":
+            or_branches = [branch for sub_query in value for branch in query_fields(sub_query)]
+            branches = [(eq + sub_eq, rng + sub_rng) for eq, rng in branches for sub_eq, sub_rng in or_branches]
+        elif key.startswith("$"):
+            continue
+        elif isinstance(value, dict) and value and all(op.startswith("$") for op in value):
+            if all(op in EQUALITY_OPERATORS for op in value):
+                equality.append(key)
+            else:
+                ranges.append(key)
+        else:
+            equality.append(key)
+    return [(equality + eq, [f for f in ranges + rng if f not in equality + eq]) for eq, rng in branches]
+
+
+def _sort_matches(keys, sort) -> bool:
+    if len(keys) < len(sort) or any(order == HASHED for _, order in keys):
+        return False
+    if [field for field, _ in keys[:len(sort)]] != [field for field, _ in sort]:
+        return False
+    # an index can be walked in either direction
+    same = all(order == direction for (_, order), (_, direction) in zip(keys, sort))
+    reversed_ = all(order == -direction for (_, order), (_, direction) in zip(keys, sort))
+    return same or reversed_
+
+
+def index_usage(keys, equality, ranges, sort) -> tuple:
+    """
+    :return: (used, sufficient), whether the index helps the query at all
+             and whether it serves both the filter and the sort
+    """
+    fields = [field for field, _ in keys]
+    prefix = 0
+    while prefix < len(fields) and fields[prefix] in equality:
+        prefix += 1
+    filter_used = prefix > 0 or (prefix < len(fields) and fields[prefix] in ranges)
+    sort_used = bool(sort) and _sort_matches(keys[prefix:], sort)
+    filter_ok = filter_used or not (equality or ranges)
+    sort_ok = not sort or sort_used
+    return filter_used or sort_used, filter_ok and sort_ok
+
+
+def suggest_index(equality, ranges, sort) -> tuple:
+    """
+    the equality, sort, range order of fields is what lets an index
+    serve both the filter and the sort
+    """
+    keys = [(field, 1) for field in equality]
+    used = set(equality)
+    for field, direction in sort:
+        if field not in used:
+            keys.append((field, direction))
+            used.add(field)
+    keys.extend((field, 1) for field in ranges if field not in used)
+    return index_keys(keys)
+
+
+def merge_indexes(declared, existing) -> list:
+    """
+    :param declared: list of (keys, options) as given by Model.index_specs()
+    :param existing: list of index documents as given by list_indexes()
+    """
+    indexes = {}
+    for keys, options in declared:
+        keys = index_keys(keys)
+        indexes[keys] = IndexInfo(keys, options, "declared")
+    for index in existing:
+        keys = index_keys(index["key"].items())
+        if index.get("name") == "_id_":
+            continue
+        if keys in indexes:
+            indexes[keys] = indexes[keys]._replace(source="both")
+        else:
+            options = {key: value for key, value in index.items() if key not in ("key", "name", "v", "ns")}
+            indexes[keys] = IndexInfo(keys, options, "db")
+    return list(indexes.values())
+
+
+def _is_constraint(index: IndexInfo) -> bool:
+    return any(index.options.get(option) for option in CONSTRAINT_OPTIONS) or \
+        "partialFilterExpression" in index.options
+
+
+def advise(records, declared, existing) -> dict:
+    """
+    compares the recorded query shapes of a collection with its indexes
+    :param records: query shape records of the collection
+    :param declared: the model's index_specs()
+    :param existing: index documents from the database, or None to compare
+                     with the declared indexes only
+    :return: {
+        "missing": [(suggested keys, filter, sort, count)],
+        "unused": [IndexInfo],
+        "redundant": [(IndexInfo, IndexInfo it is a prefix of)],
+        "not_created": [IndexInfo], declared but not in the database
+        "undeclared": [IndexInfo], in the database but not in __indexes__
+    }
+    """
+    indexes = merge_indexes(declared, existing or [])
+    usable = [index.keys for index in indexes]
+    if existing is not None:
+        usable = [index.keys for index in indexes if index.source != "declared"]
+    usable.append((("_id", 1),))
+
+    used = set()
+    missing = {}
+    for record in records:
+        sort = [tuple(item) for item in record["sort"] or []]
+        for equality, ranges in query_fields(record["filter"] or {}):
+            sufficient = False
+            for keys in usable:
+                is_used, is_sufficient = index_usage(keys, equality, ranges, sort)
+                if is_used:
+                    used.add(keys)
+                sufficient = sufficient or is_sufficient
+            if not sufficient:
+                suggestion = suggest_index(equality, ranges, sort)
+                entry = missing.get(suggestion)
+                if entry is None:
+                    missing[suggestion] = [suggestion, record["filter"], record["sort"], record["count"]]
+                else:
+                    entry[3] += record["count"]
+
+    redundant = []
+    for index in indexes:
+        if _is_constraint(index) or any(order == HASHED for _, order in index.keys):
+            continue
+        for other in indexes:
+            if len(other.keys) > len(index.keys) and other.keys[:len(index.keys)] == index.keys:
+                redundant.append((index, other))
+                break
+
+    return {
+        "missing": sorted((tuple(entry) for entry in missing.values()), key=lambda entry: -entry[3]),
+        "unused": [index for index in indexes
+                   if index.keys in usable and index.keys not in used and not _is_constraint(index)]
+        if records else [],
+        "redundant": redundant,
+        "not_created": [index for index in indexes if index.source == "declared"] if existing is not None else [],
+        "undeclared": [index for index in indexes if index.source == "db"],
+    }
+
+
+def group_by_collection(records) -> dict:
+    grouped = {}
+    for record in records:
+        grouped.setdefault(record["collection"], []).append(record)
+    return grouped
@@ -0,0 +1,160 @@
+import functools
+from collections import namedtuple
+from contextvars import ContextVar
+from time import monotonic
+from starlette.requests import Request
+
+from . import ctx
+from .metrics import HTTP_REQUEST_DURATION
+
+# an operation reported to db observers, duration is in seconds,
+# error is the exception the operation failed with or None,
+# options are the sort/skip/limit of the operation if any
+DBOperation = namedtuple("DBOperation", ["operation", "collection", "shard_id", "query", "duration", "error",
+                                         "options"], defaults=(None,))
+
+_db_observers = []
+_request_stats = ContextVar("request_stats", default=None)
+
+
+def add_db_observer(observer):
+    """
+    registers a callable getting a DBOperation after every db operation
+    """
+    if observer not in _db_observers:
+        _db_observers.append(observer)
+
+
+def remove_db_observer(observer):
+    if observer in _db_observers:
+        _db_observers.remove(observer)
+
+
+class RequestStats:
+    """
+    db operations made while serving a request, grouped by shard and collection
+    """
+
+    def __init__(self):
+        self.started_at = monotonic()
+        self.db_count = 0
+        self.db_time = 0.0
+        self.by_collection = {}
+
+    def add(self, op: DBOperation):
+        self.db_count += 1
+        self.db_time += op.duration
+        key = (op.shard_id, op.collection)
+        entry = self.by_collection.get(key)
+        if entry is None:
+            self.by_collection[key] = [1, op.duration]
+        else:
+            entry[0] += 1
+            entry[1] += op.duration
+
+    @property
+    def elapsed(self) -> float:
+        return monotonic() - self.started_at
+
+    def server_timing(self) -> str:
+        metrics = [f'db;desc="{self.db_count} ops";dur={self.db_time * 1000:.1f}']
+        for (shard_id, collection), (count, duration) in self.by_collection.items():
+            name = f"db.{shard_id}.{collection}" if shard_id else f"db.{collection}"
+            metrics.append(f'{name};desc="{count} ops";dur={duration * 1000:.1f}')
+        metrics.append(f"total;dur={self.elapsed * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def normalize_query(query):
+    """
+    replaces the values in a query with "?" keeping the fields and operators,
+    so that queries differing only in values get the same shape. Lists of
+    documents like $or conditions or aggregation pipelines are normalized
+    item by item, other lists (e.g. $in values) become a single "?"
+    """
+    if isinstance(query, dict):
+        return {key: normalize_query(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)) and query and all(isinstance(item, dict) for item in query):
+        return [normalize_query(item) for item in query]
+    return "?"
+
+
+def current_request_stats() -> RequestStats:
+    return _request_stats.get()
+
+
+class track_db_op:  # pylint: disable=invalid-name
+    """
+    context manager timing a db operation and reporting it to the current
+    request stats and the db observers
+    """
+
+    __slots__ = ("operation", "collection", "shard_id", "query", "options", "started_at")
+
+    def __init__(self, operation, collection, shard_id=None, query=None, options=None):
+        self.operation = operation
+        self.collection = collection
+        self.shard_id = shard_id
+        self.query = query
+        self.options = options
+        self.started_at = None
+
+    def __enter__(self):
+        self.started_at = monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        stats = _request_stats.get()
+        if stats is None and not _db_observers:
+            return
+        op = DBOperation(self.operation, self.collection, self.shard_id, self.query,
+                         monotonic() - self.started_at, exc_val, self.options)
+        if stats is not None:
+            stats.add(op)
+        for observer in _db_observers:
+            observer(op)
+
+
+def instrumented(operation, target):
+    """
+    reports calls of a DBShard coroutine method as db operations
+    :param target: takes the method arguments (except for self) and
+                   returns (collection, query) or (collection, query, options)
+                   of the operation
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            collection, query, *options = target(*args, **kwargs)
+            options = options[0] if options else None
+            with track_db_op(operation, collection, self._shard_id, query, options):  # pylint: disable=protected-access
+                return await func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def create_instrumentation_middleware():
+    server_timing = ctx.cfg.get("server_timing", True)
+    access_log = ctx.cfg.get("access_log", True)
+
+    async def instrumentation_middleware(request: Request, call_next):
+        stats = RequestStats()
+        token = _request_stats.set(stats)
+        try:
+            response = await call_next(request)
+        finally:
+            _request_stats.reset(token)
+
+        route = request.scope.get("route")
+        HTTP_REQUEST_DURATION.observe(request.method, route.path if route else "unmatched",
+                                      response.status_code, value=stats.elapsed)
+
+        if server_timing:
+            response.headers["Server-Timing"] = stats.server_timing()
+        if access_log:
+            ctx.log.info("%s %s %d %.1fms db_ops=%d db_time=%.1fms",
+                         request.method, request.url.path, response.status_code,
+                         stats.elapsed * 1000, stats.db_count, stats.db_time * 1000)
+        return response
+
+    return instrumentation_middleware
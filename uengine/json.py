@@ -1,14 +1,110 @@
+import json
 from bson import ObjectId, Timestamp
+from datetime import date, datetime, time
+from enum import Enum
 from types import GeneratorType
 
+from .metrics import record_cache_lookup
 
-def jsonable(obj):
-    if isinstance(obj, dict):
-        return {k: jsonable(v) for k, v in obj.items()}
-    if isinstance(obj, (list, tuple, set, frozenset, GeneratorType)):
-        return [jsonable(item) for item in obj]
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, Timestamp):
-        return obj.time
+
+def _timestamp(obj):
+    return obj.time
+
+
+def _isoformat(obj):
+    return obj.isoformat()
+
+
+def _enum_value(obj):
+    return obj.value
+
+
+def _same(obj):
     return obj
+
+
+def _jsonable_dict(obj):
+    return {k: jsonable(v) for k, v in obj.items()}
+
+
+def _jsonable_list(obj):
+    return [jsonable(item) for item in obj]
+
+
+# jsonable() converters, the lookup is done by the exact object type first
+# and then by the type's ancestors, the result is cached in the same dict
+# unless it has grown to MAX_TABLE_SIZE entries (e.g. with dynamically
+# created classes), then the ancestors are looked up every time
+MAX_TABLE_SIZE = 256
+
+JSONABLE_CONVERTERS = {
+    str: _same,
+    int: _same,
+    float: _same,
+    bool: _same,
+    type(None): _same,
+    dict: _jsonable_dict,
+    list: _jsonable_list,
+    tuple: _jsonable_list,
+    set: _jsonable_list,
+    frozenset: _jsonable_list,
+    GeneratorType: _jsonable_list,
+    ObjectId: str,
+    Timestamp: _timestamp,
+}
+
+# dumps() only needs encoders for types json can't handle by itself
+JSON_ENCODERS = {
+    ObjectId: str,
+    Timestamp: _timestamp,
+    datetime: _isoformat,
+    date: _isoformat,
+    time: _isoformat,
+    Enum: _enum_value,
+    set: list,
+    frozenset: list,
+    GeneratorType: list,
+}
+
+
+def _lookup(table, obj_type, default=None):
+    value = default
+    for cls in obj_type.__mro__[1:]:
+        if cls in table:
+            value = table[cls]
+            break
+    if value is not None and len(table) < MAX_TABLE_SIZE:
+        table[obj_type] = value
+    return value
+
+
+def jsonable(obj):
+    obj_type = type(obj)
+    converter = JSONABLE_CONVERTERS.get(obj_type)
+    if converter is None:
+        converter = _lookup(JSONABLE_CONVERTERS, obj_type, _same)
+    return converter(obj)
+
+
+def _default(obj):
+    obj_type = type(obj)
+    encoder = JSON_ENCODERS.get(obj_type)
+    # only the types json can't handle by itself get here, unlike
+    # jsonable() which is called for every value and is not counted
+    record_cache_lookup("json_encoders", encoder is not None)
+    if encoder is None:
+        encoder = _lookup(JSON_ENCODERS, obj_type)
+        if encoder is None:
+            raise TypeError(f"Object of type {obj_type.__name__} is not JSON serializable")
+    return encoder(obj)
+
+
+_encoder = json.JSONEncoder(default=_default, ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+
+def dumps(obj) -> bytes:
+    """
+    serializes obj to json bytes in one pass, ObjectIds, Timestamps,
+    datetimes, enums and sets are converted on the way
+    """
+    return _encoder.encode(obj).encode("utf-8")
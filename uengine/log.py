@@ -0,0 +1,107 @@
+import re
+import queue
+import logging
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from starlette.requests import Request
+from uuid import uuid4
+
+DEFAULT_LOG_QUEUE_SIZE = 10000
+DROP_NEW = "drop_new"
+DROP_OLD = "drop_old"
+DROP_POLICIES = (DROP_NEW, DROP_OLD)
+
+REQUEST_ID_HEADER = "X-Request-Id"
+# incoming request ids are only trusted if they look sane
+REQUEST_ID_EXPR = re.compile(r"^[\w\-.:]{1,64}$")
+
+request_id_var = ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    puts the current request id into log records, the filter runs
+    in the logging coroutine's context, not in the listener thread
+    """
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    QueueHandler which never blocks the event loop: when the queue is full
+    either the new record (drop_new) or the oldest queued one (drop_old)
+    is dropped. The number of dropped records is reported with a warning
+    as soon as the queue has room again
+    """
+
+    def __init__(self, log_queue: queue.Queue, drop_policy: str = DROP_NEW):
+        super().__init__(log_queue)
+        if drop_policy not in DROP_POLICIES:
+            raise ValueError(f"invalid log drop policy {drop_policy}, must be one of {DROP_POLICIES}")
+        self.drop_policy = drop_policy
+        self.dropped = 0
+        self._unreported = 0
+
+    def _drop(self):
+        self.dropped += 1
+        self._unreported += 1
+
+    def _put(self, record) -> bool:
+        """
+        :return: True if the record got into the queue with nothing dropped
+        """
+        try:
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            pass
+
+        if self.drop_policy == DROP_OLD:
+            try:
+                self.queue.get_nowait()
+                self._drop()
+                self.queue.put_nowait(record)
+                return False
+            except (queue.Empty, queue.Full):
+                pass
+        self._drop()
+        return False
+
+    def enqueue(self, record):
+        if self._put(record) and self._unreported:
+            count = self._unreported
+            self._unreported = 0
+            report = logging.LogRecord(
+                record.name, logging.WARNING, __file__, 0,
+                "%d log records dropped due to the full log queue", (count,), None
+            )
+            report.request_id = "-"
+            self._put(report)
+
+
+def create_queue_logging(handlers, queue_size: int = DEFAULT_LOG_QUEUE_SIZE, drop_policy: str = DROP_NEW):
+    """
+    moves actual handlers to a listener thread
+    :return: (queue_handler, listener), the listener is already started
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue, drop_policy)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return queue_handler, listener
+
+
+async def request_id_middleware(request: Request, call_next):
+    request_id = request.headers.get(REQUEST_ID_HEADER)
+    if not request_id or not REQUEST_ID_EXPR.match(request_id):
+        request_id = uuid4().hex
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers[REQUEST_ID_HEADER] = request_id
+    return response
@@ -0,0 +1,219 @@
+import asyncio
+from bisect import bisect_left
+from time import monotonic
+from typing import Iterable
+
+from .executor import executors_stats
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+DEFAULT_LOOP_LAG_INTERVAL = 1.0
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+    """
+    base metric class, values are kept per tuple of label values.
+    Metrics are updated from the event loop thread only so no locks are used
+    """
+
+    type_name = None
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), callback=None):
+        """
+        :param callback: if set, computes the values when rendered returning
+                         {label values tuple: value}, for the metrics which
+                         are already counted elsewhere
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        self._values = {}
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+    def samples(self) -> list:
+        if self.callback is not None:
+            self._values = dict(self.callback())
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in self._values.items()
+        ]
+
+    def render(self) -> str:
+        return "\n".join(self.header() + self.samples())
+
+    def clear(self):
+        self._values.clear()
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    type_name = "gauge"
+
+    def set(self, *labels, value):
+        self._values[labels] = value
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+
+class Histogram(Metric):
+    """
+    histogram with buckets fixed at creation time, an observation costs
+    a bisect and a couple of increments
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels, value: float):
+        entry = self._values.get(labels)
+        if entry is None:
+            # per bucket counts (the last one is +Inf), sum, count
+            entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def count(self, *labels) -> int:
+        entry = self._values.get(labels)
+        return entry[2] if entry else 0
+
+    def samples(self) -> list:
+        lines = []
+        bounds = self.buckets + (float("inf"),)
+        for labels, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), callback=None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, callback))
+
+    def gauge(self, name, documentation, labelnames=(), callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, callback))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name) -> Metric:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """
+        renders all the metrics in prometheus text exposition format
+        """
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+def _executors_queue_depth():
+    return {(name, key): stats[key]
+            for name, stats in executors_stats().items()
+            for key in ("queue_depth", "in_progress")}
+
+
+def _executors_calls():
+    return {(name, key): stats[key]
+            for name, stats in executors_stats().items()
+            for key in ("completed", "failed", "rejected")}
+
+
+registry = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"))
+DB_OPERATION_DURATION = registry.histogram(
+    "db_operation_duration_seconds", "Database operation latency", ("operation", "collection", "shard"))
+DB_OPERATION_ERRORS = registry.counter(
+    "db_operation_errors_total", "Failed database operations", ("operation", "collection", "shard"))
+DB_RETRIES = registry.counter(
+    "db_retries_total", "Database operations retried after a server selection timeout", ("mode", "function"))
+DB_CONNECTION_RESETS = registry.counter(
+    "db_connection_resets_total",
+    "Read/write connections reset and read-only operations switched to the read/write connection", ("mode",))
+DB_GIVE_UPS = registry.counter(
+    "db_give_ups_total", "Database operations failed after all the retries", ("mode", "function"))
+CACHE_REQUESTS = registry.counter(
+    "cache_requests_total", "Cache lookups by result, hit ratio is hit / (hit + miss)", ("cache", "result"))
+EVENT_LOOP_LAG = registry.histogram(
+    "event_loop_lag_seconds", "Delay of event loop callbacks against their schedule", buckets=LOOP_LAG_BUCKETS)
+EXECUTOR_TASKS = registry.gauge(
+    "executor_tasks", "Calls waiting for or running in executors", ("executor", "state"),
+    callback=_executors_queue_depth)
+EXECUTOR_CALLS = registry.counter(
+    "executor_calls_total", "Executor calls by outcome", ("executor", "outcome"),
+    callback=_executors_calls)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+def db_metrics_observer(op):
+    shard = op.shard_id or "meta"
+    DB_OPERATION_DURATION.observe(op.operation, op.collection, shard, value=op.duration)
+    if op.error is not None:
+        DB_OPERATION_ERRORS.inc(op.operation, op.collection, shard)
+
+
+async def monitor_event_loop_lag(interval: float = DEFAULT_LOOP_LAG_INTERVAL):
+    """
+    measures how late a sleeping coroutine wakes up, runs until cancelled
+    """
+    while True:
+        scheduled_at = monotonic() + interval
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.observe(value=max(0.0, monotonic() - scheduled_at))
@@ -1,3 +1,4 @@
 from .storable_model import StorableModel
 from .abstract_model import save_required
 from .data_types import ObjectIdType
+from .relation import Relation
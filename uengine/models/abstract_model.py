@@ -1,4 +1,5 @@
 import asyncio
+from collections import OrderedDict
 from itertools import chain
 from pymongo import ASCENDING, DESCENDING, HASHED
 from pymongo.errors import OperationFailure
@@ -8,10 +9,12 @@ from typing import Any, Iterable, Set, Type
 from functools import wraps
 
 from .model_hook import ModelHook
+from .serializer import ModelSerializer, normalize_fields, MAX_CACHED_SERIALIZERS
 from uengine import ctx
+from uengine.metrics import record_cache_lookup
+from uengine.tracing import span
 from uengine.utils import snake_case
 from uengine.errors import FieldRequired, InvalidFieldType
-from uengine.json import jsonable
 
 
 def parse_index_key(index_key):
@@ -78,6 +81,8 @@ class ModelMeta(type):
             merge_func(attr, new_cls, bases)
 
         setattr(new_cls, "__collection__", mcs._get_collection(new_cls, name, bases, dct))
+        # compiled serializers cache, must be per class
+        setattr(new_cls, "__serializers__", OrderedDict())
         return new_cls
 
     @staticmethod
@@ -129,6 +134,7 @@ class AbstractModel(metaclass=ModelMeta):
     __auto_trim_fields__: Set = set()
     __key_field__: str = None
     __indexes__: (list, tuple) = []
+    __relations__: dict = {}
     __hooks__: Set[Type[ModelHook]] = set()
 
     __auxiliary_slots__: tuple = (
@@ -142,6 +148,7 @@ class AbstractModel(metaclass=ModelMeta):
         "__auto_trim_fields__",
         "__key_field__",
         "__indexes__",
+        "__relations__",
         "__mergers__",
         "__hooks__",
     )
@@ -155,6 +162,7 @@ class AbstractModel(metaclass=ModelMeta):
         "__restricted_fields__": merge_set,
         "__auto_trim_fields__": merge_set,
         "__indexes__": merge_tuple,
+        "__relations__": merge_dict,
     }
 
     def __init__(self, **kwargs):
@@ -209,7 +217,7 @@ class AbstractModel(metaclass=ModelMeta):
     def __set_initial_state(self):
         setattr(self,
                 "_initial_state",
-                deepcopy(self._dict_sync(self.__fields__, include_restricted=True, jsonable_dict=False)))
+                deepcopy(self._dict_sync(include_restricted=True, jsonable_dict=False)))
 
     async def _before_save(self):
         pass
@@ -269,27 +277,34 @@ class AbstractModel(metaclass=ModelMeta):
     async def destroy(self, skip_callback: bool = False, invalidate_cache: bool = True):
         if self.is_new:
             return
-        if not skip_callback:
-            await self._before_delete()
-        await self._delete_from_db()
-        if not skip_callback:
-            await self._after_delete()
-        self._id = None
-        for hook in self.__hooks__:
-            try:
-                hook.on_model_destroy(self)
-            except Exception as e:
-                ctx.log.error("error executing destroy hook %s on model %s(%s): %s",
-                              hook.__class__.__name__, self.__class__.__name__, self._id, e)
-        if invalidate_cache:
-            self.invalidate()
+        with span("model.destroy", model=self.__class__.__name__):
+            if not skip_callback:
+                with span("model._before_delete"):
+                    await self._before_delete()
+            await self._delete_from_db()
+            if not skip_callback:
+                with span("model._after_delete"):
+                    await self._after_delete()
+            self._id = None
+            with span("model.destroy_hooks"):
+                for hook in self.__hooks__:
+                    try:
+                        hook.on_model_destroy(self)
+                    except Exception as e:
+                        ctx.log.error("error executing destroy hook %s on model %s(%s): %s",
+                                      hook.__class__.__name__, self.__class__.__name__, self._id, e)
+            if invalidate_cache:
+                self.invalidate()
         return self
 
-    async def save(self, skip_callback: bool = False, invalidate_cache: bool = True):
-        is_new = self.is_new
-
+    async def _prepare_save(self, skip_callback: bool = False):
+        """
+        the steps of save() before the object is written: callbacks,
+        validation and trimming
+        """
         if not skip_callback:
-            await self._before_validation()
+            with span("model._before_validation"):
+                await self._before_validation()
         self._validate()
 
         # autotrim
@@ -302,21 +317,35 @@ class AbstractModel(metaclass=ModelMeta):
                 pass
 
         if not skip_callback:
-            await self._before_save()
-        await self._save_to_db()
-
-        for hook in self.__hooks__:
-            try:
-                hook.on_model_save(self, is_new)
-            except Exception as e:
-                ctx.log.error("error executing save hook %s on model %s(%s): %s",
-                              hook.__class__.__name__, self.__class__.__name__, self._id, e)
+            with span("model._before_save"):
+                await self._before_save()
+
+    async def _complete_save(self, is_new: bool, skip_callback: bool = False, invalidate_cache: bool = True):
+        """
+        the steps of save() after the object is written: hooks and callbacks
+        """
+        with span("model.save_hooks"):
+            for hook in self.__hooks__:
+                try:
+                    hook.on_model_save(self, is_new)
+                except Exception as e:
+                    ctx.log.error("error executing save hook %s on model %s(%s): %s",
+                                  hook.__class__.__name__, self.__class__.__name__, self._id, e)
 
         self.__set_initial_state()
         if invalidate_cache:
             self.invalidate()
         if not skip_callback:
-            await self._after_save(is_new)
+            with span("model._after_save"):
+                await self._after_save(is_new)
+
+    async def save(self, skip_callback: bool = False, invalidate_cache: bool = True):
+        is_new = self.is_new
+
+        with span("model.save", model=self.__class__.__name__, is_new=is_new):
+            await self._prepare_save(skip_callback)
+            await self._save_to_db()
+            await self._complete_save(is_new, skip_callback, invalidate_cache)
 
         return self
 
@@ -364,70 +393,51 @@ class AbstractModel(metaclass=ModelMeta):
             result[field] = value
         return result
 
-    def _dict_sync(self, fields: Iterable[str] = None, include_restricted: bool = False, jsonable_dict: bool = True) -> dict:
-        if fields is None:
-            fields = list(self.__fields__)
-
-        result = {}
-        for field in fields:
-            if field in self.__restricted_fields__ and not include_restricted:
-                continue
-            try:
-                value = getattr(self, field)
-            except AttributeError:
-                continue
-            if callable(value):
-                continue
-            if asyncio.iscoroutine(value):
-                continue
-            if jsonable_dict:
-                value = jsonable(value)
-
-            result[field] = value
-
-        return result
-
-    async def to_dict(self, fields: Iterable[str] = None, include_restricted: bool = False, jsonable_dict: bool = True) -> dict:
-        from uengine.db import ObjectsCursor
+    @classmethod
+    def get_serializer(cls, fields: Iterable[str] = None, include_restricted: bool = False) -> ModelSerializer:
+        cache = cls.__serializers__
+        key = (tuple(fields) if fields is not None else None, include_restricted)
+        serializer = cache.get(key)
+        record_cache_lookup("serializers", serializer is not None)
+        if serializer is not None:
+            cache.move_to_end(key)
+            return serializer
 
         if fields is None:
-            fields = list(self.__fields__)
+            serializer = ModelSerializer(cls, cls.__fields__, include_restricted)
+        else:
+            # permutations of the same fields share the compiled serializer,
+            # the results still follow the requested order
+            normalized_key = (normalize_fields(fields), include_restricted)
+            compiled = cache.get(normalized_key)
+            if compiled is None:
+                compiled = ModelSerializer(cls, normalized_key[0], include_restricted)
+                cls._cache_serializer(normalized_key, compiled)
+            serializer = compiled if key == normalized_key else compiled.reordered(fields)
+        cls._cache_serializer(key, serializer)
+        return serializer
 
-        result = {}
-        async_props = {}
+    @classmethod
+    def _cache_serializer(cls, key, serializer):
+        # fields come from clients, the cache is bounded
+        cache = cls.__serializers__
+        cache[key] = serializer
+        cache.move_to_end(key)
+        if len(cache) > MAX_CACHED_SERIALIZERS:
+            cache.popitem(last=False)
 
-        for field in fields:
-            if field in self.__restricted_fields__ and not include_restricted:
-                continue
-            try:
-                value = getattr(self, field)
-            except AttributeError:
-                continue
-            if callable(value):
-                continue
+    def _dict_sync(self, fields: Iterable[str] = None, include_restricted: bool = False, jsonable_dict: bool = True) -> dict:
+        serializer = self.get_serializer(fields, include_restricted)
+        result, pending = serializer.serialize_sync(self, jsonable_dict)
+        for value in pending.values():
             if asyncio.iscoroutine(value):
-                async_props[field] = value
-                continue
-
-            if isinstance(value, ObjectsCursor):
-                item_tasks = [asyncio.create_task(x.to_dict()) async for x in value]
-                value = await asyncio.gather(*item_tasks)
-
-            if jsonable_dict:
-                value = jsonable(value)
-
-            result[field] = value
-
-        if async_props:
-
-            async_values = await self.collect_async_props(async_props)
-            for field, value in async_values.items():
-                if isinstance(value, AbstractModel):
-                    value = await value.to_dict(jsonable_dict=jsonable_dict)
-                result[field] = value
-
+                value.close()
         return result
 
+    async def to_dict(self, fields: Iterable[str] = None, include_restricted: bool = False, jsonable_dict: bool = True) -> dict:
+        serializer = self.get_serializer(fields, include_restricted)
+        return await serializer.serialize(self, jsonable_dict)
+
     @classmethod
     def from_data(cls, **data):
         return cls(**data)
@@ -437,10 +447,15 @@ class AbstractModel(metaclass=ModelMeta):
         return [ctx.db.meta]
 
     @classmethod
-    async def ensure_indexes(cls, loud=False, overwrite=False):  # pylint: disable=too-many-branches
+    def index_specs(cls):
+        """
+        parses __indexes__
+        :return: list of (keys, options), keys being a list of (field, order)
+        """
         if not isinstance(cls.__indexes__, (list, tuple)):
             raise TypeError("INDEXES field must be of type list or tuple")
 
+        specs = []
         for index in cls.__indexes__:
             if isinstance(index, str):
                 index = [index]
@@ -452,7 +467,20 @@ class AbstractModel(metaclass=ModelMeta):
                     keys.append(parse_index_key(sub_index))
                 else:
                     for key, value in sub_index.items():
+                        # callable option values are computed at index creation
+                        # time, e.g. expireAfterSeconds taken from the config.
+                        # None means the option is omitted
+                        if callable(value):
+                            value = value()
+                            if value is None:
+                                continue
                         options[key] = value
+            specs.append((keys, options))
+        return specs
+
+    @classmethod
+    async def ensure_indexes(cls, loud=False, overwrite=False):
+        for keys, options in cls.index_specs():
             if loud:
                 ctx.log.debug(
                     "Creating index with options: %s, %s", keys, options)
@@ -0,0 +1,57 @@
+import importlib
+
+
+class Relation:
+    """
+    Describes a model field referencing objects of another (storable) model,
+    e.g. WorkGroup.owner_id -> User._id. Declared in the model's __relations__
+    to let serializers resolve related objects of a whole page in one query.
+
+      - local_field: field holding the reference (a list of them if many=True)
+      - model: related model class or its import path like "app.models.user.User"
+      - many: whether local_field is a list of references
+      - remote_field: field of the related model the references point to
+      - attribute: if set, the related objects are represented by this
+        attribute only, e.g. "username", instead of their serialized dicts
+
+    Sharded models can't be related to as the references don't tell the shard.
+    """
+
+    def __init__(self, local_field: str, model, many: bool = False, remote_field: str = "_id",
+                 attribute: str = None):
+        self.local_field = local_field
+        self.many = many
+        self.remote_field = remote_field
+        self.attribute = attribute
+        self._model = model
+        if not isinstance(model, str):
+            self._check_model(model)
+
+    @staticmethod
+    def _check_model(model):
+        from .sharded_model import ShardedModel
+        if issubclass(model, ShardedModel):
+            raise TypeError(f"relations to sharded model {model.__name__} are not supported")
+
+    @property
+    def model(self):
+        if isinstance(self._model, str):
+            module_name, class_name = self._model.rsplit(".", 1)
+            model = getattr(importlib.import_module(module_name), class_name)
+            self._check_model(model)
+            self._model = model
+        return self._model
+
+    def references(self, obj) -> list:
+        value = getattr(obj, self.local_field, None)
+        if value is None:
+            return []
+        if self.many:
+            return list(value)
+        return [value]
+
+    async def fetch(self, references: list, limit: int = None) -> list:
+        cursor = self.model.find({self.remote_field: {"$in": references}})
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        return await cursor.all()
@@ -0,0 +1,388 @@
+import re
+import asyncio
+import inspect
+from copy import copy
+from contextvars import ContextVar
+from typing import Iterable
+
+from uengine import ctx
+from uengine.context import ContextError
+from uengine.json import jsonable
+
+# field kinds
+PLAIN = 0       # model data field, converted right away
+DYNAMIC = 1     # sync property or unknown attribute, checked for cursors and coroutines when read
+ASYNC_PROP = 2  # property returning a coroutine
+RELATION = 3    # field declared in __relations__, resolved in batches
+
+DEFAULT_SERIALIZATION_CONCURRENCY = 16
+# compiled serializers kept per model class, least recently used ones are dropped
+MAX_CACHED_SERIALIZERS = 128
+
+FIELD_SPEC_EXPR = re.compile(r"^([^\[\]]+)\[:(\d+)\]$")
+
+_cursor_class = None
+
+# per-request (or rather per-context) serialization fan-out limiter
+_serialization_limiter = ContextVar("serialization_limiter", default=None)
+# the slot of the limited() call the current code runs within
+_limiter_slot = ContextVar("serialization_limiter_slot", default=None)
+
+
+def _objects_cursor_class():
+    # uengine.db imports models, so it can't be imported at the module level
+    global _cursor_class
+    if _cursor_class is None:
+        from uengine.db import ObjectsCursor
+        _cursor_class = ObjectsCursor
+    return _cursor_class
+
+
+def parse_field_spec(spec: str):
+    """
+    parses field specifications like "members" or "members[:20]"
+    :return: (field_name, limit), limit is None if not specified
+    """
+    if "[" not in spec:
+        return spec, None
+    match = FIELD_SPEC_EXPR.match(spec)
+    if match is None:
+        raise ValueError(f"invalid field specification {spec}")
+    return match.group(1), int(match.group(2))
+
+
+def parse_fields(fields: Iterable[str]):
+    """
+    groups dotted field paths by their top-level fields keeping the order,
+    e.g. ["name", "owner.username", "owner.email", "members[:5].email"] gives
+    [("name", None, None), ("owner", None, ["username", "email"]), ("members", 5, ["email"])]
+    subfields are None when the top-level field is requested as a whole
+    """
+    parsed = {}
+    for path in fields:
+        head, _, rest = path.partition(".")
+        field, limit = parse_field_spec(head)
+        if field not in parsed:
+            parsed[field] = [limit, [] if rest else None]
+        else:
+            entry = parsed[field]
+            if limit is not None:
+                entry[0] = limit
+            if not rest:
+                entry[1] = None
+        if rest and parsed[field][1] is not None:
+            parsed[field][1].append(rest)
+    return [(field, limit, subfields) for field, (limit, subfields) in parsed.items()]
+
+
+def normalize_fields(fields: Iterable[str]) -> tuple:
+    """
+    the requested field paths deduplicated and sorted, so that
+    permutations of the same fields share a compiled serializer
+    """
+    return tuple(sorted(set(fields)))
+
+
+def select_subfields(value, subfields):
+    """
+    picks subfields from plain dict values (or lists of them)
+    """
+    if subfields is None:
+        return value
+    if isinstance(value, dict):
+        return {
+            field: select_subfields(value[field], nested)
+            for field, _, nested in parse_fields(subfields)
+            if field in value
+        }
+    if isinstance(value, (list, tuple)):
+        return [select_subfields(item, subfields) for item in value]
+    return value
+
+
+def ensure_serialization_limiter():
+    """
+    sets up the fan-out limiter for the current context unless it is
+    already there. Called by top-level serialization entry points so
+    the tasks they spawn share the same limiter
+    """
+    if _serialization_limiter.get() is None:
+        try:
+            concurrency = ctx.cfg.get("serialization_concurrency", DEFAULT_SERIALIZATION_CONCURRENCY)
+        except ContextError:
+            # models are used without a configured app, e.g. in unit tests
+            concurrency = DEFAULT_SERIALIZATION_CONCURRENCY
+        if concurrency:
+            _serialization_limiter.set(asyncio.Semaphore(concurrency))
+
+
+class _LimiterSlot:
+    """
+    a limiter slot which is lent back to the limiter while nested
+    limited() calls run, so that parents waiting for their children
+    don't exhaust the limiter and deadlock
+    """
+
+    def __init__(self, limiter: asyncio.Semaphore):
+        self.limiter = limiter
+        self.holding = True
+        self.lent = 0
+
+    def lend(self):
+        self.lent += 1
+        if self.holding:
+            self.holding = False
+            self.limiter.release()
+
+    async def reclaim(self):
+        self.lent -= 1
+        while self.lent == 0 and not self.holding:
+            await self.limiter.acquire()
+            if self.lent == 0 and not self.holding:
+                self.holding = True
+            else:
+                # lent again or reclaimed by another child meanwhile
+                self.limiter.release()
+
+    def release(self):
+        if self.holding:
+            self.holding = False
+            self.limiter.release()
+
+
+async def limited(awaitable):
+    """
+    awaits within a slot of the current serialization limiter, nested
+    calls (e.g. serializing relations of related objects) take slots
+    of their own while the parent's one is lent back
+    """
+    limiter = _serialization_limiter.get()
+    if limiter is None:
+        return await awaitable
+    parent = _limiter_slot.get()
+    if parent is not None:
+        parent.lend()
+    try:
+        await limiter.acquire()
+        slot = _LimiterSlot(limiter)
+        token = _limiter_slot.set(slot)
+        try:
+            return await awaitable
+        finally:
+            _limiter_slot.reset(token)
+            slot.release()
+    finally:
+        if parent is not None:
+            await parent.reclaim()
+
+
+async def _fetch_cursor(cursor):
+    return [item async for item in cursor]
+
+
+async def serialize_models(items: Iterable, fields: Iterable[str] = None, jsonable_dict: bool = True) -> list:
+    """
+    serializes models synchronously where possible, only the items having
+    async properties or cursors among the fields are resolved concurrently.
+    Related objects are fetched with one query per relation for all the items
+    """
+    if fields is not None:
+        fields = tuple(fields)
+    serializers = {}
+    related = {}
+    result = []
+    pending_items = []
+    for item in items:
+        item_cls = item.__class__
+        serializer = serializers.get(item_cls)
+        if serializer is None:
+            serializer = serializers[item_cls] = item_cls.get_serializer(fields)
+        value, pending = serializer.serialize_sync(item, jsonable_dict)
+        if pending:
+            pending_items.append(serializer.resolve_pending(value, pending, jsonable_dict))
+        if serializer.relations:
+            if serializer not in related:
+                related[serializer] = ([], [])
+            related[serializer][0].append(item)
+            related[serializer][1].append(value)
+        result.append(value)
+
+    for serializer, (related_items, related_results) in related.items():
+        pending_items.append(serializer.resolve_relations(related_items, related_results, jsonable_dict))
+
+    if pending_items:
+        ensure_serialization_limiter()
+        await asyncio.gather(*pending_items)
+    return result
+
+
+class ModelSerializer:
+    """
+    to_dict() plan compiled once per model class and set of requested fields:
+    it knows in advance which fields are plain data, which ones are async
+    properties, relations and which ones should be checked for cursors
+    """
+
+    def __init__(self, model_cls, fields: Iterable[str], include_restricted: bool):
+        self.model_cls = model_cls
+        self.steps = []
+        self.relations = []
+
+        for field, limit, subfields in parse_fields(fields):
+            if field in model_cls.__restricted_fields__ and not include_restricted:
+                continue
+            kind = self.field_kind(model_cls, field)
+            if kind == RELATION:
+                self.relations.append((field, model_cls.__relations__[field], limit, subfields))
+            elif kind is not None:
+                self.steps.append((field, kind, limit, subfields))
+
+        self._set_plain_fields()
+
+    def _set_plain_fields(self):
+        self.plain_fields = [field for field, kind, _, subfields in self.steps if kind == PLAIN and subfields is None]
+        self.all_plain = len(self.plain_fields) == len(self.steps)
+
+    def reordered(self, fields: Iterable[str]) -> "ModelSerializer":
+        """
+        a copy of the serializer giving the fields in the requested order
+        """
+        order = {field: idx for idx, (field, _, _) in enumerate(parse_fields(fields))}
+        serializer = copy(self)
+        serializer.steps = sorted(self.steps, key=lambda step: order[step[0]])
+        serializer.relations = sorted(self.relations, key=lambda relation: order[relation[0]])
+        serializer._set_plain_fields()
+        return serializer
+
+    @staticmethod
+    def field_kind(model_cls, field):
+        if field in model_cls.__relations__:
+            return RELATION
+        if field in model_cls.__fields__:
+            return PLAIN
+        cls_attr = inspect.getattr_static(model_cls, field, None)
+        if isinstance(cls_attr, property):
+            if inspect.iscoroutinefunction(cls_attr.fget):
+                return ASYNC_PROP
+            return DYNAMIC
+        if callable(cls_attr) or isinstance(cls_attr, (staticmethod, classmethod)):
+            # methods are never serialized
+            return None
+        return DYNAMIC
+
+    def serialize_sync(self, obj, jsonable_dict: bool = True):
+        """
+        serializes everything that doesn't need awaiting, relations are left out
+        :return: (result, pending) where pending maps fields to coroutines
+                 and cursors which are to be resolved asynchronously
+        """
+        if self.all_plain:
+            if jsonable_dict:
+                return {field: jsonable(getattr(obj, field)) for field in self.plain_fields}, {}
+            return {field: getattr(obj, field) for field in self.plain_fields}, {}
+
+        result = {}
+        pending = {}
+        cursor_class = None
+        for field, kind, limit, subfields in self.steps:
+            try:
+                value = getattr(obj, field)
+            except AttributeError:
+                continue
+
+            if kind == ASYNC_PROP:
+                pending[field] = value, subfields
+                continue
+
+            if kind == DYNAMIC:
+                if callable(value):
+                    continue
+                if asyncio.iscoroutine(value):
+                    pending[field] = value, subfields
+                    continue
+                if cursor_class is None:
+                    cursor_class = _objects_cursor_class()
+                if isinstance(value, cursor_class):
+                    if limit == 0:
+                        # mongo treats limit(0) as no limit at all
+                        result[field] = []
+                    else:
+                        pending[field] = (value.limit(limit) if limit is not None else value), subfields
+                    continue
+
+            value = select_subfields(value, subfields)
+            if jsonable_dict:
+                value = jsonable(value)
+            result[field] = value
+
+        return result, pending
+
+    async def resolve_pending(self, result: dict, pending: dict, jsonable_dict: bool = True):
+        from .abstract_model import AbstractModel
+        cursor_class = _objects_cursor_class()
+
+        async def resolve(value, subfields):
+            if isinstance(value, cursor_class):
+                items = await limited(_fetch_cursor(value))
+                return await serialize_models(items, subfields)
+            value = await limited(value)
+            if isinstance(value, AbstractModel):
+                return await value.to_dict(fields=subfields, jsonable_dict=jsonable_dict)
+            if isinstance(value, list) and value and isinstance(value[0], AbstractModel):
+                return await serialize_models(value, subfields, jsonable_dict)
+            return select_subfields(value, subfields)
+
+        fields = list(pending.keys())
+        if len(fields) == 1:
+            values = [await resolve(*pending[fields[0]])]
+        else:
+            values = await asyncio.gather(*[resolve(*pending[field]) for field in fields])
+        for field, value in zip(fields, values):
+            result[field] = value
+        return result
+
+    async def resolve_relations(self, items: list, results: list, jsonable_dict: bool = True):
+        """
+        fetches related objects of all the items with one query per relation
+        and puts their serialized representations into the items' results
+        """
+
+        async def resolve(field, relation, limit, subfields):
+            references = [relation.references(item) for item in items]
+            fetch_limit = None
+            if relation.many and limit is not None:
+                # only the first limit references of each item are shown
+                references = [refs[:limit] for refs in references]
+                if len(items) == 1:
+                    fetch_limit = limit
+            unique = list({ref for refs in references for ref in refs})
+            related = {}
+            if unique:
+                objs = await limited(relation.fetch(unique, fetch_limit))
+                if relation.attribute is not None:
+                    dicts = [getattr(obj, relation.attribute) for obj in objs]
+                    if jsonable_dict:
+                        dicts = [jsonable(value) for value in dicts]
+                else:
+                    dicts = await serialize_models(objs, subfields, jsonable_dict)
+                related = {getattr(obj, relation.remote_field): data for obj, data in zip(objs, dicts)}
+
+            for refs, result in zip(references, results):
+                if relation.many:
+                    result[field] = [related[ref] for ref in refs if ref in related]
+                else:
+                    result[field] = related.get(refs[0]) if refs else None
+
+        await asyncio.gather(*[resolve(*relation) for relation in self.relations])
+
+    async def serialize(self, obj, jsonable_dict: bool = True) -> dict:
+        result, pending = self.serialize_sync(obj, jsonable_dict)
+        if pending or self.relations:
+            ensure_serialization_limiter()
+            tasks = []
+            if pending:
+                tasks.append(self.resolve_pending(result, pending, jsonable_dict))
+            if self.relations:
+                tasks.append(self.resolve_relations([obj], [result], jsonable_dict))
+            await asyncio.gather(*tasks)
+        return result
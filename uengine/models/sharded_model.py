@@ -1,11 +1,93 @@
+import asyncio
+from bson import BSON
 from bson.objectid import ObjectId
+from collections import namedtuple
 from functools import partial
+from time import monotonic
 from uengine import ctx
 from uengine.errors import ApiError, NotFound, MissingShardId
 from uengine.utils import resolve_id
 
 from .storable_model import StorableModel
 
+ShardedResult = namedtuple("_ShardedResult", field_names=["result", "timings"])
+
+
+def _merge_sum(a, b):
+    return a + b
+
+
+def _merge_union(a, b):
+    return union_values(a, b)
+
+
+# Accumulators which can be computed per shard and then combined
+# into the same value a single-database $group would have produced
+GROUP_ACCUMULATORS_MERGERS = {
+    "$sum": _merge_sum,
+    "$count": _merge_sum,
+    "$min": min,
+    "$max": max,
+    "$push": _merge_sum,
+    "$addToSet": _merge_union,
+}
+
+
+def union_values(*value_lists):
+    merged = []
+    seen = set()
+    for values in value_lists:
+        for value in values:
+            try:
+                if value in seen:
+                    continue
+                seen.add(value)
+            except TypeError:
+                # unhashable values like sub-documents or arrays
+                if value in merged:
+                    continue
+            merged.append(value)
+    return merged
+
+
+def group_mergers(group_stage):
+    mergers = {}
+    for field, accumulator in group_stage.items():
+        if field == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            raise ValueError(f"invalid $group accumulator for field {field}")
+        operator = next(iter(accumulator))
+        if operator not in GROUP_ACCUMULATORS_MERGERS:
+            raise ValueError(f"accumulator {operator} can not be merged across shards")
+        mergers[field] = GROUP_ACCUMULATORS_MERGERS[operator]
+    return mergers
+
+
+def merge_group_results(group_stage, shard_results):
+    """
+    merges per-shard results of a pipeline ending with the given $group stage
+    """
+    mergers = group_mergers(group_stage)
+    groups = {}
+    for docs in shard_results:
+        for doc in docs:
+            # group ids may be unhashable sub-documents, BSON gives
+            # an exact hashable representation of them
+            key = BSON.encode({"_id": doc["_id"]})
+            if key not in groups:
+                groups[key] = dict(doc)
+                continue
+            group = groups[key]
+            for field, merge in mergers.items():
+                if field not in doc:
+                    continue
+                if group.get(field) is None:
+                    group[field] = doc[field]
+                elif doc[field] is not None:
+                    group[field] = merge(group[field], doc[field])
+    return list(groups.values())
+
 
 class ShardedModel(StorableModel):
 
@@ -38,6 +120,20 @@ class ShardedModel(StorableModel):
     def _get_possible_databases(cls):
         return list(ctx.db.shards.values())
 
+    @classmethod
+    async def upsert(cls, shard_id, key_query: dict, set_fields: dict = None, set_on_insert: dict = None,
+                     skip_callback: bool = False):
+        """
+        StorableModel.upsert() within the given shard
+        :return: (model, created)
+        """
+        return await cls._upsert(ctx.db.get_shard(shard_id), key_query, set_fields, set_on_insert,
+                                 skip_callback, shard_id=shard_id)
+
+    @classmethod
+    async def get_or_create(cls, shard_id, key_query: dict, defaults: dict = None, skip_callback: bool = False):
+        return await cls.upsert(shard_id, key_query, set_on_insert=defaults, skip_callback=skip_callback)
+
     @classmethod
     def find(cls, shard_id, query=None, **kwargs):
         if not query:
@@ -69,6 +165,85 @@ class ShardedModel(StorableModel):
             **kwargs
         )
 
+    @classmethod
+    async def _fan_out(cls, shard_ids, operation):
+        if shard_ids is None:
+            shard_ids = list(ctx.db.shards.keys())
+        shards = [ctx.db.get_shard(shard_id) for shard_id in shard_ids]
+
+        async def timed(shard):
+            t1 = monotonic()
+            result = await operation(shard)
+            return result, monotonic() - t1
+
+        shard_results = await asyncio.gather(*[timed(shard) for shard in shards])
+        results = [r for r, _ in shard_results]
+        timings = {shard_id: t for shard_id, (_, t) in zip(shard_ids, shard_results)}
+        return results, timings
+
+    @classmethod
+    async def count(cls, query=None, shard_ids=None):
+        """
+        counts documents matching the query on all (or the given) shards concurrently
+        :return: ShardedResult with the total count and per-shard timings in seconds
+        """
+        if not query:
+            query = {}
+        query = cls._preprocess_query(query)
+        results, timings = await cls._fan_out(
+            shard_ids,
+            lambda shard: shard.count_docs(cls.__collection__, query)
+        )
+        return ShardedResult(result=sum(results), timings=timings)
+
+    @classmethod
+    async def distinct(cls, key, query=None, shard_ids=None):
+        """
+        collects distinct values of the key on all (or the given) shards concurrently
+        :return: ShardedResult with the values union and per-shard timings in seconds
+        """
+        if not query:
+            query = {}
+        query = cls._preprocess_query(query)
+        results, timings = await cls._fan_out(
+            shard_ids,
+            lambda shard: shard.distinct(cls.__collection__, key, query)
+        )
+        return ShardedResult(result=union_values(*results), timings=timings)
+
+    @classmethod
+    async def aggregate(cls, pipeline, shard_ids=None, **kwargs):
+        """
+        runs the aggregation pipeline on all (or the given) shards concurrently.
+        If the pipeline ends with a $group stage using mergeable accumulators
+        ($sum, $count, $min, $max, $push, $addToSet) the groups are combined
+        across shards, otherwise shard results are concatenated.
+        :return: ShardedResult with the merged documents and per-shard timings in seconds
+        """
+        pipeline = list(pipeline)
+        group_stage = None
+        for idx, stage in enumerate(pipeline):
+            if "$group" in stage:
+                if idx != len(pipeline) - 1:
+                    raise ValueError("$group must be the last stage of a cross-shard aggregation")
+                group_stage = stage["$group"]
+                # fail early on accumulators we are unable to merge
+                group_mergers(group_stage)
+
+        match = cls._preprocess_query({})
+        if match:
+            pipeline.insert(0, {"$match": match})
+
+        results, timings = await cls._fan_out(
+            shard_ids,
+            lambda shard: shard.aggregate(cls.__collection__, pipeline, **kwargs)
+        )
+        if group_stage is None:
+            merged = [doc for docs in results for doc in docs]
+        else:
+            merged = merge_group_results(group_stage, results)
+        return ShardedResult(result=merged, timings=timings)
+
     @classmethod
     async def get(cls, shard_id, expression, raise_if_none=None):
         if expression is None:
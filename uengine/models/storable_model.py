@@ -1,6 +1,7 @@
 from functools import partial
+from itertools import chain
 from uengine import ctx
-from uengine.utils import resolve_id
+from uengine.utils import resolve_id, now
 from uengine.errors import NotFound, ModelDestroyed, IntegrityError
 # from uengine.cache import req_cache_get, req_cache_set, req_cache_has_key, req_cache_delete
 from datetime import datetime
@@ -8,6 +9,15 @@ from bson.objectid import ObjectId
 
 from .abstract_model import AbstractModel, save_required
 
+DEFAULT_TOUCH_INTERVAL = 300
+
+
+def touch_interval() -> int:
+    """
+    minimal number of seconds between two db_touch() writes of the same object
+    """
+    return ctx.cfg.get("touch_interval", DEFAULT_TOUCH_INTERVAL)
+
 
 class StorableModel(AbstractModel):
 
@@ -49,6 +59,26 @@ class StorableModel(AbstractModel):
 
         return bool(new_data)
 
+    @save_required
+    async def db_touch(self, field: str = "updated_at", interval: int = None) -> bool:
+        """
+        bumps a timestamp field with a single $max update instead of a full save.
+        The write is skipped if the field has been bumped less than interval
+        seconds ago, so its stored value may lag behind by up to interval seconds
+        :param interval: throttle interval, touch_interval() by default
+        :return: True if the write has been made
+        """
+        if interval is None:
+            interval = touch_interval()
+        value = now()
+        current = getattr(self, field)
+        if current is not None and (value - current).total_seconds() < interval:
+            return False
+        # $max never moves the timestamp back if a concurrent request got ahead
+        await self._db.update_query(self.__collection__, {"_id": self._id}, {"$max": {field: value}})
+        setattr(self, field, value)
+        return True
+
     async def _delete_from_db(self):
         await self._db.delete_obj(self)
 
@@ -168,6 +198,68 @@ class StorableModel(AbstractModel):
             cache_key_keyfield = f"{self.__collection__}.{getattr(self, self.__key_field__)}"
         return self._invalidate(cache_key_id, cache_key_keyfield)
 
+    @classmethod
+    async def upsert(cls, key_query: dict, set_fields: dict = None, set_on_insert: dict = None,
+                     skip_callback: bool = False):
+        """
+        atomically updates the object matching key_query with set_fields or
+        creates it if there is none, in a single round trip. A new object gets
+        key_query equality fields, set_fields, set_on_insert and the defaults
+        of the rest of the fields. The object goes through the same steps
+        as with save(): _before_validation(), validation, trimming and
+        _before_save() run before the query, the hooks and _after_save()
+        after it (unless nothing is changed).
+        Concurrent upserts are only guaranteed not to create duplicates
+        if key_query fields are covered by a unique index
+        :return: (model, created)
+        """
+        return await cls._upsert(ctx.db.meta, key_query, set_fields, set_on_insert, skip_callback)
+
+    @classmethod
+    async def _upsert(cls, db, key_query, set_fields, set_on_insert, skip_callback, **init_kwargs):
+        set_fields = set_fields or {}
+        set_on_insert = set_on_insert or {}
+        key_fields = {
+            k: v for k, v in key_query.items()
+            if not k.startswith("$") and not (isinstance(v, dict) and any(op.startswith("$") for op in v))
+        }
+
+        candidate = cls(**{**key_fields, **set_on_insert, **set_fields}, **init_kwargs)
+        await candidate._prepare_save(skip_callback)
+        # the values as validated and trimmed
+        key_query = {**key_query, **{field: getattr(candidate, field) for field in key_fields}}
+        set_fields = {field: getattr(candidate, field) for field in set_fields}
+
+        insert_data = candidate._dict_sync(include_restricted=True, jsonable_dict=False)
+        # set_fields and key fields get into the new document by themselves,
+        # mongo rejects updates mentioning the same field twice
+        for field in chain(set_fields, key_fields):
+            insert_data.pop(field, None)
+        # the known _id tells an inserted document from a found one
+        new_id = ObjectId()
+        insert_data["_id"] = new_id
+
+        update = {"$setOnInsert": insert_data}
+        if set_fields:
+            update["$set"] = set_fields
+        data = await db.find_and_upsert(cls.__collection__, cls._preprocess_query(key_query), update)
+        obj = cls.from_data(**data)
+        created = data["_id"] == new_id
+        if created or set_fields:
+            await obj._complete_save(created, skip_callback)
+        else:
+            obj.invalidate()
+        return obj, created
+
+    @classmethod
+    async def get_or_create(cls, key_query: dict, defaults: dict = None, skip_callback: bool = False):
+        """
+        returns the object matching key_query creating it with the defaults
+        if there is none, atomically
+        :return: (model, created)
+        """
+        return await cls.upsert(key_query, set_on_insert=defaults, skip_callback=skip_callback)
+
     @classmethod
     async def destroy_all(cls):
         await ctx.db.meta.delete_query(cls.__collection__, cls._preprocess_query({}))
@@ -0,0 +1,115 @@
+import os
+import json
+import sysconfig
+import traceback
+from contextvars import ContextVar
+from starlette.requests import Request
+
+from . import ctx
+from .instrumentation import add_db_observer, normalize_query
+
+DEFAULT_NPLUSONE_THRESHOLD = 5
+STACK_DEPTH = 10
+
+_detector = ContextVar("nplusone_detector", default=None)
+
+_UENGINE_DIR = os.path.dirname(os.path.abspath(__file__))
+_UENGINE_TESTS_DIR = os.path.join(_UENGINE_DIR, "tests")
+_LIBRARY_DIRS = tuple({
+    _UENGINE_DIR,
+    sysconfig.get_paths()["stdlib"],
+    sysconfig.get_paths()["purelib"],
+    sysconfig.get_paths()["platlib"],
+})
+
+
+class NPlusOneError(Exception):
+    pass
+
+
+def query_shape(operation: str, collection: str, query) -> str:
+    normalized = normalize_query(query) if query is not None else None
+    return f"{operation} {collection} {json.dumps(normalized, sort_keys=True)}"
+
+
+def _is_app_frame(filename: str) -> bool:
+    filename = os.path.abspath(filename)
+    if filename.startswith(_UENGINE_TESTS_DIR):
+        return True
+    return not filename.startswith(_LIBRARY_DIRS)
+
+
+def call_site_stack() -> str:
+    """
+    the innermost application frames of the current stack, uengine and
+    library frames are skipped as they are the same for every query
+    """
+    frames = traceback.extract_stack()[:-1]
+    app_frames = [frame for frame in frames if _is_app_frame(frame.filename)]
+    return "".join(traceback.format_list((app_frames or frames)[-STACK_DEPTH:]))
+
+
+class NPlusOneDetector:
+    """
+    counts db operations by query shape while active and reports shapes
+    repeated more than threshold times, which is what an N+1 pattern
+    (a query per item of a list) looks like. Each shape is reported once
+    with the stack of the call site exceeding the threshold
+    """
+
+    def __init__(self, threshold: int = DEFAULT_NPLUSONE_THRESHOLD, raise_error: bool = False, name: str = "-"):
+        """
+        :param raise_error: raise NPlusOneError instead of logging a warning
+        :param name: what is being checked, e.g. the request, used in reports
+        """
+        self.threshold = threshold
+        self.raise_error = raise_error
+        self.name = name
+        self.counts = {}
+        self._token = None
+
+    def add(self, op):
+        if op.operation == "get_more":
+            # a further batch of a query which is already counted
+            return
+        shape = query_shape(op.operation, op.collection, op.query)
+        count = self.counts.get(shape, 0) + 1
+        self.counts[shape] = count
+        if count == self.threshold + 1:
+            self.report(shape)
+
+    def report(self, shape: str):
+        message = (f"possible N+1 query in {self.name}: {shape} made more than {self.threshold} times, "
+                   f"call site:\n{call_site_stack()}")
+        if self.raise_error:
+            raise NPlusOneError(message)
+        ctx.log.warning(message)
+
+    def repeated(self) -> dict:
+        """
+        :return: {shape: count} of the shapes made more than threshold times
+        """
+        return {shape: count for shape, count in self.counts.items() if count > self.threshold}
+
+    def __enter__(self):
+        add_db_observer(nplusone_observer)
+        self._token = _detector.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _detector.reset(self._token)
+
+
+def nplusone_observer(op):
+    detector = _detector.get()
+    if detector is not None:
+        detector.add(op)
+
+
+def create_nplusone_middleware(threshold: int = DEFAULT_NPLUSONE_THRESHOLD, raise_error: bool = False):
+
+    async def nplusone_middleware(request: Request, call_next):
+        with NPlusOneDetector(threshold, raise_error, f"{request.method} {request.url.path}"):
+            return await call_next(request)
+
+    return nplusone_middleware
@@ -1,14 +1,30 @@
+import zlib
+import asyncio
+from time import monotonic
 from base64 import b64encode, b64decode
 from binascii import Error as Base64Error
-from datetime import datetime
+from bson import json_util
+from datetime import datetime, timedelta
 from starlette.requests import Request
 from itsdangerous import Signer, BadSignature
-from typing import Optional, Type
+from itsdangerous.encoding import base64_encode, base64_decode
+from typing import Optional, Type, Union
 
 from . import ctx
-from .models.storable_model import StorableModel
+from .models.abstract_model import AbstractModel
+from .models.storable_model import StorableModel, touch_interval
+from .tracing import span
 from .utils import now, uuid4_string
 
+DEFAULT_SESSION_EXPIRATION_TIME = 86400 * 7 * 2
+DEFAULT_SESSION_CLEANUP_INTERVAL = 3600
+# browsers drop cookies larger than 4KB
+MAX_COOKIE_SIZE = 4093
+# payloads shorter than this are not worth compressing
+COMPRESSION_THRESHOLD = 64
+# naive utc datetimes like the ones uengine.utils.now() gives
+COOKIE_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
 _signer = None
 
 
@@ -27,10 +43,34 @@ def generate_session_id() -> (str, str):
     generates a unique session id (uuid4), signs it with itsdangerous.Signer
     and encodes with b64 encoder to use as a Cookie value
     """
-    signer = get_signer()
     session_id = uuid4_string()
-    signed = signer.sign(session_id)
-    return session_id, b64encode(signed).decode()
+    return session_id, encode_session_id(session_id)
+
+
+def encode_session_id(session_id: str) -> str:
+    signed = get_signer().sign(session_id)
+    return b64encode(signed).decode()
+
+
+def session_expiration_time() -> int:
+    """
+    session lifetime in seconds since the last update, 0 means sessions never expire
+    """
+    return ctx.cfg.get("session_expiration_time", DEFAULT_SESSION_EXPIRATION_TIME)
+
+
+def _ttl_index_expiration() -> Optional[int]:
+    expiration_time = session_expiration_time()
+    return expiration_time if expiration_time > 0 else None
+
+
+def _session_expired(updated_at) -> bool:
+    expiration_time = session_expiration_time()
+    if expiration_time <= 0:
+        return False
+    if not isinstance(updated_at, datetime):
+        return True
+    return (now() - updated_at).total_seconds() > expiration_time
 
 
 def read_session_id(cookie_str: str) -> Optional[str]:
@@ -56,6 +96,8 @@ class BaseSession(StorableModel):
 
     __indexes__ = (
         ["sid", {"unique": True}],
+        # mongo removes expired sessions by itself
+        ["updated_at", {"expireAfterSeconds": _ttl_index_expiration}],
     )
 
     __key_field__ = "sid"
@@ -71,35 +113,260 @@ class BaseSession(StorableModel):
     def touch(self):
         self.updated_at = now()
 
+    @property
+    def expired(self) -> bool:
+        return _session_expired(self.updated_at)
+
+    @classmethod
+    def new(cls) -> "BaseSession":
+        return cls(sid=uuid4_string())
+
+    @classmethod
+    async def from_cookie(cls, cookie_value: str) -> Optional["BaseSession"]:
+        session_id = read_session_id(cookie_value)
+        if not session_id:
+            return None
+        session = await cls.get(session_id)
+        # the TTL monitor runs once a minute at best, expired
+        # sessions may still be there
+        if session and session.expired:
+            return None
+        return session
+
+    @classmethod
+    async def cleanup(cls) -> int:
+        """
+        removes expired sessions
+        :return: the number of removed sessions
+        """
+        expiration_time = session_expiration_time()
+        if expiration_time <= 0:
+            return 0
+        threshold = now() - timedelta(seconds=expiration_time)
+        query = cls._preprocess_query({"updated_at": {"$lt": threshold}})
+        result = await ctx.db.meta.delete_query(cls.__collection__, query)
+        return result.deleted_count
+
+    async def store(self) -> Optional[str]:
+        """
+        saves the session
+        :return: a cookie value if the cookie is to be (re)set, None otherwise
+        """
+        is_new = self.is_new
+        await self.save()
+        if is_new:
+            return encode_session_id(self.sid)
+        return None
+
+    async def refresh(self) -> Optional[str]:
+        """
+        keeps an unmodified session alive bumping its updated_at at most
+        once per touch_interval() seconds
+        :return: a cookie value if the cookie is to be reset, None otherwise
+        """
+        if not self.is_new:
+            await self.db_touch()
+        return None
+
+
+class BaseCookieSession(AbstractModel):
+    """
+    stateless session keeping all its fields in a signed cookie,
+    suitable for small payloads like user_id. The cookie expires
+    after session_expiration_time seconds since the last store()
+    """
+
+    created_at: datetime = now
+    updated_at: datetime = now
+
+    __compress__ = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.modified = False
+
+    async def _before_save(self):
+        self.touch()
+
+    def touch(self):
+        self.updated_at = now()
+
+    @property
+    def expired(self) -> bool:
+        return _session_expired(self.updated_at)
+
+    def dump_cookie(self) -> str:
+        data = self._dict_sync(include_restricted=True, jsonable_dict=False)
+        del data["_id"]
+        payload = json_util.dumps(data).encode()
+        compressed = False
+        if self.__compress__ and len(payload) > COMPRESSION_THRESHOLD:
+            zipped = zlib.compress(payload)
+            if len(zipped) < len(payload):
+                payload = zipped
+                compressed = True
+        payload = base64_encode(payload)
+        if compressed:
+            payload = b"." + payload
+        return get_signer().sign(payload).decode()
+
+    @classmethod
+    def load_cookie(cls, cookie_value: Union[str, bytes]) -> Optional["BaseCookieSession"]:
+        try:
+            payload = get_signer().unsign(cookie_value)
+        except BadSignature:
+            return None
+
+        compressed = payload.startswith(b".")
+        if compressed:
+            payload = payload[1:]
+        try:
+            payload = base64_decode(payload)
+            if compressed:
+                payload = zlib.decompress(payload)
+            data = json_util.loads(payload, json_options=COOKIE_JSON_OPTIONS)
+        except (ValueError, zlib.error):
+            return None
+        if not isinstance(data, dict):
+            return None
+
+        session = cls(**data)
+        if session.expired:
+            return None
+        return session
+
+    @classmethod
+    def new(cls) -> "BaseCookieSession":
+        return cls()
+
+    @classmethod
+    async def from_cookie(cls, cookie_value: str) -> Optional["BaseCookieSession"]:
+        return cls.load_cookie(cookie_value)
+
+    async def store(self) -> Optional[str]:
+        await self.save()
+        cookie_value = self.dump_cookie()
+        if len(cookie_value) > MAX_COOKIE_SIZE:
+            ctx.log.error("session cookie of %d bytes exceeds the %d bytes limit",
+                          len(cookie_value), MAX_COOKIE_SIZE)
+        return cookie_value
+
+    async def refresh(self) -> Optional[str]:
+        """
+        reissues the cookie at most once per touch_interval() seconds
+        to keep an unmodified session alive
+        """
+        if (now() - self.updated_at).total_seconds() < touch_interval():
+            return None
+        return await self.store()
+
+
+SessionType = Union[BaseSession, BaseCookieSession]
+
+
+class SessionSweeper:
+    """
+    removes expired sessions in background at most once per interval,
+    for setups where the TTL index is not enough (e.g. it can't be
+    created or removes sessions too slowly)
+    """
+
+    def __init__(self, session_class: Type[BaseSession], interval: int):
+        self.session_class = session_class
+        self.interval = interval
+        self.last_run = None
+        self._task = None
 
-def create_session_middleware(session_class: Type[BaseSession]):
+    def maybe_run(self):
+        if self._task is not None and not self._task.done():
+            return
+        t = monotonic()
+        if self.last_run is not None and t - self.last_run < self.interval:
+            return
+        self.last_run = t
+        self._task = asyncio.ensure_future(self.sweep())
+
+    async def sweep(self):
+        try:
+            removed = await self.session_class.cleanup()
+        except Exception as e:
+            ctx.log.error("error cleaning up expired sessions: %s", e)
+            return
+        if removed:
+            ctx.log.debug("%d expired sessions removed", removed)
+
+
+class SessionLoader:
+    """
+    loads the request session on first demand, so requests which never
+    acquire the session (e.g. token-authenticated ones) cost nothing
+    """
+
+    def __init__(self, request: Request, session_class: Type[SessionType], cookie_name: str):
+        self.request = request
+        self.session_class = session_class
+        self.cookie_name = cookie_name
+        self.session = None
+        self._loading = None
+
+    async def _load(self) -> SessionType:
+        session = None
+        cookie_value = self.request.cookies.get(self.cookie_name)
+        with span("session.load", session_class=self.session_class.__name__):
+            if cookie_value:
+                session = await self.session_class.from_cookie(cookie_value)
+            if not session:
+                session = self.session_class.new()
+        self.session = session
+        return session
+
+    async def load(self) -> SessionType:
+        if self.session is not None:
+            return self.session
+        # concurrent callers share the same lookup
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+        return await self._loading
+
+
+def create_session_middleware(session_class: Type[SessionType], cleanup_interval: int = None):
+    """
+    :param cleanup_interval: if set, expired sessions are removed in background
+                             at most once per cleanup_interval seconds
+    """
     cookie_name = ctx.cfg.get("session_cookie_name", "_uengine_sid")
+    sweeper = None
+    if cleanup_interval and issubclass(session_class, BaseSession):
+        sweeper = SessionSweeper(session_class, cleanup_interval)
 
     async def session_middleware(
             request: Request,
             call_next):
-        session = None
-        cookie_sid = request.cookies.get(cookie_name)
+        loader = SessionLoader(request, session_class, cookie_name)
+        request.state.session_loader = loader
 
-        if cookie_sid:
-            session_id = read_session_id(cookie_sid)
-            if session_id:
-                session = await session_class.get(session_id)
+        response = await call_next(request)
 
-        if not session:
-            session_id, cookie_sid = generate_session_id()
-            session = session_class(sid=session_id)
+        session = loader.session
+        if session is not None:
+            with span("session.store", modified=session.modified):
+                if session.modified:
+                    cookie_value = await session.store()
+                else:
+                    cookie_value = await session.refresh()
+            if cookie_value:
+                response.set_cookie(cookie_name, cookie_value)
 
-        request.state.session = session
-        response = await call_next(request)
-        if session.modified:
-            await session.save()
+        if sweeper is not None:
+            sweeper.maybe_run()
 
-        response.set_cookie(cookie_name, cookie_sid)
         return response
 
     return session_middleware
 
 
-def acquire_session(request: Request) -> BaseSession:
-    return getattr(request.state, "session", None)
+async def acquire_session(request: Request) -> Optional[SessionType]:
+    loader = getattr(request.state, "session_loader", None)
+    if loader is None:
+        return None
+    return await loader.load()
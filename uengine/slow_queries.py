@@ -0,0 +1,128 @@
+import json
+import asyncio
+from bson import SON
+
+from . import ctx
+from .instrumentation import normalize_query
+
+DEFAULT_SLOW_QUERY_THRESHOLD = 0.1
+# the slow query log lines are "<prefix> <json record>" so that
+# they can be collected from the log files later on
+SLOW_QUERY_PREFIX = "slow db operation"
+SLOW_QUERY_EXPLAIN_PREFIX = "slow db operation explained"
+EXPLAINABLE_OPERATIONS = ("find", "find_one", "count")
+
+
+def slow_query_record(op) -> dict:
+    options = op.options or {}
+    return {
+        "operation": op.operation,
+        "collection": op.collection,
+        "shard_id": op.shard_id,
+        "filter": normalize_query(op.query) if op.query is not None else None,
+        "sort": options.get("sort") or None,
+        "skip": options.get("skip"),
+        "limit": options.get("limit"),
+        "duration_ms": round(op.duration * 1000, 1),
+    }
+
+
+def parse_slow_query_line(line: str):
+    """
+    :return: the record of a slow query log line or None for other lines
+    """
+    idx = line.find(SLOW_QUERY_PREFIX + " {")
+    if idx < 0:
+        return None
+    try:
+        return json.loads(line[idx + len(SLOW_QUERY_PREFIX) + 1:])
+    except ValueError:
+        return None
+
+
+def explain_command(op) -> SON:
+    """
+    the command explaining a find or count the same way it was made
+    """
+    if op.operation == "count":
+        return SON([("count", op.collection), ("query", op.query or {})])
+    command = SON([("find", op.collection), ("filter", op.query or {})])
+    options = op.options or {}
+    if options.get("sort"):
+        command["sort"] = SON(options["sort"])
+    if options.get("skip"):
+        command["skip"] = options["skip"]
+    if op.operation == "find_one":
+        command["limit"] = 1
+    elif options.get("limit"):
+        command["limit"] = options["limit"]
+    return command
+
+
+def _plan_stages(plan) -> set:
+    stages = set()
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.add(plan["stage"])
+        for value in plan.values():
+            stages |= _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            stages |= _plan_stages(item)
+    return stages
+
+
+def summarize_explain(result: dict) -> dict:
+    """
+    picks the numbers telling whether a query is served by an index
+    from an explain("executionStats") result
+    """
+    stats = result.get("executionStats", {})
+    stages = _plan_stages(result.get("queryPlanner", {}).get("winningPlan", {}))
+    return {
+        "docs_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "returned": stats.get("nReturned"),
+        "collection_scan": "COLLSCAN" in stages,
+        "in_memory_sort": "SORT" in stages,
+    }
+
+
+class SlowQueryLog:
+    """
+    db observer logging the operations slower than threshold seconds
+    with their normalized filter, sort, skip and limit. With explain set
+    the first slow operation of every shape is also explained, which
+    tells collection scans and in-memory sorts apart from the operations
+    which are just slow
+    """
+
+    def __init__(self, threshold: float = DEFAULT_SLOW_QUERY_THRESHOLD, explain: bool = False):
+        self.threshold = threshold
+        self.explain = explain
+        # shape -> summary of its explain result
+        self.explained = {}
+
+    def __call__(self, op):
+        if op.duration < self.threshold:
+            return
+        record = slow_query_record(op)
+        ctx.log.warning("%s %s", SLOW_QUERY_PREFIX, json.dumps(record, default=str))
+        if not self.explain or op.error is not None or op.operation not in EXPLAINABLE_OPERATIONS:
+            return
+        shape = json.dumps([record[key] for key in ("operation", "collection", "filter", "sort")], default=str)
+        if shape not in self.explained:
+            self.explained[shape] = None
+            asyncio.ensure_future(self.run_explain(op, record, shape))
+
+    async def run_explain(self, op, record, shape):
+        shard = ctx.db.get_shard(op.shard_id) if op.shard_id else ctx.db.meta
+        try:
+            result = await shard.ro_conn.command("explain", explain_command(op), verbosity="executionStats")
+        except Exception as e:  # pylint: disable=broad-except
+            ctx.log.error("error explaining %s on %s: %s", op.operation, op.collection, e)
+            return
+        summary = summarize_explain(result)
+        self.explained[shape] = summary
+        record.update(summary)
+        ctx.log.warning("%s %s", SLOW_QUERY_EXPLAIN_PREFIX, json.dumps(record, default=str))
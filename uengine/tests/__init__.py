@@ -1,4 +1,16 @@
 from .test_abstract_model import TestAbstractModel
 from .test_storable_model import TestStorableModel
 from .test_sharded_model import TestShardedModel
-from .test_submodel import TestStorableSubmodel
\ No newline at end of file
+from .test_submodel import TestStorableSubmodel
+from .test_api import TestKeysetHelpers, TestTransformItems, TestPaginated
+from .test_utils import TestGatherOrCancel
+from .test_json import TestJson
+from .test_sessions import TestSessions, TestCookieSession
+from .test_executor import TestBoundedExecutor
+from .test_log import TestLog
+from .test_instrumentation import TestInstrumentation, TestDBInstrumentation
+from .test_metrics import TestMetrics
+from .test_tracing import TestTracing
+from .test_nplusone import TestNPlusOne
+from .test_slow_queries import TestSlowQueries
+from .test_index_advisor import TestIndexAdvisor
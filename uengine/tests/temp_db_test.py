@@ -1,12 +1,76 @@
 import asyncio
+from contextlib import contextmanager
 from string import ascii_lowercase
 from random import choice
 from unittest import TestCase
 from uengine import ctx
+from uengine.context import ContextError
 from uengine.db import DB
+from uengine.instrumentation import add_db_observer, remove_db_observer
 
 TEMP_DB_PREFIX_LENGTH = 5
 
+# db operations grouped into the types the query assertions count
+QUERY_TYPES = {
+    "find": "find",
+    "find_one": "find",
+    "get_more": "find",
+    "distinct": "find",
+    "aggregate": "find",
+    "insert": "insert",
+    "update": "update",
+    "delete": "delete",
+    "count": "count",
+}
+
+
+def replace_config(cfg: dict):
+    """
+    sets ctx.cfg for a test case
+    :return: the previous config to pass to restore_config() afterwards
+    """
+    try:
+        previous = ctx.cfg
+    except ContextError:
+        previous = None
+    else:
+        del ctx.cfg
+    ctx.cfg = cfg
+    return previous
+
+
+def restore_config(previous):
+    try:
+        del ctx.cfg
+    except AttributeError:
+        pass
+    if previous is not None:
+        ctx.cfg = previous
+
+
+class QueryCounter:
+    """
+    collects the db operations made while active, on all the shards
+    """
+
+    def __init__(self):
+        self.ops = []
+
+    def __call__(self, op):
+        self.ops.append(op)
+
+    def count(self, query_type: str = None) -> int:
+        if query_type is None:
+            return len(self.ops)
+        return sum(1 for op in self.ops if QUERY_TYPES.get(op.operation, op.operation) == query_type)
+
+    def describe(self) -> str:
+        lines = []
+        for op in self.ops:
+            collection = f"{op.shard_id}.{op.collection}" if op.shard_id else op.collection
+            lines.append(f"  {op.operation} {collection} {op.query}")
+        return "\n".join(lines)
+
 
 class TemporaryDatabaseTest(TestCase):
 
@@ -40,6 +104,35 @@ class TemporaryDatabaseTest(TestCase):
         }
         ctx.db = DB()
 
+    @contextmanager
+    def assertMaxQueries(self, total: int = None, **limits):  # pylint: disable=invalid-name
+        """
+        fails if the block makes more db operations than allowed, e.g.
+        with self.assertMaxQueries(3): ... or with self.assertMaxQueries(find=1, update=0): ...
+        :param total: limit for all the operations
+        :param limits: limits per query type: find, insert, update, delete, count
+        """
+        unknown = set(limits) - set(QUERY_TYPES.values())
+        if unknown:
+            raise ValueError(f"unknown query types {unknown}")
+
+        counter = QueryCounter()
+        add_db_observer(counter)
+        try:
+            yield counter
+        finally:
+            remove_db_observer(counter)
+
+        exceeded = []
+        if total is not None and counter.count() > total:
+            exceeded.append(f"{counter.count()} queries made, at most {total} expected")
+        for query_type, limit in limits.items():
+            count = counter.count(query_type)
+            if count > limit:
+                exceeded.append(f"{count} {query_type} queries made, at most {limit} expected")
+        if exceeded:
+            self.fail("; ".join(exceeded) + ":\n" + counter.describe())
+
     @classmethod
     def tearDownClass(cls) -> None:
         conns = [ctx.db.meta.conn] + [x.conn for x in ctx.db.shards.values()]
@@ -1,6 +1,9 @@
 import asyncio
 
+from bson import ObjectId
+
 from uengine.models.abstract_model import AbstractModel
+from uengine.models.serializer import limited, _serialization_limiter, MAX_CACHED_SERIALIZERS
 from uengine.errors import FieldRequired, InvalidFieldType
 from unittest import TestCase
 
@@ -94,3 +97,84 @@ class TestAbstractModel(TestCase):
         t = TestModel(field1="   a   \t", field2="b", field3="c")
         self.loop.run_until_complete(t.save())
         self.assertEqual(t.field1, "a")
+
+    def test_to_dict(self):
+        class SerializedModel(AbstractModel):
+            name: str = "name"
+            secret: str = "secret"
+            __restricted_fields__ = {"secret"}
+
+            @property
+            def upper_name(self):
+                return self.name.upper()
+
+            @property
+            async def async_name(self):
+                await asyncio.sleep(0)
+                return f"async {self.name}"
+
+            def method(self):
+                return None
+
+        model = SerializedModel(_id=ObjectId("5e1f5e5e5e5e5e5e5e5e5e5e"))
+        data = self.loop.run_until_complete(model.to_dict())
+        self.assertDictEqual(data, {"_id": "5e1f5e5e5e5e5e5e5e5e5e5e", "name": "name"})
+
+        fields = ["async_name", "name", "upper_name", "method", "secret", "missing"]
+        data = self.loop.run_until_complete(model.to_dict(fields=fields))
+        self.assertDictEqual(data, {"name": "name", "upper_name": "NAME", "async_name": "async name"})
+
+        data = self.loop.run_until_complete(model.to_dict(fields=["name", "secret"], include_restricted=True))
+        self.assertDictEqual(data, {"name": "name", "secret": "secret"})
+
+        serializer = SerializedModel.get_serializer(fields)
+        self.assertIs(serializer, SerializedModel.get_serializer(list(fields)))
+        self.assertFalse(serializer.all_plain)
+        self.assertTrue(SerializedModel.get_serializer(["name", "_id"]).all_plain)
+
+    def test_nested_limited(self):
+        active = 0
+        max_active = 0
+
+        async def leaf():
+            nonlocal active, max_active
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.001)
+            active -= 1
+
+        async def parent():
+            await asyncio.gather(*[limited(leaf()) for _ in range(5)])
+
+        async def serialize():
+            _serialization_limiter.set(asyncio.Semaphore(2))
+            await asyncio.gather(*[limited(parent()) for _ in range(4)])
+            return _serialization_limiter.get()
+
+        # parents waiting for their children give their slots away
+        # instead of deadlocking, children still go through the limiter
+        limiter = self.loop.run_until_complete(asyncio.wait_for(serialize(), 5))
+        self.assertEqual(max_active, 2)
+        self.assertFalse(limiter.locked())
+        self.assertEqual(limiter._value, 2)  # pylint: disable=protected-access
+
+    def test_serializers_cache(self):
+        class CachedModel(AbstractModel):
+            name: str = "name"
+            value: int = 0
+
+        first = CachedModel.get_serializer(["name", "value"])
+        self.assertIs(CachedModel.get_serializer(["name", "value"]), first)
+        # a permutation reuses the compiled steps in its own order
+        second = CachedModel.get_serializer(["value", "name", "value"])
+        self.assertListEqual([step[0] for step in second.steps], ["value", "name"])
+        self.assertEqual(len(CachedModel.__serializers__), 2)
+        # the cache is bounded
+        for idx in range(MAX_CACHED_SERIALIZERS + 10):
+            CachedModel.get_serializer([f"name[:{idx}]"])
+        self.assertEqual(len(CachedModel.__serializers__), MAX_CACHED_SERIALIZERS)
+
+        model = CachedModel(name="cached", value=1)
+        model.extra = "instance attribute"
+        data = self.loop.run_until_complete(model.to_dict(fields=["value", "missing", "name", "extra"]))
+        self.assertListEqual(list(data.items()), [("value", 1), ("name", "cached"), ("extra", "instance attribute")])
@@ -0,0 +1,304 @@
+import asyncio
+import json
+from unittest import TestCase
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+
+from uengine.api import (keyset_sort, keyset_query, encode_keyset_cursor, decode_keyset_cursor,
+                         paginated, streamed, transform_items, fields_param, PaginationParams, CountMode, StreamFormat)
+from uengine import ctx
+from uengine.errors import InputDataError
+from uengine.models.abstract_model import AbstractModel
+from uengine.models import Relation
+from uengine.models.serializer import DEFAULT_SERIALIZATION_CONCURRENCY, parse_field_spec, parse_fields, select_subfields
+from uengine.models.storable_model import StorableModel
+from uengine.utils import now
+from .temp_db_test import TemporaryDatabaseTest
+
+
+class TestKeysetHelpers(TestCase):
+
+    def test_keyset_sort(self):
+        self.assertListEqual(keyset_sort([("name", ASCENDING)]), [("name", ASCENDING), ("_id", ASCENDING)])
+        self.assertListEqual(keyset_sort([("_id", DESCENDING)]), [("_id", DESCENDING)])
+
+    def test_cursor_roundtrip(self):
+        values = ["username", now(), ObjectId()]
+        cursor = encode_keyset_cursor(values)
+        self.assertListEqual(decode_keyset_cursor(cursor, 3), values)
+        with self.assertRaises(InputDataError):
+            decode_keyset_cursor(cursor, 2)
+        with self.assertRaises(InputDataError):
+            decode_keyset_cursor("garbage", 3)
+
+    def test_keyset_query(self):
+        query = keyset_query([("name", ASCENDING), ("age", DESCENDING), ("_id", ASCENDING)], ["a", 3, 1])
+        self.assertDictEqual(query, {
+            "$or": [
+                {"name": {"$gt": "a"}},
+                {"name": "a", "$or": [{"age": {"$lt": 3}}, {"age": None}]},
+                {"name": "a", "age": 3, "_id": {"$gt": 1}},
+            ]
+        })
+
+    def test_keyset_query_nulls(self):
+        query = keyset_query([("name", ASCENDING), ("age", DESCENDING), ("_id", ASCENDING)], [None, None, 1])
+        self.assertDictEqual(query, {
+            "$or": [
+                {"name": {"$ne": None}},
+                {"name": None, "age": None, "_id": {"$gt": 1}},
+            ]
+        })
+
+
+class TransformedModel(AbstractModel):
+    name: str
+
+    running = 0
+    max_running = 0
+
+    @property
+    async def async_name(self):
+        await asyncio.sleep(0)
+        return f"async {self.name}"
+
+    @property
+    async def tracked_name(self):
+        cls = self.__class__
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        await asyncio.sleep(0.001)
+        cls.running -= 1
+        return self.name
+
+    @property
+    async def nested(self):
+        # serializing other models while holding a limiter slot must not deadlock
+        children = [TransformedModel(name=f"{self.name}.{idx}") for idx in range(3)]
+        return [await child.to_dict(fields=["tracked_name"]) for child in children]
+
+
+class TestTransformItems(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def test_sync_fields(self):
+        items = [TransformedModel(name=f"item{idx}") for idx in range(5)]
+        result = self.loop.run_until_complete(transform_items(items, ["name"]))
+        self.assertListEqual(result, [{"name": f"item{idx}"} for idx in range(5)])
+
+    def test_async_fields(self):
+        items = [TransformedModel(name=f"item{idx}") for idx in range(5)]
+        result = self.loop.run_until_complete(transform_items(items, ["name", "async_name"]))
+        self.assertListEqual(result, [{"name": f"item{idx}", "async_name": f"async item{idx}"} for idx in range(5)])
+
+    def test_custom_transform(self):
+        async def transform(item, fields):
+            return {"fields": fields, "name": item.name}
+
+        items = [TransformedModel(name="item")]
+        result = self.loop.run_until_complete(transform_items(items, ["name"], transform))
+        self.assertListEqual(result, [{"fields": ["name"], "name": "item"}])
+
+    def test_stream_error(self):
+        class FailingCursor:
+            @staticmethod
+            async def batches():
+                yield [TransformedModel(name="item")]
+                raise KeyError("x")
+
+        chunks = []
+
+        async def scenario():
+            async for chunk in streamed(FailingCursor(), StreamFormat.json, fields=["name"]).body_iterator:
+                chunks.append(chunk)
+
+        with self.assertLogs(level="ERROR") as logs:
+            with self.assertRaises(KeyError):
+                self.loop.run_until_complete(scenario())
+        self.assertIn("error streaming", logs.records[0].getMessage())
+        self.assertListEqual(chunks, [b"[", b'{"name":"item"}'])
+
+    def test_bounded_concurrency(self):
+        items = [TransformedModel(name=f"item{idx}") for idx in range(DEFAULT_SERIALIZATION_CONCURRENCY * 3)]
+        TransformedModel.max_running = 0
+        result = self.loop.run_until_complete(transform_items(items, ["tracked_name"]))
+        self.assertListEqual(result, [{"tracked_name": item.name} for item in items])
+        self.assertGreater(TransformedModel.max_running, 1)
+        self.assertLessEqual(TransformedModel.max_running, DEFAULT_SERIALIZATION_CONCURRENCY)
+
+    def test_nested_serialization(self):
+        items = [TransformedModel(name=f"item{idx}") for idx in range(DEFAULT_SERIALIZATION_CONCURRENCY * 2)]
+        result = self.loop.run_until_complete(asyncio.wait_for(transform_items(items, ["nested"]), 5))
+        self.assertListEqual(result[0]["nested"], [{"tracked_name": f"item0.{idx}"} for idx in range(3)])
+
+    def test_field_specs(self):
+        self.assertTupleEqual(parse_field_spec("members"), ("members", None))
+        self.assertTupleEqual(parse_field_spec("members[:20]"), ("members", 20))
+        self.assertListEqual(fields_param("name,members[:20]"), ["name", "members[:20]"])
+        with self.assertRaises(InputDataError):
+            fields_param("name,members[1:20]")
+
+    def test_dotted_fields(self):
+        fields = ["name", "owner.username", "owner.email", "members[:5].email", "group", "group.name"]
+        self.assertListEqual(parse_fields(fields), [
+            ("name", None, None),
+            ("owner", None, ["username", "email"]),
+            ("members", 5, ["email"]),
+            ("group", None, None),
+        ])
+        value = {"a": 1, "b": {"c": 2, "d": 3}, "e": [{"f": 4, "g": 5}]}
+        self.assertDictEqual(select_subfields(value, ["b.c", "e.f"]), {"b": {"c": 2}, "e": [{"f": 4}]})
+
+
+class PaginatedModel(StorableModel):
+    name: str
+    group: int = 0
+
+    @property
+    def same_group(self):
+        return PaginatedModel.find({"group": self.group}).sort("name")
+
+
+class LinkedModel(StorableModel):
+    title: str
+    main_id: ObjectId = None
+    linked_ids: list = []
+
+    __relations__ = {
+        "main": Relation("main_id", PaginatedModel),
+        "linked": Relation("linked_ids", PaginatedModel, many=True),
+    }
+
+
+class TestPaginated(TemporaryDatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        super().setUp()
+        self.loop.run_until_complete(PaginatedModel.destroy_all())
+        for idx in range(25):
+            model = PaginatedModel(name=f"model{idx:02d}", group=idx % 3)
+            self.loop.run_until_complete(model.save())
+
+    def test_keyset(self):
+        names = []
+        cursor = ""
+        while cursor is not None:
+            data = PaginatedModel.find().sort([("group", DESCENDING), ("name", ASCENDING)])
+            pagination = PaginationParams(limit=10, page=1, nopaging=False, cursor=cursor)
+            result = self.loop.run_until_complete(paginated(data, pagination=pagination))
+            self.assertLessEqual(len(result["data"]), 10)
+            self.assertEqual(result["count"], 25)
+            names.extend(item["name"] for item in result["data"])
+            cursor = result["next"]
+            self.assertEqual(result["has_more"], cursor is not None)
+
+        expected = sorted([f"model{idx:02d}" for idx in range(25)], key=lambda n: (-(int(n[5:]) % 3), n))
+        self.assertListEqual(names, expected)
+
+    def test_keyset_missing_sort_field(self):
+        class OptionalModel(StorableModel):
+            __collection__ = "paginated_model"
+            name: str
+            rank: int = None
+
+        async def prepare():
+            # documents lacking the sort field entirely, not only null ones
+            await ctx.db.meta.conn["paginated_model"].update_many({"group": 1}, {"$set": {"rank": 1}})
+            await ctx.db.meta.conn["paginated_model"].update_many({"group": 2}, {"$set": {"rank": None}})
+
+        self.loop.run_until_complete(prepare())
+        for direction in (ASCENDING, DESCENDING):
+            names = []
+            cursor = ""
+            while cursor is not None:
+                data = OptionalModel.find().sort([("rank", direction), ("name", ASCENDING)])
+                pagination = PaginationParams(limit=4, page=1, nopaging=False, cursor=cursor)
+                result = self.loop.run_until_complete(paginated(data, pagination=pagination))
+                names.extend(item["name"] for item in result["data"])
+                cursor = result["next"]
+            self.assertCountEqual(names, [f"model{idx:02d}" for idx in range(25)])
+            self.assertEqual(len(names), 25)
+
+    def test_count_modes(self):
+        def get_page(page, count):
+            data = PaginatedModel.find({"group": {"$lt": 2}}).sort("name")
+            pagination = PaginationParams(limit=10, page=page, nopaging=False, cursor=None, count=count)
+            return self.loop.run_until_complete(paginated(data, pagination=pagination))
+
+        result = get_page(1, CountMode.exact)
+        self.assertEqual(result["count"], 17)
+        self.assertEqual(result["total_pages"], 2)
+        self.assertTrue(result["has_more"])
+
+        result = get_page(2, CountMode.estimated)
+        self.assertEqual(result["count"], 17)
+        self.assertEqual(len(result["data"]), 7)
+        self.assertFalse(result["has_more"])
+        self.assertFalse(result["count_capped"])
+
+        ctx.cfg["estimated_count_limit"] = 15
+        try:
+            result = get_page(1, CountMode.estimated)
+        finally:
+            del ctx.cfg["estimated_count_limit"]
+        self.assertEqual(result["count"], 15)
+        self.assertTrue(result["count_capped"])
+        self.assertIsNone(result["total_pages"])
+
+        result = get_page(1, CountMode.none)
+        self.assertIsNone(result["count"])
+        self.assertIsNone(result["total_pages"])
+        self.assertEqual(len(result["data"]), 10)
+        self.assertTrue(result["has_more"])
+
+    def test_stream(self):
+        async def read_body(response):
+            return b"".join([chunk async for chunk in response.body_iterator])
+
+        for stream_format in StreamFormat:
+            data = PaginatedModel.find().sort("name")
+            pagination = PaginationParams(limit=10, page=1, nopaging=True, stream=stream_format)
+            response = self.loop.run_until_complete(paginated(data, pagination=pagination, fields=["name"]))
+            body = self.loop.run_until_complete(read_body(response)).decode()
+            if stream_format == StreamFormat.ndjson:
+                items = [json.loads(line) for line in body.splitlines()]
+            else:
+                items = json.loads(body)
+            self.assertListEqual(items, [{"name": f"model{idx:02d}"} for idx in range(25)])
+
+    def test_cursor_field_limit(self):
+        model = self.loop.run_until_complete(PaginatedModel.find_one({"name": "model00"}))
+        data = self.loop.run_until_complete(model.to_dict(fields=["name", "same_group[:3]"]))
+        self.assertListEqual([item["name"] for item in data["same_group"]], ["model00", "model03", "model06"])
+
+    def test_relations(self):
+        self.loop.run_until_complete(LinkedModel.destroy_all())
+        models = self.loop.run_until_complete(PaginatedModel.find().sort("name").all())
+        for idx in range(3):
+            linked = LinkedModel(title=f"linked{idx}", main_id=models[idx]._id,
+                                 linked_ids=[m._id for m in models[idx:idx + 4]])
+            self.loop.run_until_complete(linked.save())
+
+        data = LinkedModel.find().sort("title")
+        pagination = PaginationParams(limit=10, page=1, nopaging=False)
+        fields = ["title", "main.name", "linked[:2].name", "linked.group"]
+        result = self.loop.run_until_complete(paginated(data, pagination=pagination, fields=fields))
+        self.assertDictEqual(result["data"][1], {
+            "title": "linked1",
+            "main": {"name": "model01"},
+            "linked": [{"name": "model01", "group": 1}, {"name": "model02", "group": 2}],
+        })
+
+        # a single object's relation is limited by the query
+        linked = self.loop.run_until_complete(LinkedModel.find_one({"title": "linked2"}))
+        data = self.loop.run_until_complete(linked.to_dict(fields=["linked[:3].name"]))
+        self.assertListEqual([item["name"] for item in data["linked"]], ["model02", "model03", "model04"])
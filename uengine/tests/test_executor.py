@@ -0,0 +1,72 @@
+import asyncio
+import threading
+from unittest import TestCase
+
+from uengine.errors import ServiceOverloaded
+from uengine.executor import BoundedExecutor
+
+
+class TestBoundedExecutor(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        self.executor = BoundedExecutor("test", max_workers=2, max_queue=1)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_run(self):
+        result = self.loop.run_until_complete(self.executor.run(pow, 2, 10))
+        self.assertEqual(result, 1024)
+        stats = self.executor.stats()
+        self.assertEqual(stats["completed"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_error(self):
+        with self.assertRaises(ZeroDivisionError):
+            self.loop.run_until_complete(self.executor.run(divmod, 1, 0))
+        self.assertEqual(self.executor.stats()["failed"], 1)
+
+    def test_overload(self):
+        release = threading.Event()
+
+        async def scenario():
+            # 2 running, 1 queued
+            tasks = [asyncio.ensure_future(self.executor.run(release.wait, 5)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            self.assertEqual(self.executor.in_progress, 2)
+            self.assertEqual(self.executor.queue_depth, 1)
+            with self.assertRaises(ServiceOverloaded):
+                await self.executor.run(release.wait, 5)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+        results = self.loop.run_until_complete(scenario())
+        self.assertListEqual(results, [True, True, True])
+        stats = self.executor.stats()
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["completed"], 3)
+        self.assertEqual(stats["max_queue_depth"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_cancel(self):
+        release = threading.Event()
+
+        async def scenario():
+            tasks = [asyncio.ensure_future(self.executor.run(release.wait, 5)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            for task in tasks:
+                task.cancel()
+            await asyncio.sleep(0.05)
+            # the running calls keep their threads busy, the queued one is dropped
+            self.assertEqual(self.executor.in_progress, 2)
+            self.assertEqual(self.executor.queue_depth, 0)
+            release.set()
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(scenario())
+        self.assertEqual(self.executor.stats()["queue_depth"], 0)
+        self.assertEqual(self.executor.stats()["in_progress"], 0)
@@ -0,0 +1,95 @@
+import os
+import tempfile
+from unittest import TestCase
+from bson import SON
+
+from uengine.instrumentation import DBOperation
+from uengine.index_advisor import QueryShapeRecorder, query_fields, advise, load_shapes, group_by_collection
+from uengine.models.abstract_model import AbstractModel
+
+
+class AdvisedModel(AbstractModel):
+    __indexes__ = (
+        ["username", {"unique": True}],
+        "owner_id",
+        ["owner_id", "-created_at"],
+        "updated_at",
+    )
+
+
+def make_op(query, operation="find", sort=None, collection="groups"):
+    return DBOperation(operation, collection, None, query, 0.001, None, {"sort": sort} if sort else None)
+
+
+def db_index(name, *keys, **options):
+    return dict(name=name, key=SON(keys), v=2, **options)
+
+
+class TestIndexAdvisor(TestCase):
+
+    def test_query_fields(self):
+        self.assertListEqual(
+            query_fields({"owner_id": "?", "created_at": {"$gt": "?"}, "member_ids": {"$in": "?"}}),
+            [(["owner_id", "member_ids"], ["created_at"])]
+        )
+        self.assertListEqual(
+            query_fields({"a": "?", "$or": [{"b": "?"}, {"c": {"$regex": "?"}}]}),
+            [(["a", "b"], []), (["a"], ["c"])]
+        )
+        self.assertListEqual(query_fields({"$and": [{"a": "?"}, {"b": {"$lt": "?"}}]}), [(["a"], ["b"])])
+
+    def test_recorder(self):
+        recorder = QueryShapeRecorder()
+        recorder(make_op({"owner_id": 1}, sort=[("created_at", -1)]))
+        recorder(make_op({"owner_id": 2}, sort=[("created_at", -1)]))
+        recorder(make_op(None, "insert"))
+        recorder(make_op([{"$match": {"name": "x"}}, {"$sort": {"name": 1}}], "aggregate"))
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "shapes.jsonl")
+            recorder.dump(filename)
+            records = load_shapes(filename)
+        self.assertListEqual(records, [
+            {"collection": "groups", "filter": {"owner_id": "?"}, "sort": [["created_at", -1]], "count": 2},
+            {"collection": "groups", "filter": {"name": "?"}, "sort": [["name", 1]], "count": 1},
+        ])
+        self.assertListEqual(list(group_by_collection(records)), ["groups"])
+
+    def test_advise_declared(self):
+        records = [
+            # served by owner_id, -created_at walked backwards
+            {"collection": "groups", "filter": {"owner_id": "?"}, "sort": [["created_at", 1]], "count": 3},
+            # unindexed filter and sort
+            {"collection": "groups", "filter": {"name": {"$regex": "?"}, "system": "?"},
+             "sort": [["name", 1]], "count": 5},
+            {"collection": "groups", "filter": {"_id": "?"}, "sort": None, "count": 10},
+        ]
+        advice = advise(records, AdvisedModel.index_specs(), None)
+        self.assertListEqual(advice["missing"], [
+            ((("system", 1), ("name", 1)), {"name": {"$regex": "?"}, "system": "?"}, [["name", 1]], 5),
+        ])
+        # unique indexes are kept for the constraint
+        self.assertListEqual([index.keys for index in advice["unused"]], [(("updated_at", 1),)])
+        self.assertListEqual(
+            [(index.keys, covering.keys) for index, covering in advice["redundant"]],
+            [((("owner_id", 1),), (("owner_id", 1), ("created_at", -1)))]
+        )
+        self.assertListEqual(advice["not_created"], [])
+
+    def test_advise_existing(self):
+        existing = [
+            db_index("_id_", ("_id", 1)),
+            db_index("username_1", ("username", 1), unique=True),
+            db_index("owner_id_1", ("owner_id", 1)),
+            db_index("legacy_1", ("legacy", 1)),
+        ]
+        records = [{"collection": "groups", "filter": {"updated_at": {"$gt": "?"}}, "sort": None, "count": 1}]
+        advice = advise(records, AdvisedModel.index_specs(), existing)
+        # only the existing indexes serve queries
+        self.assertListEqual([entry[0] for entry in advice["missing"]], [(("updated_at", 1),)])
+        self.assertCountEqual(
+            [index.keys for index in advice["not_created"]],
+            [(("owner_id", 1), ("created_at", -1)), (("updated_at", 1),)]
+        )
+        self.assertListEqual([index.keys for index in advice["undeclared"]], [(("legacy", 1),)])
+        self.assertCountEqual([index.keys for index in advice["unused"]], [(("owner_id", 1),), (("legacy", 1),)])
@@ -0,0 +1,141 @@
+import asyncio
+from unittest import TestCase
+from starlette.requests import Request
+from starlette.responses import Response
+
+from uengine.instrumentation import track_db_op, add_db_observer, remove_db_observer, \
+    create_instrumentation_middleware, current_request_stats
+from uengine.models.storable_model import StorableModel
+from .temp_db_test import TemporaryDatabaseTest, replace_config, restore_config
+
+
+class InstrumentedModel(StorableModel):
+    __collection__ = "instrumented"
+    value: int = 0
+
+
+def make_request():
+    return Request({"type": "http", "method": "GET", "path": "/things", "headers": []})
+
+
+class TestInstrumentation(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.saved_cfg = replace_config({"access_log": False})
+        cls.loop = asyncio.get_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        restore_config(cls.saved_cfg)
+
+    def test_observers(self):
+        ops = []
+        add_db_observer(ops.append)
+        try:
+            with track_db_op("find", "users", "s1", {"a": 1}):
+                pass
+            with self.assertRaises(KeyError):
+                with track_db_op("find_one", "users"):
+                    raise KeyError("x")
+        finally:
+            remove_db_observer(ops.append)
+        with track_db_op("find", "users"):
+            pass
+
+        self.assertEqual(len(ops), 2)
+        self.assertEqual(ops[0].operation, "find")
+        self.assertEqual(ops[0].shard_id, "s1")
+        self.assertDictEqual(ops[0].query, {"a": 1})
+        self.assertIsNone(ops[0].error)
+        self.assertIsInstance(ops[1].error, KeyError)
+
+    def test_server_timing(self):
+        ops = [("find", "users", None), ("find", "users", None), ("count", "groups", "s1")]
+
+        async def call_next(_):
+            for operation, collection, shard_id in ops:
+                with track_db_op(operation, collection, shard_id):
+                    pass
+            self.assertEqual(current_request_stats().db_count, 3)
+            return Response("ok")
+
+        middleware = create_instrumentation_middleware()
+        response = self.loop.run_until_complete(middleware(make_request(), call_next))
+        header = response.headers["Server-Timing"]
+        self.assertIn('db;desc="3 ops"', header)
+        self.assertIn('db.users;desc="2 ops"', header)
+        self.assertIn('db.s1.groups;desc="1 ops"', header)
+        self.assertIn("total;dur=", header)
+        self.assertIsNone(current_request_stats())
+
+
+class TestDBInstrumentation(TemporaryDatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        self.loop.run_until_complete(InstrumentedModel.destroy_all())
+        self.ops = []
+        add_db_observer(self.ops.append)
+
+    def tearDown(self):
+        remove_db_observer(self.ops.append)
+
+    def operations(self):
+        return [(op.operation, op.collection) for op in self.ops]
+
+    def test_model_operations(self):
+        async def scenario():
+            model = InstrumentedModel(value=1)
+            await model.save()
+            model.value = 2
+            await model.save()
+            await InstrumentedModel.find_one({"_id": model._id})
+            await InstrumentedModel.find().all()
+            await InstrumentedModel.find().count()
+            await model.destroy()
+
+        self.ops.clear()
+        self.loop.run_until_complete(scenario())
+        self.assertListEqual(self.operations(), [
+            ("insert", "instrumented"),
+            ("update", "instrumented"),
+            ("find_one", "instrumented"),
+            ("find", "instrumented"),
+            ("count", "instrumented"),
+            ("delete", "instrumented"),
+        ])
+
+    def test_cursor_iteration(self):
+        async def scenario():
+            for idx in range(5):
+                await InstrumentedModel(value=idx).save()
+            self.ops.clear()
+            cursor = InstrumentedModel.find()
+            cursor.batch_size(2)
+            return [obj async for obj in cursor]
+
+        objs = self.loop.run_until_complete(scenario())
+        self.assertEqual(len(objs), 5)
+        # one round trip per batch, not per document
+        self.assertEqual(self.operations(), [("find", "instrumented")] + [("get_more", "instrumented")] * 2)
+
+    def test_buffered_batches(self):
+        async def scenario():
+            for idx in range(5):
+                await InstrumentedModel(value=idx).save()
+            self.ops.clear()
+            cursor = InstrumentedModel.find().batch_size(10)
+            # the second batch comes from the documents the first round trip got
+            first = await cursor._fetch_batch(2)  # pylint: disable=protected-access
+            second = await cursor._fetch_batch(2)  # pylint: disable=protected-access
+            rest = await cursor.all()
+            return first + second + rest
+
+        objs = self.loop.run_until_complete(scenario())
+        self.assertEqual(len(objs), 5)
+        self.assertEqual(self.operations(), [("find", "instrumented")])
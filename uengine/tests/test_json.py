@@ -0,0 +1,58 @@
+import json
+from datetime import datetime
+from enum import Enum, IntEnum
+from unittest import TestCase
+
+from bson import ObjectId, Timestamp
+from uengine.json import jsonable, dumps, JSONABLE_CONVERTERS, JSON_ENCODERS, MAX_TABLE_SIZE
+
+
+class Color(Enum):
+    red = "red"
+
+
+class Level(IntEnum):
+    high = 2
+
+
+class TestJson(TestCase):
+
+    def test_jsonable(self):
+        oid = ObjectId()
+        data = {"id": oid, "ts": Timestamp(100, 1), "items": ({"x": oid}, {1, 2}), "level": Level.high}
+        self.assertDictEqual(jsonable(data), {
+            "id": str(oid),
+            "ts": 100,
+            "items": [{"x": str(oid)}, [1, 2]],
+            "level": Level.high,
+        })
+
+    def test_dumps(self):
+        oid = ObjectId()
+        dt = datetime(2020, 1, 2, 3, 4, 5)
+        data = {"id": oid, "ts": Timestamp(100, 1), "dt": dt, "level": Level.high,
+                "color": Color.red, "tags": frozenset(["a"]), "name": "имя"}
+        encoded = dumps(data)
+        self.assertIsInstance(encoded, bytes)
+        self.assertDictEqual(json.loads(encoded), {
+            "id": str(oid),
+            "ts": 100,
+            "dt": "2020-01-02T03:04:05",
+            "level": 2,
+            "color": "red",
+            "tags": ["a"],
+            "name": "имя",
+        })
+
+    def test_dumps_unknown_type(self):
+        with self.assertRaises(TypeError):
+            dumps({"obj": object()})
+
+    def test_bounded_tables(self):
+        for idx in range(MAX_TABLE_SIZE * 2):
+            oid_type = type(f"CustomId{idx}", (ObjectId,), {})
+            oid = oid_type()
+            self.assertEqual(jsonable(oid), str(oid))
+            self.assertEqual(dumps(oid), f'"{oid}"'.encode())
+        self.assertLessEqual(len(JSONABLE_CONVERTERS), MAX_TABLE_SIZE)
+        self.assertLessEqual(len(JSON_ENCODERS), MAX_TABLE_SIZE)
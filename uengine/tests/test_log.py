@@ -0,0 +1,105 @@
+import queue
+import asyncio
+import logging
+from unittest import TestCase
+from starlette.requests import Request
+from starlette.responses import Response
+
+from uengine.log import DroppingQueueHandler, RequestIdFilter, request_id_var, request_id_middleware, \
+    create_queue_logging, DROP_OLD, REQUEST_ID_HEADER
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_record(msg):
+    return logging.LogRecord("test", logging.INFO, __file__, 0, msg, (), None)
+
+
+def make_request(headers=None):
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw_headers})
+
+
+class TestLog(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def queued_messages(self, log_queue):
+        messages = []
+        while not log_queue.empty():
+            messages.append(log_queue.get_nowait().getMessage())
+        return messages
+
+    def test_drop_new(self):
+        log_queue = queue.Queue(maxsize=2)
+        handler = DroppingQueueHandler(log_queue)
+        for idx in range(4):
+            handler.handle(make_record(f"m{idx}"))
+        self.assertEqual(handler.dropped, 2)
+        self.assertListEqual(self.queued_messages(log_queue), ["m0", "m1"])
+
+        # the drop is reported once there is room in the queue
+        handler.handle(make_record("m4"))
+        messages = self.queued_messages(log_queue)
+        self.assertEqual(messages[0], "m4")
+        self.assertIn("2 log records dropped", messages[1])
+
+    def test_drop_old(self):
+        log_queue = queue.Queue(maxsize=2)
+        handler = DroppingQueueHandler(log_queue, DROP_OLD)
+        for idx in range(4):
+            handler.handle(make_record(f"m{idx}"))
+        self.assertEqual(handler.dropped, 2)
+        self.assertListEqual(self.queued_messages(log_queue), ["m2", "m3"])
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            DroppingQueueHandler(queue.Queue(), "drop_everything")
+
+    def test_listener(self):
+        target = ListHandler()
+        queue_handler, listener = create_queue_logging([target])
+        logger = logging.getLogger("uengine_test_log")
+        logger.propagate = False
+        logger.addHandler(queue_handler)
+        logger.addFilter(RequestIdFilter())
+        token = request_id_var.set("req1")
+        try:
+            logger.warning("hello %s", "world")
+        finally:
+            request_id_var.reset(token)
+            listener.stop()
+            logger.removeHandler(queue_handler)
+        self.assertEqual(len(target.records), 1)
+        self.assertEqual(target.records[0].getMessage(), "hello world")
+        self.assertEqual(target.records[0].request_id, "req1")
+
+    def test_request_id_middleware(self):
+        seen = []
+
+        async def call_next(_):
+            seen.append(request_id_var.get())
+            return Response("ok")
+
+        response = self.loop.run_until_complete(request_id_middleware(make_request(), call_next))
+        self.assertEqual(response.headers[REQUEST_ID_HEADER], seen[0])
+        self.assertNotEqual(seen[0], "-")
+        self.assertEqual(request_id_var.get(), "-")
+
+        response = self.loop.run_until_complete(
+            request_id_middleware(make_request({REQUEST_ID_HEADER: "upstream-1"}), call_next))
+        self.assertEqual(response.headers[REQUEST_ID_HEADER], "upstream-1")
+
+        response = self.loop.run_until_complete(
+            request_id_middleware(make_request({REQUEST_ID_HEADER: "bad id\n"}), call_next))
+        self.assertNotEqual(response.headers[REQUEST_ID_HEADER], "bad id\n")
@@ -0,0 +1,89 @@
+import asyncio
+from unittest import TestCase
+
+from bson import ObjectId
+
+from uengine.instrumentation import DBOperation
+from uengine.json import dumps
+from uengine.metrics import MetricsRegistry, db_metrics_observer, monitor_event_loop_lag, \
+    DB_OPERATION_DURATION, DB_OPERATION_ERRORS, EVENT_LOOP_LAG, CACHE_REQUESTS
+from uengine.models.abstract_model import AbstractModel
+
+
+class TestMetrics(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        counter = self.registry.counter("things_total", "Things", ("kind",))
+        counter.inc("a")
+        counter.inc("a", amount=2)
+        counter.inc('b"\n')
+        self.assertEqual(counter.value("a"), 3)
+        text = self.registry.render()
+        self.assertIn("# TYPE things_total counter", text)
+        self.assertIn('things_total{kind="a"} 3', text)
+        self.assertIn('things_total{kind="b\\"\\n"} 1', text)
+
+    def test_duplicate(self):
+        self.registry.gauge("value", "Value")
+        with self.assertRaises(ValueError):
+            self.registry.counter("value", "Value")
+
+    def test_callback(self):
+        data = {("x",): 5}
+        self.registry.gauge("queue", "Queue", ("name",), callback=lambda: data)
+        self.assertIn('queue{name="x"} 5', self.registry.render())
+        data[("x",)] = 7
+        self.assertIn('queue{name="x"} 7', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe("/", value=value)
+        self.assertEqual(histogram.count("/"), 4)
+        text = self.registry.render()
+        self.assertIn('latency_seconds_bucket{route="/",le="0.1"} 2', text)
+        self.assertIn('latency_seconds_bucket{route="/",le="1"} 3', text)
+        self.assertIn('latency_seconds_bucket{route="/",le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_sum{route="/"} 3.65', text)
+        self.assertIn('latency_seconds_count{route="/"} 4', text)
+
+    def test_db_observer(self):
+        count = DB_OPERATION_DURATION.count("find", "metrics_test", "meta")
+        errors = DB_OPERATION_ERRORS.value("find", "metrics_test", "s1")
+        db_metrics_observer(DBOperation("find", "metrics_test", None, {}, 0.01, None))
+        db_metrics_observer(DBOperation("find", "metrics_test", "s1", {}, 0.01, KeyError()))
+        self.assertEqual(DB_OPERATION_DURATION.count("find", "metrics_test", "meta"), count + 1)
+        self.assertEqual(DB_OPERATION_ERRORS.value("find", "metrics_test", "s1"), errors + 1)
+
+    def test_cache_requests(self):
+        class MeteredModel(AbstractModel):
+            name: str = "name"
+
+        hits = CACHE_REQUESTS.value("serializers", "hit")
+        misses = CACHE_REQUESTS.value("serializers", "miss")
+        MeteredModel.get_serializer(["name"])
+        MeteredModel.get_serializer(["name"])
+        self.assertEqual(CACHE_REQUESTS.value("serializers", "miss"), misses + 1)
+        self.assertEqual(CACHE_REQUESTS.value("serializers", "hit"), hits + 1)
+
+        hits = CACHE_REQUESTS.value("json_encoders", "hit")
+        dumps({"id": ObjectId(), "name": "plain values are not looked up"})
+        self.assertEqual(CACHE_REQUESTS.value("json_encoders", "hit"), hits + 1)
+
+    def test_loop_lag(self):
+        count = EVENT_LOOP_LAG.count()
+
+        async def run():
+            task = asyncio.ensure_future(monitor_event_loop_lag(0.01))
+            await asyncio.sleep(0.055)
+            task.cancel()
+
+        self.loop.run_until_complete(run())
+        self.assertGreaterEqual(EVENT_LOOP_LAG.count() - count, 3)
@@ -0,0 +1,90 @@
+import asyncio
+from unittest import TestCase
+from bson import ObjectId
+from starlette.requests import Request
+from starlette.responses import Response
+
+from uengine.instrumentation import track_db_op
+from uengine.nplusone import NPlusOneDetector, NPlusOneError, normalize_query, query_shape, \
+    create_nplusone_middleware
+
+
+def make_request():
+    return Request({"type": "http", "method": "GET", "path": "/groups", "headers": []})
+
+
+def find_owner(owner_id):
+    with track_db_op("find_one", "users", query={"_id": owner_id}):
+        pass
+
+
+class TestNPlusOne(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def test_normalize_query(self):
+        self.assertDictEqual(normalize_query({"_id": ObjectId()}), {"_id": "?"})
+        self.assertDictEqual(
+            normalize_query({"_id": {"$in": [1, 2, 3]}, "$or": [{"a": 1}, {"b": {"$gt": 2}}]}),
+            {"_id": {"$in": "?"}, "$or": [{"a": "?"}, {"b": {"$gt": "?"}}]}
+        )
+        self.assertEqual(
+            query_shape("find", "users", {"a": 1, "b": 2}),
+            query_shape("find", "users", {"b": 3, "a": 4}),
+        )
+        self.assertNotEqual(
+            query_shape("find", "users", {"a": 1}),
+            query_shape("find", "users", {"a": {"$in": [1]}}),
+        )
+        self.assertEqual(query_shape("insert", "users", None), "insert users null")
+
+    def test_warning(self):
+        with self.assertLogs(level="WARNING") as logs:
+            with NPlusOneDetector(threshold=3, name="test") as detector:
+                for _ in range(6):
+                    find_owner(ObjectId())
+                with track_db_op("find", "groups", query={}):
+                    pass
+        self.assertEqual(len(logs.records), 1)
+        message = logs.records[0].getMessage()
+        self.assertIn("possible N+1 query in test: find_one users", message)
+        # the stack points to the code making the queries
+        self.assertIn("find_owner", message)
+        self.assertDictEqual(detector.repeated(), {'find_one users {"_id": "?"}': 6})
+
+        # the detector is only active inside the context
+        for _ in range(6):
+            find_owner(ObjectId())
+
+    def test_raise(self):
+        with NPlusOneDetector(threshold=2, raise_error=True):
+            find_owner(ObjectId())
+            find_owner(ObjectId())
+            with self.assertRaises(NPlusOneError):
+                find_owner(ObjectId())
+
+    def test_cursor_batches(self):
+        with NPlusOneDetector(threshold=2, raise_error=True) as detector:
+            with track_db_op("find", "users", query={"system": False}):
+                pass
+            for _ in range(6):
+                with track_db_op("get_more", "users", query={"system": False}):
+                    pass
+        self.assertDictEqual(detector.repeated(), {})
+
+    def test_middleware(self):
+        async def call_next(_):
+            for _ in range(3):
+                find_owner(ObjectId())
+            return Response("ok")
+
+        middleware = create_nplusone_middleware(threshold=2, raise_error=True)
+        with self.assertRaises(NPlusOneError) as cm:
+            self.loop.run_until_complete(middleware(make_request(), call_next))
+        self.assertIn("GET /groups", str(cm.exception))
+
+        middleware = create_nplusone_middleware(threshold=3, raise_error=True)
+        response = self.loop.run_until_complete(middleware(make_request(), call_next))
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,247 @@
+import asyncio
+from datetime import timedelta
+from unittest import TestCase
+from bson import ObjectId
+from starlette.requests import Request
+from starlette.responses import Response
+
+from uengine import ctx
+from uengine.utils import now
+from uengine.sessions import BaseSession, BaseCookieSession, create_session_middleware, acquire_session, \
+    generate_session_id, SessionSweeper, DEFAULT_SESSION_EXPIRATION_TIME
+from .temp_db_test import TemporaryDatabaseTest, replace_config, restore_config
+
+COOKIE_NAME = "_uengine_sid"
+
+
+class TestSession(BaseSession):
+    __collection__ = "test_sessions"
+    value: str = None
+
+
+class TenantSession(BaseSession):
+    __collection__ = "test_sessions"
+    tenant: str = "tenant1"
+
+    @classmethod
+    def _preprocess_query(cls, query):
+        return {**query, "tenant": "tenant1"}
+
+
+class TestCookieSessionModel(BaseCookieSession):
+    user_id: ObjectId = None
+    value: str = None
+
+
+def make_request(cookie=None, headers=None):
+    raw_headers = [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()]
+    if cookie:
+        raw_headers.append((b"cookie", f"{COOKIE_NAME}={cookie}".encode()))
+    return Request({"type": "http", "method": "GET", "path": "/", "headers": raw_headers})
+
+
+class TestSessions(TemporaryDatabaseTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        ctx.cfg["app_secret_key"] = "test_secret_key"
+        cls.loop = asyncio.get_event_loop()
+
+    def setUp(self):
+        self.middleware = create_session_middleware(TestSession)
+        self.loop.run_until_complete(TestSession.destroy_all())
+
+    def run_request(self, request, handler):
+        async def call_next(req):
+            await handler(req)
+            return Response("ok")
+        return self.loop.run_until_complete(self.middleware(request, call_next))
+
+    def test_untouched_session(self):
+        async def handler(_):
+            pass
+
+        response = self.run_request(make_request(), handler)
+        self.assertNotIn("set-cookie", response.headers)
+        self.assertEqual(self.loop.run_until_complete(TestSession.find().count()), 0)
+
+    def test_new_session(self):
+        async def handler(req):
+            session = await acquire_session(req)
+            self.assertTrue(session.is_new)
+            session.value = "v"
+            session.modified = True
+
+        response = self.run_request(make_request(), handler)
+        self.assertIn(COOKIE_NAME, response.headers["set-cookie"])
+        self.assertEqual(self.loop.run_until_complete(TestSession.find().count()), 1)
+
+    def test_anonymous_session_is_not_stored(self):
+        async def handler(req):
+            await acquire_session(req)
+
+        response = self.run_request(make_request(), handler)
+        self.assertNotIn("set-cookie", response.headers)
+        self.assertEqual(self.loop.run_until_complete(TestSession.find().count()), 0)
+
+    def test_existing_session(self):
+        sid, cookie = generate_session_id()
+        self.loop.run_until_complete(TestSession(sid=sid, value="v1").save())
+
+        async def handler(req):
+            # concurrent acquirers share the same session object
+            s1, s2 = await asyncio.gather(acquire_session(req), acquire_session(req))
+            self.assertIs(s1, s2)
+            self.assertEqual(s1.sid, sid)
+            s1.value = "v2"
+            s1.modified = True
+
+        response = self.run_request(make_request(cookie), handler)
+        self.assertNotIn("set-cookie", response.headers)
+        session = self.loop.run_until_complete(TestSession.get(sid))
+        self.assertEqual(session.value, "v2")
+
+    def test_expired_session(self):
+        sid, cookie = generate_session_id()
+        expired_at = now() - timedelta(seconds=DEFAULT_SESSION_EXPIRATION_TIME + 1)
+        self.loop.run_until_complete(TestSession(sid=sid, value="v1", updated_at=expired_at).save())
+
+        async def handler(req):
+            session = await acquire_session(req)
+            self.assertTrue(session.is_new)
+            self.assertNotEqual(session.sid, sid)
+
+        self.run_request(make_request(cookie), handler)
+
+    def test_cleanup(self):
+        expired_at = now() - timedelta(seconds=DEFAULT_SESSION_EXPIRATION_TIME + 1)
+        self.loop.run_until_complete(TestSession(sid="expired", updated_at=expired_at).save())
+        self.loop.run_until_complete(TestSession(sid="active").save())
+        removed = self.loop.run_until_complete(TestSession.cleanup())
+        self.assertEqual(removed, 1)
+        self.assertIsNone(self.loop.run_until_complete(TestSession.get("expired")))
+        self.assertIsNotNone(self.loop.run_until_complete(TestSession.get("active")))
+
+    def test_cleanup_preprocessed(self):
+        expired_at = now() - timedelta(seconds=DEFAULT_SESSION_EXPIRATION_TIME + 1)
+        self.loop.run_until_complete(TenantSession(sid="expired1", updated_at=expired_at).save())
+        self.loop.run_until_complete(TenantSession(sid="expired2", tenant="tenant2", updated_at=expired_at).save())
+        removed = self.loop.run_until_complete(TenantSession.cleanup())
+        self.assertEqual(removed, 1)
+        self.assertIsNotNone(self.loop.run_until_complete(TestSession.get("expired2")))
+
+    def test_sweeper(self):
+        expired_at = now() - timedelta(seconds=DEFAULT_SESSION_EXPIRATION_TIME + 1)
+        self.loop.run_until_complete(TestSession(sid="expired", updated_at=expired_at).save())
+        sweeper = SessionSweeper(TestSession, 3600)
+        sweeper.maybe_run()
+        task = sweeper._task  # pylint: disable=protected-access
+        self.loop.run_until_complete(task)
+        self.assertIsNone(self.loop.run_until_complete(TestSession.get("expired")))
+        # rate limited
+        sweeper.maybe_run()
+        self.assertIs(sweeper._task, task)  # pylint: disable=protected-access
+
+    def test_ttl_index(self):
+        self.loop.run_until_complete(TestSession.ensure_indexes())
+        indexes = self.loop.run_until_complete(ctx.db.meta.conn[TestSession.__collection__].index_information())
+        ttl_indexes = [idx for idx in indexes.values() if idx["key"] == [("updated_at", 1)]]
+        self.assertEqual(len(ttl_indexes), 1)
+        self.assertEqual(ttl_indexes[0]["expireAfterSeconds"], DEFAULT_SESSION_EXPIRATION_TIME)
+
+    def test_refresh(self):
+        sid, cookie = generate_session_id()
+        stale = now() - timedelta(seconds=3600)
+        self.loop.run_until_complete(TestSession(sid=sid, updated_at=stale).save())
+
+        async def handler(req):
+            await acquire_session(req)
+
+        response = self.run_request(make_request(cookie), handler)
+        self.assertNotIn("set-cookie", response.headers)
+        session = self.loop.run_until_complete(TestSession.get(sid))
+        self.assertGreater(session.updated_at, stale)
+
+        # the next request within touch interval makes no writes
+        updated_at = session.updated_at
+        self.run_request(make_request(cookie), handler)
+        session = self.loop.run_until_complete(TestSession.get(sid))
+        self.assertEqual(session.updated_at, updated_at)
+
+    def test_no_middleware(self):
+        session = self.loop.run_until_complete(acquire_session(make_request()))
+        self.assertIsNone(session)
+
+
+class TestCookieSession(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.saved_cfg = replace_config({"app_secret_key": "test_secret_key"})
+        cls.loop = asyncio.get_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        restore_config(cls.saved_cfg)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.middleware = create_session_middleware(TestCookieSessionModel)
+
+    def test_roundtrip(self):
+        for value in ("short", "long" * 100):
+            session = TestCookieSessionModel(user_id=ObjectId(), value=value)
+            cookie = self.loop.run_until_complete(session.store())
+            loaded = TestCookieSessionModel.load_cookie(cookie)
+            self.assertEqual(loaded.user_id, session.user_id)
+            self.assertEqual(loaded.value, session.value)
+            self.assertEqual(loaded.updated_at, session.updated_at)
+
+    def test_compression(self):
+        session = TestCookieSessionModel(value="long" * 100)
+        self.assertTrue(session.dump_cookie().startswith("."))
+        self.assertLess(len(session.dump_cookie()), 400)
+
+    def test_tampered(self):
+        cookie = TestCookieSessionModel(value="v").dump_cookie()
+        self.assertIsNone(TestCookieSessionModel.load_cookie(cookie[:-2] + "xx"))
+        self.assertIsNone(TestCookieSessionModel.load_cookie("garbage"))
+        self.assertIsNone(TestCookieSessionModel.load_cookie(""))
+
+    def test_expired(self):
+        session = TestCookieSessionModel(value="v")
+        session.updated_at = now() - timedelta(seconds=DEFAULT_SESSION_EXPIRATION_TIME + 1)
+        self.assertIsNone(TestCookieSessionModel.load_cookie(session.dump_cookie()))
+
+    def test_middleware(self):
+        user_id = ObjectId()
+
+        async def login(req):
+            session = await acquire_session(req)
+            session.user_id = user_id
+            session.modified = True
+
+        async def read(req):
+            session = await acquire_session(req)
+            self.assertEqual(session.user_id, user_id)
+
+        async def run(request, handler):
+            async def call_next(req):
+                await handler(req)
+                return Response("ok")
+            return await self.middleware(request, call_next)
+
+        response = self.loop.run_until_complete(run(make_request(), login))
+        cookie = response.headers["set-cookie"].split(";")[0].split("=", 1)[1]
+        response = self.loop.run_until_complete(run(make_request(cookie), read))
+        self.assertNotIn("set-cookie", response.headers)
+
+    def test_refresh(self):
+        session = TestCookieSessionModel(value="v")
+        self.assertIsNone(self.loop.run_until_complete(session.refresh()))
+        session.updated_at = now() - timedelta(seconds=3600)
+        cookie = self.loop.run_until_complete(session.refresh())
+        self.assertIsNotNone(cookie)
+        self.assertEqual(TestCookieSessionModel.load_cookie(cookie).value, "v")
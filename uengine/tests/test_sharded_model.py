@@ -1,6 +1,7 @@
 import asyncio
 from uengine import ctx
-from uengine.models.sharded_model import ShardedModel, MissingShardId
+from uengine.models.sharded_model import ShardedModel, MissingShardId, merge_group_results
+from uengine.models.relation import Relation
 from .temp_db_test import TemporaryDatabaseTest
 
 CALLABLE_DEFAULT_VALUE = 4
@@ -64,3 +65,79 @@ class TestShardedModel(TemporaryDatabaseTest):
         model = TestModel(shard_id=shard_id, field2="value")
         self.assertEqual(model._shard_id, shard_id)
         self.loop.run_until_complete(model.save())
+
+    def test_get_or_create(self):
+        shard_id, other_shard_id = ctx.db.rw_shards[:2]
+        model, created = self.loop.run_until_complete(
+            TestModel.get_or_create(shard_id, {"field2": "goc"}, {"field1": "v1"})
+        )
+        self.assertTrue(created)
+        self.assertEqual(model._shard_id, shard_id)
+        self.assertEqual(model.field1, "v1")
+
+        same, created = self.loop.run_until_complete(TestModel.get_or_create(shard_id, {"field2": "goc"}))
+        self.assertFalse(created)
+        self.assertEqual(same._id, model._id)
+
+        # the other shard is independent
+        other, created = self.loop.run_until_complete(
+            TestModel.upsert(other_shard_id, {"field2": "goc"}, {"field1": "v2"})
+        )
+        self.assertTrue(created)
+        self.assertEqual(other._shard_id, other_shard_id)
+        self.assertIsNone(self.loop.run_until_complete(TestModel.find_one(other_shard_id, {"field1": "v1"})))
+
+    def test_relation_not_supported(self):
+        with self.assertRaises(TypeError):
+            Relation("model_id", TestModel)
+        relation = Relation("model_id", f"{__name__}.TestModel")
+        with self.assertRaises(TypeError):
+            _ = relation.model
+
+    def _create_across_shards(self):
+        shard_ids = list(ctx.db.shards.keys())
+        for idx in range(6):
+            shard_id = shard_ids[idx % len(shard_ids)]
+            model = TestModel(shard_id=shard_id, field1=f"group{idx % 2}", field2=f"value{idx}")
+            self.loop.run_until_complete(model.save())
+        return shard_ids
+
+    def test_count(self):
+        shard_ids = self._create_across_shards()
+        # a count per shard
+        with self.assertMaxQueries(count=len(shard_ids)):
+            res = self.loop.run_until_complete(TestModel.count())
+        self.assertEqual(res.result, 6)
+        self.assertCountEqual(res.timings.keys(), shard_ids)
+
+        res = self.loop.run_until_complete(TestModel.count({"field1": "group0"}, shard_ids=shard_ids[:1]))
+        # even-indexed models, all of group0, go to the first shard
+        self.assertEqual(res.result, 3)
+        self.assertCountEqual(res.timings.keys(), shard_ids[:1])
+
+    def test_distinct(self):
+        self._create_across_shards()
+        res = self.loop.run_until_complete(TestModel.distinct("field1"))
+        self.assertCountEqual(res.result, ["group0", "group1"])
+
+    def test_aggregate(self):
+        self._create_across_shards()
+        pipeline = [{"$group": {"_id": "$field1", "cnt": {"$sum": 1}, "values": {"$addToSet": "$field2"}}}]
+        res = self.loop.run_until_complete(TestModel.aggregate(pipeline))
+        groups = {doc["_id"]: doc for doc in res.result}
+        self.assertEqual(groups["group0"]["cnt"], 3)
+        self.assertEqual(groups["group1"]["cnt"], 3)
+        self.assertCountEqual(groups["group0"]["values"], ["value0", "value2", "value4"])
+
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(TestModel.aggregate([{"$group": {"_id": None, "a": {"$avg": 1}}}]))
+
+    def test_merge_group_results(self):
+        group = {"_id": "$k", "total": {"$sum": "$v"}, "lo": {"$min": "$v"}, "hi": {"$max": "$v"}}
+        shard_results = [
+            [{"_id": {"k": 1}, "total": 3, "lo": 1, "hi": 2}, {"_id": {"k": 2}, "total": 5, "lo": 5, "hi": 5}],
+            [{"_id": {"k": 1}, "total": 4, "lo": 0, "hi": 4}],
+        ]
+        merged = merge_group_results(group, shard_results)
+        self.assertEqual(len(merged), 2)
+        self.assertDictEqual(merged[0], {"_id": {"k": 1}, "total": 7, "lo": 0, "hi": 4})
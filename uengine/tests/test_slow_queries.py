@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from uengine.instrumentation import DBOperation
+from uengine.slow_queries import SlowQueryLog, parse_slow_query_line, explain_command, summarize_explain
+
+
+def make_op(duration, operation="find", query=None, options=None):
+    return DBOperation(operation, "users", "s1", query or {"username": "u"}, duration, None, options)
+
+
+EXPLAIN_RESULT = {
+    "queryPlanner": {
+        "winningPlan": {
+            "stage": "SORT",
+            "inputStage": {"stage": "COLLSCAN", "filter": {"username": {"$regex": "^u"}}},
+        }
+    },
+    "executionStats": {"nReturned": 2, "totalDocsExamined": 1000, "totalKeysExamined": 0},
+}
+
+
+class TestSlowQueries(TestCase):
+
+    def test_threshold(self):
+        slow_log = SlowQueryLog(threshold=0.1)
+        with self.assertLogs(level="WARNING") as logs:
+            slow_log(make_op(0.05))
+            slow_log(make_op(0.2, query={"username": {"$regex": "^a"}},
+                             options={"sort": [("created_at", -1)], "skip": 20, "limit": 10}))
+        self.assertEqual(len(logs.records), 1)
+        record = parse_slow_query_line(logs.output[0])
+        self.assertDictEqual(record, {
+            "operation": "find",
+            "collection": "users",
+            "shard_id": "s1",
+            "filter": {"username": {"$regex": "?"}},
+            "sort": [["created_at", -1]],
+            "skip": 20,
+            "limit": 10,
+            "duration_ms": 200.0,
+        })
+        self.assertIsNone(parse_slow_query_line("WARNING some other message"))
+
+    def test_explain_command(self):
+        command = explain_command(make_op(0.2, options={"sort": [("a", 1), ("b", -1)], "skip": 5, "limit": 10}))
+        self.assertListEqual(list(command.items()), [
+            ("find", "users"),
+            ("filter", {"username": "u"}),
+            ("sort", {"a": 1, "b": -1}),
+            ("skip", 5),
+            ("limit", 10),
+        ])
+        self.assertEqual(explain_command(make_op(0.2, "find_one"))["limit"], 1)
+        self.assertListEqual(list(explain_command(make_op(0.2, "count")).keys()), ["count", "query"])
+
+    def test_summarize_explain(self):
+        self.assertDictEqual(summarize_explain(EXPLAIN_RESULT), {
+            "docs_examined": 1000,
+            "keys_examined": 0,
+            "returned": 2,
+            "collection_scan": True,
+            "in_memory_sort": True,
+        })
@@ -1,5 +1,8 @@
 import asyncio
+from datetime import datetime, timedelta
 from uengine.models.storable_model import StorableModel
+from uengine.utils import now
+from uengine.errors import FieldRequired
 from .temp_db_test import TemporaryDatabaseTest
 
 CALLABLE_DEFAULT_VALUE = 4
@@ -30,6 +33,26 @@ class TestModel(StorableModel):
     )
 
 
+class CallbackModel(StorableModel):
+    name: str
+    value: int = 0
+    saves: int = 0
+
+    __auto_trim_fields__ = {"name"}
+
+    async def _before_save(self):
+        if self.value < 0:
+            raise ValueError("value can not be negative")
+        self.saves += 1
+
+    async def _after_save(self, is_new):
+        self.after_save_called = is_new
+
+
+class TouchModel(StorableModel):
+    updated_at: datetime = now
+
+
 class TestStorableModel(TemporaryDatabaseTest):
 
     @classmethod
@@ -81,3 +104,93 @@ class TestStorableModel(TemporaryDatabaseTest):
         self.assertEqual(model1.field2, "mymodel_updated")
         self.assertEqual(model2.field2, "mymodel_updated")
         self.assertEqual(model3.field2, "mymodel_update_test")
+
+    def test_db_touch(self):
+        model = TouchModel()
+        self.loop.run_until_complete(model.save())
+        stale = now() - timedelta(seconds=30)
+        self.loop.run_until_complete(model.db_update({"$set": {"updated_at": stale}}))
+
+        # throttled
+        self.assertFalse(self.loop.run_until_complete(model.db_touch(interval=60)))
+        self.assertEqual(model.updated_at, stale)
+
+        self.assertTrue(self.loop.run_until_complete(model.db_touch(interval=10)))
+        stored = self.loop.run_until_complete(TouchModel.find_one({"_id": model._id}))
+        self.assertGreater(stored.updated_at, stale)
+        self.assertEqual(stored.updated_at, model.updated_at)
+
+    def test_db_touch_never_goes_back(self):
+        model = TouchModel()
+        self.loop.run_until_complete(model.save())
+        future = now() + timedelta(seconds=60)
+        self.loop.run_until_complete(TouchModel.update_many({"_id": model._id}, {"$set": {"updated_at": future}}))
+        self.loop.run_until_complete(model.db_touch(interval=0))
+        stored = self.loop.run_until_complete(TouchModel.find_one({"_id": model._id}))
+        self.assertEqual(stored.updated_at, future)
+
+    def test_get_or_create(self):
+        model, created = self.loop.run_until_complete(TestModel.get_or_create({"field2": "goc"}, {"field1": "v1"}))
+        self.assertTrue(created)
+        self.assertFalse(model.is_new)
+        self.assertEqual(model.field1, "v1")
+        self.assertEqual(model.field3, "required_default_value")
+        self.assertEqual(model.callable_default_field, CALLABLE_DEFAULT_VALUE)
+
+        same, created = self.loop.run_until_complete(TestModel.get_or_create({"field2": "goc"}, {"field1": "v2"}))
+        self.assertFalse(created)
+        self.assertEqual(same._id, model._id)
+        self.assertEqual(same.field1, "v1")
+
+    def test_upsert(self):
+        model, created = self.loop.run_until_complete(
+            TestModel.upsert({"field2": "ups"}, {"field1": "set"}, set_on_insert={"field3": "inserted"})
+        )
+        self.assertTrue(created)
+        self.assertEqual(model.field1, "set")
+        self.assertEqual(model.field3, "inserted")
+
+        model, created = self.loop.run_until_complete(
+            TestModel.upsert({"field2": "ups"}, {"field1": "updated"}, set_on_insert={"field3": "ignored"})
+        )
+        self.assertFalse(created)
+        self.assertEqual(model.field1, "updated")
+        self.assertEqual(model.field3, "inserted")
+
+    def test_upsert_validation(self):
+        with self.assertRaises(FieldRequired):
+            self.loop.run_until_complete(TestModel.upsert({"field1": "x"}, {"field3": "y"}))
+
+    def test_upsert_save_steps(self):
+        self.loop.run_until_complete(CallbackModel.destroy_all())
+        model, created = self.loop.run_until_complete(
+            CallbackModel.upsert({"name": "  trimmed "}, {"value": 1}, set_on_insert={"value": 2})
+        )
+        self.assertTrue(created)
+        self.assertEqual(model.name, "trimmed")
+        # set_fields win over set_on_insert
+        self.assertEqual(model.value, 1)
+        self.assertEqual(model.saves, 1)
+        self.assertTrue(model.after_save_called)
+
+        same, created = self.loop.run_until_complete(CallbackModel.get_or_create({"name": "trimmed "}))
+        self.assertFalse(created)
+        self.assertEqual(same._id, model._id)
+
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(CallbackModel.upsert({"name": "negative"}, {"value": -1}))
+        self.assertIsNone(self.loop.run_until_complete(CallbackModel.find_one({"name": "negative"})))
+
+    def test_assert_max_queries(self):
+        with self.assertMaxQueries(2, insert=1) as counter:
+            self.loop.run_until_complete(TestModel(field2="counted").save())
+            self.loop.run_until_complete(TestModel.find_one({"field2": "counted"}))
+        self.assertEqual(counter.count("insert"), 1)
+        self.assertEqual(counter.count("find"), 1)
+
+        with self.assertRaises(AssertionError) as cm:
+            with self.assertMaxQueries(find=1):
+                for _ in range(2):
+                    self.loop.run_until_complete(TestModel.find_one({"field2": "counted"}))
+        self.assertIn("2 find queries made, at most 1 expected", str(cm.exception))
+        self.assertIn("find_one test_model", str(cm.exception))
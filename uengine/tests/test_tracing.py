@@ -0,0 +1,148 @@
+import os
+import json
+import asyncio
+import tempfile
+from unittest import TestCase
+from starlette.requests import Request
+from starlette.responses import Response
+
+from uengine.instrumentation import track_db_op, add_db_observer, remove_db_observer
+from uengine.tracing import span, traced, record_span, db_tracing_observer, Span, Trace, NOOP_SPAN, \
+    InMemoryExporter, JsonLinesExporter, get_exporter, set_exporter, create_tracing_middleware, \
+    TRACE_ID_HEADER
+from .temp_db_test import replace_config, restore_config
+
+
+def make_request():
+    return Request({"type": "http", "method": "GET", "path": "/things", "headers": []})
+
+
+class TestTracing(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.saved_cfg = replace_config({})
+        cls.loop = asyncio.get_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        restore_config(cls.saved_cfg)
+
+    def setUp(self) -> None:
+        self.saved_exporter = get_exporter()
+
+    def tearDown(self) -> None:
+        set_exporter(self.saved_exporter)
+
+    def test_noop_outside_trace(self):
+        self.assertIs(span("anything"), NOOP_SPAN)
+        with span("anything") as s:
+            s.set_attribute("key", "value")
+        record_span("finished", 0.1)
+
+    def test_nesting(self):
+        trace = Trace()
+
+        @traced()
+        async def dependency():
+            with span("inner", key="value"):
+                pass
+
+        async def handler():
+            with Span(trace, "root"):
+                await dependency()
+                record_span("db.find", 0.005, collection="users")
+
+        self.loop.run_until_complete(handler())
+        spans = {s.name: s for s in trace.spans}
+        self.assertEqual(len(spans), 4)
+        root = spans["root"]
+        wrapper = spans[dependency.__qualname__]
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(wrapper.parent_id, root.span_id)
+        self.assertEqual(spans["inner"].parent_id, wrapper.span_id)
+        self.assertEqual(spans["inner"].attributes, {"key": "value"})
+        self.assertEqual(spans["db.find"].parent_id, root.span_id)
+        self.assertAlmostEqual(spans["db.find"].duration, 0.005)
+        # spans are appended when finished, the root one comes last
+        self.assertEqual(trace.spans[-1].name, "root")
+
+    def test_error(self):
+        trace = Trace()
+        with self.assertRaises(KeyError):
+            with Span(trace, "root"):
+                with span("failing"):
+                    raise KeyError("x")
+        self.assertEqual(trace.spans[0].name, "failing")
+        self.assertIn("KeyError", trace.spans[0].error)
+        self.assertIn("KeyError", trace.spans[1].error)
+
+    def test_db_observer(self):
+        trace = Trace()
+        add_db_observer(db_tracing_observer)
+        try:
+            with Span(trace, "root"):
+                with track_db_op("find", "users", "s1"):
+                    pass
+        finally:
+            remove_db_observer(db_tracing_observer)
+        self.assertEqual(trace.spans[0].name, "db.find")
+        self.assertDictEqual(trace.spans[0].attributes, {"collection": "users", "shard_id": "s1"})
+
+    def test_middleware(self):
+        exporter = InMemoryExporter(max_traces=2)
+        set_exporter(exporter)
+
+        async def call_next(_):
+            with span("handler"):
+                pass
+            return Response("ok")
+
+        middleware = create_tracing_middleware(1.0)
+        for _ in range(3):
+            response = self.loop.run_until_complete(middleware(make_request(), call_next))
+            self.assertIn(TRACE_ID_HEADER, response.headers)
+        self.assertEqual(len(exporter.traces), 2)
+
+        spans = exporter.traces[-1]
+        self.assertListEqual([s["name"] for s in spans], ["handler", "request"])
+        self.assertEqual(spans[1]["attributes"]["status"], 200)
+        self.assertEqual(spans[1]["attributes"]["path"], "/things")
+        self.assertEqual(spans[1]["trace_id"], response.headers[TRACE_ID_HEADER])
+        self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+
+        middleware = create_tracing_middleware(0)
+        response = self.loop.run_until_complete(middleware(make_request(), call_next))
+        self.assertNotIn(TRACE_ID_HEADER, response.headers)
+        self.assertEqual(len(exporter.traces), 2)
+
+    def test_failed_request(self):
+        exporter = InMemoryExporter()
+        set_exporter(exporter)
+
+        async def call_next(_):
+            with span("handler"):
+                raise KeyError("x")
+
+        middleware = create_tracing_middleware(1.0)
+        with self.assertRaises(KeyError):
+            self.loop.run_until_complete(middleware(make_request(), call_next))
+        spans = exporter.traces[-1]
+        self.assertListEqual([s["name"] for s in spans], ["handler", "request"])
+        self.assertIn("KeyError", spans[1]["error"])
+
+    def test_json_lines_exporter(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "traces.jsonl")
+            exporter = JsonLinesExporter(filename)
+            trace = Trace()
+            with Span(trace, "root"):
+                with span("child"):
+                    pass
+            exporter.export(trace)
+            exporter.close()
+
+            with open(filename) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertListEqual([s["name"] for s in spans], ["child", "root"])
+        self.assertTrue(all(s["trace_id"] == trace.trace_id for s in spans))
@@ -0,0 +1,58 @@
+import asyncio
+from unittest import TestCase
+
+from uengine.utils import gather_or_cancel
+
+
+class TestGatherOrCancel(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.loop = asyncio.get_event_loop()
+
+    def test_results(self):
+        async def value(v):
+            await asyncio.sleep(0)
+            return v
+
+        results = self.loop.run_until_complete(gather_or_cancel(value(1), value(2)))
+        self.assertListEqual(results, [1, 2])
+
+    def test_cancel_on_error(self):
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def failing():
+            await asyncio.sleep(0)
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            self.loop.run_until_complete(gather_or_cancel(slow(), failing()))
+        self.assertListEqual(cancelled, [True])
+
+    def test_cancel_caller(self):
+        cancelled = []
+
+        async def slow():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        async def caller():
+            task = asyncio.ensure_future(gather_or_cancel(slow(), slow()))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0)
+
+        self.loop.run_until_complete(caller())
+        self.assertListEqual(cancelled, [True, True])
@@ -0,0 +1,223 @@
+import json
+import random
+import logging
+import functools
+from collections import deque
+from contextvars import ContextVar
+from time import time, monotonic
+from starlette.requests import Request
+
+from . import ctx
+from .log import create_queue_logging, request_id_var
+
+DEFAULT_MEMORY_EXPORTER_SIZE = 1000
+TRACE_ID_HEADER = "X-Trace-Id"
+
+_current_span = ContextVar("current_span", default=None)
+_exporter = None
+
+
+def _new_id() -> str:
+    return "%016x" % random.getrandbits(64)
+
+
+class Span:
+    """
+    a timed operation within a trace, spans are only created for
+    sampled requests, the rest get the no-op span
+    """
+
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes",
+                 "start", "duration", "error", "_started_at", "_token")
+
+    def __init__(self, trace, name, parent_id=None, attributes=None):
+        self.trace = trace
+        self.name = name
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start = None
+        self.duration = None
+        self.error = None
+        self._started_at = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start = time()
+        self._started_at = monotonic()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.duration = monotonic() - self._started_at
+        if exc_val is not None:
+            self.error = repr(exc_val)
+        _current_span.reset(self._token)
+        self.trace.spans.append(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan:
+
+    __slots__ = ()
+
+    def set_attribute(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or _new_id() + _new_id()
+        self.spans = []
+
+
+def span(name: str, **attributes):
+    """
+    starts a child span of the current one, a no-op outside of sampled traces
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def traced(name: str = None):
+    """
+    wraps a coroutine function into a span, e.g. a FastAPI dependency
+    """
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(span_name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_span(name: str, duration: float, error=None, **attributes):
+    """
+    adds an already finished span to the current trace
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return
+    finished = Span(parent.trace, name, parent.span_id, attributes)
+    finished.start = time() - duration
+    finished.duration = duration
+    if error is not None:
+        finished.error = repr(error)
+    parent.trace.spans.append(finished)
+
+
+def db_tracing_observer(op):
+    record_span(f"db.{op.operation}", op.duration, op.error,
+                collection=op.collection, shard_id=op.shard_id)
+
+
+class InMemoryExporter:
+    """
+    keeps the last max_traces traces, handy for tests and debugging
+    """
+
+    def __init__(self, max_traces: int = DEFAULT_MEMORY_EXPORTER_SIZE):
+        self.traces = deque(maxlen=max_traces)
+
+    def export(self, trace: Trace):
+        self.traces.append([s.to_dict() for s in trace.spans])
+
+    def close(self):
+        pass
+
+
+class JsonLinesExporter:
+    """
+    appends spans to a file as json lines, the writing is done
+    by a logging queue listener thread off the event loop
+    """
+
+    def __init__(self, filename: str):
+        self.logger = logging.getLogger(f"uengine.tracing.{filename}")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.file_handler = logging.FileHandler(filename)
+        self.file_handler.setFormatter(logging.Formatter("%(message)s"))
+        queue_handler, self.listener = create_queue_logging([self.file_handler])
+        self.logger.addHandler(queue_handler)
+
+    def export(self, trace: Trace):
+        for s in trace.spans:
+            self.logger.info(json.dumps(s.to_dict(), default=str))
+
+    def close(self):
+        self.listener.stop()
+        self.file_handler.close()
+
+
+def get_exporter():
+    return _exporter
+
+
+def set_exporter(exporter):
+    global _exporter
+    _exporter = exporter
+
+
+def create_exporter():
+    exporter_type = ctx.cfg.get("tracing_exporter", "memory")
+    if exporter_type == "memory":
+        return InMemoryExporter(ctx.cfg.get("tracing_memory_size", DEFAULT_MEMORY_EXPORTER_SIZE))
+    if exporter_type == "jsonl":
+        return JsonLinesExporter(ctx.cfg["tracing_file"])
+    raise ValueError(f"unknown tracing exporter {exporter_type}")
+
+
+def create_tracing_middleware(sample_rate: float):
+
+    async def tracing_middleware(request: Request, call_next):
+        if random.random() >= sample_rate:
+            return await call_next(request)
+
+        trace = Trace()
+        attributes = {"method": request.method, "path": request.url.path, "request_id": request_id_var.get()}
+        try:
+            with Span(trace, "request", attributes=attributes) as root:
+                response = await call_next(request)
+                route = request.scope.get("route")
+                if route is not None:
+                    root.set_attribute("route", route.path)
+                root.set_attribute("status", response.status_code)
+        finally:
+            # failed requests are the most interesting ones to export
+            if _exporter is not None:
+                _exporter.export(trace)
+
+        response.headers[TRACE_ID_HEADER] = trace.trace_id
+        return response
+
+    return tracing_middleware
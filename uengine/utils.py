@@ -1,5 +1,6 @@
 import os
 import json
+import asyncio
 from datetime import datetime
 from bson.objectid import ObjectId, InvalidId
 from urllib.parse import urlencode, unquote, urlparse, parse_qsl, ParseResult
@@ -28,6 +29,30 @@ def resolve_id(id_):
     return id_
 
 
+async def gather_or_cancel(*aws):
+    """
+    runs awaitables concurrently like asyncio.gather does but cancels
+    the rest of them as soon as one fails or the caller gets cancelled
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if pending:
+        for task in pending:
+            task.cancel()
+        await asyncio.wait(pending)
+
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+    return [task.result() for task in tasks]
+
+
 def uuid4_string():
     return str(uuid4())
 